@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Stage by stage benchmark of the acquisition path, without a headset.
+
+Every stage a packet goes through is timed on its own against a simulated
+dongle (epoc_sim), one call at a time, for each batch size:
+
+    read      SimulatedEndpoint.read(32), one packet per call
+    decrypt   AES decryption of a batch of packets
+    decode    EmotivPacketDecoder.decode() of a decrypted batch
+    enqueue   SampleRingBuffer.write() of a decoded batch
+    dequeue   SampleRingBuffer.read() of a batch
+
+then the whole path end to end: EmotivDeviceGroup acquiring from 1 to N
+simulated headsets, with the dongles sending as fast as they are read
+unless --realtime is given.
+
+Cold start is measured too, each time in a fresh interpreter: the import
+of every module of STARTUP_MODULES (which pulls in its dependencies) and
+the construction of an EmotivDevice on a simulated dongle. The median of
+--startup-runs runs is reported, after one run which compiles the modules.
+
+Results (throughput, p50/p99/p99.9/max latency in microseconds) are
+printed and written as JSON with --output; --compare checks them against a
+previous run and exits with status 1 if a stage got slower than
+--tolerance allows, so that regressions are caught between versions:
+
+    python benchmark.py --output before.json
+    python benchmark.py --compare before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from epoc_buffer import SampleRingBuffer
+from epoc_decoder import PACKET_SIZE, EmotivPacketDecoder, hostClock
+from epoc_sim import DEFAULT_SERIAL, SimulatedEndpoint, SimulatedTransport
+from epoc_usb import newCipher
+
+# Finest clock available for the per call timings
+timer = getattr(time, "perf_counter", hostClock)
+
+PERCENTILES = (50, 99, 99.9)
+
+def summarize(latencies, items):
+    """Statistics of per call `latencies` (seconds) of calls handling `items`
+    packets each."""
+    latencies = np.asarray(latencies)
+    micro = latencies * 1e6
+    result = {"calls": len(latencies),
+              "packetsPerSec": items * len(latencies) / latencies.sum(),
+              "maxUs": float(micro.max())}
+    for p, value in zip(PERCENTILES, np.percentile(micro, PERCENTILES)):
+        result["p%gUs" % p] = float(value)
+    return result
+
+def timeCalls(call, count):
+    """Per call duration of `count` calls of call(i)."""
+    latencies = np.empty(count)
+    for i in range(count):
+        start = timer()
+        call(i)
+        latencies[i] = timer() - start
+    return latencies
+
+def benchStages(packets, batchSize):
+    """Time every stage over `packets` packets, batchSize at a time."""
+    calls = packets // batchSize
+    packets = calls * batchSize
+    endpoint = SimulatedEndpoint(realtime=False)
+    results = {}
+
+    raw = []
+    results["read"] = summarize(timeCalls(lambda i: raw.append(endpoint.read(PACKET_SIZE)),
+                                          packets), 1)
+    batches = [b"".join(bytes(bytearray(r)) for r in raw[i:i + batchSize])
+               for i in range(0, packets, batchSize)]
+
+    cipher = newCipher(DEFAULT_SERIAL)
+    plain = []
+    results["decrypt"] = summarize(timeCalls(lambda i: plain.append(cipher.decrypt(batches[i])),
+                                             calls), batchSize)
+
+    decoder = EmotivPacketDecoder()
+    readTimes = np.arange(packets) / 128.0
+    blocks = []
+    results["decode"] = summarize(timeCalls(
+        lambda i: blocks.append(decoder.decode(plain[i], readTimes[i * batchSize:(i + 1) * batchSize])),
+        calls), batchSize)
+
+    ring = SampleRingBuffer(max(4096, 2 * batchSize))
+    cursor = ring.openCursor()
+    # Write and read in turn so that the buffer is never lapped
+    enqueue = np.empty(calls)
+    dequeue = np.empty(calls)
+    for i in range(calls):
+        start = timer()
+        ring.write(blocks[i])
+        enqueue[i] = timer() - start
+        start = timer()
+        ring.read(cursor, batchSize)
+        dequeue[i] = timer() - start
+    results["enqueue"] = summarize(enqueue, batchSize)
+    results["dequeue"] = summarize(dequeue, batchSize)
+    return results
+
+def benchDevices(deviceCount, duration, batchSize, realtime):
+    """Samples per second delivered by EmotivDeviceGroup.read() from
+    `deviceCount` simulated headsets over `duration` seconds."""
+    from epoc_group import EmotivDeviceGroup
+    serials = ["SN201301160%05d" % i for i in range(deviceCount)]
+    group = EmotivDeviceGroup(transport=SimulatedTransport(serials, realtime=realtime),
+                              batchSize=batchSize)
+    samples = dict((sn, 0) for sn in serials)
+    group.startAcquisition()
+    start = hostClock()
+    try:
+        while hostClock() - start < duration:
+            for sn, block in group.read(timeout=0.1).items():
+                samples[sn] += len(block.counter)
+    finally:
+        elapsed = hostClock() - start
+        group.stopAcquisition()
+    overwritten = sum(device._cursor.overwritten for device in group.devices.values())
+    lost = sum(group.getPacketLoss().values())
+    return {"devices": deviceCount,
+            "samplesPerSec": sum(samples.values()) / elapsed,
+            "minDeviceSamplesPerSec": min(samples.values()) / elapsed,
+            "overwritten": overwritten,
+            "packetsLost": lost}
+
+# Modules imported by the cold start runs, the decoder alone first
+STARTUP_MODULES = ("epoc_decoder", "epoc_buffer", "epoc_record", "epoc_iohub", "epoc_group")
+
+_STARTUP_SCRIPT = """
+import time
+timer = getattr(time, "perf_counter", time.time)
+start = timer()
+import %s
+imported = timer()
+%s
+print(repr((imported - start, timer() - imported)))
+"""
+
+_DEVICE_SETUP = "epoc_iohub.EmotivDevice(transport=epoc_sim.SimulatedTransport())"
+
+def coldStart(modules, setup=""):
+    """(import, setup, whole process) seconds of a fresh interpreter which
+    imports `modules` then runs the `setup` statement."""
+    script = _STARTUP_SCRIPT % (modules, setup)
+    start = timer()
+    output = subprocess.check_output([sys.executable, "-c", script],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    process = timer() - start
+    imported, setUp = eval(output.decode().strip())
+    return imported, setUp, process
+
+def benchStartup(runs):
+    """Median cold start times in milliseconds of every STARTUP_MODULES and
+    of a simulated EmotivDevice."""
+    cases = [(name, name, "") for name in STARTUP_MODULES]
+    cases.append(("device", "epoc_iohub, epoc_sim", _DEVICE_SETUP))
+    results = {}
+    for name, modules, setup in cases:
+        coldStart(modules, setup)
+        times = np.array([coldStart(modules, setup) for i in range(runs)]) * 1e3
+        imported, setUp, process = np.median(times, axis=0)
+        results[name] = {"importMs": float(imported), "processMs": float(process)}
+        if setup:
+            results[name]["setupMs"] = float(setUp)
+    return results
+
+# Figures checked by --compare; p99.9 and max are too noisy over short runs
+COMPARED = ("p50Us", "p99Us")
+
+def compare(results, baseline, tolerance):
+    """Lines describing every figure of `results` worse than `baseline` by
+    more than `tolerance` (a fraction)."""
+    regressions = []
+    for batch, stages in results["stages"].items():
+        for stage, stats in stages.items():
+            old = baseline.get("stages", {}).get(batch, {}).get(stage)
+            if old is None:
+                continue
+            for key, value in stats.items():
+                if key in COMPARED and value > old[key] * (1 + tolerance):
+                    regressions.append("%s batch %s %s: %.1f -> %.1f"
+                                       % (stage, batch, key, old[key], value))
+                if key == "packetsPerSec" and value < old[key] * (1 - tolerance):
+                    regressions.append("%s batch %s %s: %.0f -> %.0f"
+                                       % (stage, batch, key, old[key], value))
+    for name, times in results.get("startup", {}).items():
+        before = baseline.get("startup", {}).get(name)
+        if before and times["importMs"] > before["importMs"] * (1 + tolerance):
+            regressions.append("%s importMs: %.1f -> %.1f"
+                               % (name, before["importMs"], times["importMs"]))
+    old = dict((r["devices"], r) for r in baseline.get("devices", []))
+    for run in results["devices"]:
+        before = old.get(run["devices"])
+        if before and run["samplesPerSec"] < before["samplesPerSec"] * (1 - tolerance):
+            regressions.append("%d devices samplesPerSec: %.0f -> %.0f"
+                               % (run["devices"], before["samplesPerSec"],
+                                  run["samplesPerSec"]))
+    return regressions
+
+def printResults(results):
+    print("%-8s %6s %12s %9s %9s %9s %9s" % ("stage", "batch", "packets/s",
+                                             "p50 us", "p99 us", "p99.9 us", "max us"))
+    for batch in sorted(results["stages"], key=int):
+        for stage in ("read", "decrypt", "decode", "enqueue", "dequeue"):
+            s = results["stages"][batch][stage]
+            print("%-8s %6s %12.0f %9.1f %9.1f %9.1f %9.1f" % (
+                stage, batch, s["packetsPerSec"], s["p50Us"], s["p99Us"],
+                s["p99.9Us"], s["maxUs"]))
+    for run in results["devices"]:
+        print("%d device(s): %.0f samples/s (slowest device %.0f/s), "
+              "%d overwritten, %d lost" % (run["devices"], run["samplesPerSec"],
+                                           run["minDeviceSamplesPerSec"],
+                                           run["overwritten"], run["packetsLost"]))
+    startup = results.get("startup", {})
+    for name in STARTUP_MODULES + ("device",):
+        if name in startup:
+            s = startup[name]
+            print("cold start %-13s import %6.1f ms, process %6.1f ms%s" % (
+                name, s["importMs"], s["processMs"],
+                ", construction %.1f ms" % s["setupMs"] if "setupMs" in s else ""))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=20000,
+                        help="packets pushed through each stage")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="headset counts of the end to end runs")
+    parser.add_argument("--duration", type=float, default=3.0,
+                        help="seconds of every end to end run")
+    parser.add_argument("--realtime", action="store_true",
+                        help="pace the simulated dongles at 128Hz")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="fresh interpreters per cold start figure, 0 to skip them")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown allowed by --compare (fraction)")
+    args = parser.parse_args(argv)
+
+    results = {"python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "time": time.time(),
+               "packets": args.packets,
+               "stages": {},
+               "devices": [],
+               "startup": {}}
+    for batchSize in args.batch_sizes:
+        results["stages"][str(batchSize)] = benchStages(args.packets, batchSize)
+    for count in args.devices:
+        results["devices"].append(benchDevices(count, args.duration,
+                                               max(args.batch_sizes), args.realtime))
+    if args.startup_runs:
+        results["startup"] = benchStartup(args.startup_runs)
+    printResults(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
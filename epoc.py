@@ -23,15 +23,14 @@ import os
 import sys
 import time
 
-import usb.core
-import usb.util
-
 import numpy as np
 import time
 
-from bitstring import BitArray
+# USB and AES are only imported once a headset is used, see epoc_usb
+from epoc_decoder import CYCLE, DeviceTables, EmotivPacketDecoder, hostClock, signalDtype
+from epoc_usb import (INTERFACE_DESC, MANUFACTURER_DESC, dongleKey, newCipher, openDongle,
+                      releaseDongle)
 
-from Crypto.Cipher import AES
 
 # Enumerations for EEG channels (14 channels)
 CH_F3, CH_FC5, CH_AF3, CH_F7, CH_T7,  CH_P7, CH_O1,\
@@ -40,68 +39,29 @@ CH_O2, CH_P8,  CH_T8,  CH_F8, CH_AF4, CH_FC6,CH_F4 = range(14)
 class EmotivEPOCNotFoundException(Exception):
     pass
 
-class EmotivEPOC(object):
-    def __init__(self, serialNumber=None):
-        # These seem to be the same for every device
-        self.INTERFACE_DESC = "Emotiv RAW DATA"
-        self.MANUFACTURER_DESC = "Emotiv Systems Pty Ltd"
-
-        # Define a contact quality ordering
-        # See:
-        #   github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
-        # For counter values between 0-15
-        self.cqOrder = ["F3", "FC5", "AF3", "F7", "T7",  "P7",  "O1",
-                        "O2", "P8",  "T8",  "F8", "AF4", "FC6", "F4",
-                        "F8", "AF4"]
-        # 16-63 is currently unknown
-        self.cqOrder.extend([None,] * 48)
-        # Now the first 16 values repeat once more and ends with 'FC6'
-        self.cqOrder.extend(self.cqOrder[:16])
-        self.cqOrder.append("FC6")
-        # Finally pattern 77-80 repeats until 127
-        self.cqOrder.extend(self.cqOrder[-4:] * 12)
-
-        # Channel names
-        self.channelNames = ["F3", "FC5", "AF3", "F7", "T7", "P7", "O1",
-                             "O2", "P8",  "T8",  "F8", "AF4","FC6","F4"]
-
-        ##################
-        # ADC parameters #
-        # ################
-
-        # Sampling rate: 128Hz (Internal: 2048Hz)
-        self.sampling_rate = 128
-
-        # Vertical resolution (0.51 microVolt)
-        self.resolution = 0.51
-
-        # Each channel has 14 bits of data
-        self.ch_bits = 14
-
-        self.sample_buffer=np.ndarray([1,14])
-
-        # Battery levels
-        # github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
-        self.battery_levels = {247:99, 246:97, 245:93, 244:89, 243:85,
-                               242:82, 241:77, 240:72, 239:66, 238:62,
-                               237:55, 236:46, 235:32, 234:20, 233:12,
-                               232: 6, 231: 4, 230: 3, 229: 2, 228: 1,
-                               227: 1, 226: 1,
-                               }
-        # 100% for bit values between 248-255
-        self.battery_levels.update(dict([(k,100) for k in range(248, 256)]))
-        # 0% for bit values between 128-225
-        self.battery_levels.update(dict([(k,0)   for k in range(128, 226)]))
+class EmotivEPOC(DeviceTables):
+    # These seem to be the same for every device
+    INTERFACE_DESC = INTERFACE_DESC
+    MANUFACTURER_DESC = MANUFACTURER_DESC
+
+    def __init__(self, serialNumber=None, transport=None, signalFormat="float"):
+        self.sample_buffer=np.zeros((1, 14), dtype=signalDtype(signalFormat))
 
         # One can want to specify the dongle with its serial
         self.serialNumber = serialNumber
 
+        # Replaces the USB scan, e.g. epoc_sim.SimulatedTransport()
+        self.transport = transport
+
         # Serial number indexed device map
         self.devices = {}
         self.endpoints = {}
 
+        # Keeps the counter sequence to count lost packets
+        # signalFormat is one of epoc_decoder.SIGNAL_FORMATS
+        self.decoder = EmotivPacketDecoder(signalFormat=signalFormat)
+
         # Acquired data
-        self.packetLoss = 0
         self.counter = 0
         self.battery = 0
         self.gyroX   = 0
@@ -113,85 +73,35 @@ class EmotivEPOC(object):
                             "FC6": 0, "F4"  : 0,
                        }
 
-    def _is_emotiv_epoc(self, device):
-        """Custom match function for libusb."""
-        try:
-            manu = usb.util.get_string(device, len(self.MANUFACTURER_DESC),
-                                       device.iManufacturer)
-        except usb.core.USBError, ue:
-            # Skip failing devices as it happens on Raspberry Pi
-            if ue.errno == 32:
-                return False
-            elif ue.errno == 13:
-                self.permissionProblem = True
-                pass
-        else:
-            if manu == self.MANUFACTURER_DESC:
-                # Found a dongle, check for interface class 3
-                for interf in device.get_active_configuration():
-                    ifStr = usb.util.get_string(device, len(self.INTERFACE_DESC),
-                                                interf.iInterface)
-                    if ifStr == self.INTERFACE_DESC:
-                        return True
-
     def enumerate(self):
-        devs = usb.core.find(find_all=True, custom_match=self._is_emotiv_epoc)
-
-        if not devs:
-            raise EmotivEPOCNotFoundException("No plugged Emotiv EPOC")
-
-        for dev in devs:
-            sn = usb.util.get_string(dev, 32, dev.iSerialNumber)
-            cfg = dev.get_active_configuration()
-
-            for interf in dev.get_active_configuration():
-                if dev.is_kernel_driver_active(interf.bInterfaceNumber):
-                    # Detach kernel drivers and claim through libusb
-                    dev.detach_kernel_driver(interf.bInterfaceNumber)
-                    usb.util.claim_interface(dev, interf.bInterfaceNumber)
-
-            # 2nd interface is the one we need
-            self.endpoints[sn] = usb.util.find_descriptor(interf,
-                                 bEndpointAddress=usb.ENDPOINT_IN|2)
-
-            self.devices[sn] = dev
+        if self.transport is not None:
+            sn, endpoint = self.transport.open(self.serialNumber)
+            self.endpoints[sn] = endpoint
             self.serialNumber = sn
+            return
 
-            # FIXME: Default to the first device for now
-            break
+        found = openDongle(self.serialNumber)
+        if found is None:
+            raise EmotivEPOCNotFoundException("No plugged Emotiv EPOC")
+        sn, endpoint = found
+        self.endpoints[sn] = endpoint
+        self.devices[sn] = endpoint.device
+        self.serialNumber = sn
 
     def setupEncryption(self, research=True):
         """Generate the encryption key and setup Crypto module.
         The key is based on the serial number of the device and the
         information whether it is a research or consumer device.
         """
-        if research:
-            self.key = ''.join([self.serialNumber[15], '\x00',
-                                self.serialNumber[14], '\x54',
-                                self.serialNumber[13], '\x10',
-                                self.serialNumber[12], '\x42',
-                                self.serialNumber[15], '\x00',
-                                self.serialNumber[14], '\x48',
-                                self.serialNumber[13], '\x00',
-                                self.serialNumber[12], '\x50'])
-        else:
-            self.key = ''.join([self.serialNumber[15], '\x00',
-                                self.serialNumber[14], '\x48',
-                                self.serialNumber[13], '\x00',
-                                self.serialNumber[12], '\x54',
-                                self.serialNumber[15], '\x10',
-                                self.serialNumber[14], '\x42',
-                                self.serialNumber[13], '\x00',
-                                self.serialNumber[12], '\x50'])
-
-        self.cipher = AES.new(self.key)
+        self.key = dongleKey(self.serialNumber, research)
+        self.cipher = newCipher(self.serialNumber, research)
 
 
     def acquireData(self, dump=False):
+        import usb
         try:
             raw = self.endpoints[self.serialNumber].read(32, timeout=0)
-            bits = BitArray(bytes=self.cipher.decrypt(raw))
-            #print("aaaa"+bits[0])
+            sample = self.decoder.decode(self.cipher.decrypt(raw), [hostClock()])
 
         except usb.USBError as e:
             if e.errno == 110:
@@ -201,35 +111,21 @@ class EmotivEPOC(object):
 
         else:
             # Counter / Battery
-            if bits[0]:
-                self.battery = self.battery_levels[bits[0:8].uint]
-            else:
-                self.counter = bits[0:8].uint
+            self.battery = self.decoder.battery
+            if len(sample.counter):
+                self.counter = int(sample.counter[0])
                 ## Connection quality available with counters
                 try:
-                    self.quality[self.cqOrder[self.counter]] = bits[107:121].uint
+                    self.quality[self.cqOrder[self.counter]] = int(sample.quality[0])
                     #print(self.quality[self.cqOrder[self.counter]])
                 except KeyError:
                     pass
 
-                self.sample_buffer[0][CH_F3] = bits[8:22].uint
-                self.sample_buffer[0][CH_FC5] = bits[22:36].uint
-                self.sample_buffer[0][CH_AF3] = bits[36:50].uint
-                self.sample_buffer[0][CH_F7] = bits[50:64].uint
-                self.sample_buffer[0][CH_T7] = bits[64:78].uint
-                self.sample_buffer[0][CH_P7] = bits[78:92].uint
-                self.sample_buffer[0][CH_O1] = bits[92:106].uint
-                self.sample_buffer[0][CH_O2] = bits[134:148].uint
-                self.sample_buffer[0][CH_P8] = bits[148:162].uint
-                self.sample_buffer[0][CH_T8] = bits[162:176].uint
-                self.sample_buffer[0][CH_F8] = bits[176:190].uint
-                self.sample_buffer[0][CH_AF4] = bits[190:204].uint
-                self.sample_buffer[0][CH_FC6] = bits[204:218].uint
-                self.sample_buffer[0][CH_F4] = bits[218:232].uint
+                self.sample_buffer[0] = sample.signal[0]
 
                 ## Gyroscope
-                self.gyroX = bits[233:240].uint - 106
-                self.gyroY = bits[240:248].uint - 106
+                self.gyroX = int(sample.gyro[0, 0])
+                self.gyroY = int(sample.gyro[0, 1])
 
                 return self.sample_buffer[0]
 
@@ -262,11 +158,18 @@ class EmotivEPOC(object):
         """Returns the battery level."""
         return self.battery
 
+    @property
+    def packetLoss(self):
+        """Packets lost since the acquisition started."""
+        return self.decoder.loss.lost
+
+    def getLossRate(self, window=CYCLE):
+        """Returns the fraction of the last `window` packets (one second by
+        default) which were lost."""
+        return self.decoder.loss.rate(window)
+
     def disconnect(self):
         """Release the claimed interfaces."""
 
-        for dev in self.devices.values():
-            cfg = dev.get_active_configuration()
-
-            for interf in dev.get_active_configuration():
-                usb.util.release_interface(dev, interf.bInterfaceNumber)
+        for sn in list(self.devices):
+            releaseDongle(sn)
@@ -23,16 +23,15 @@ import os
 import sys
 import time
 
-import usb.core
-import usb.util
-
 import numpy as np
 import time
 
-from bitstring import BitArray
-from multiprocessing import Queue, Process
-from Crypto.Cipher import AES
-from Queue import Empty
+# USB and AES are only imported once a headset is used, see epoc_usb
+from epoc_decoder import (CYCLE, DeviceTables, EmotivPacketDecoder, PacketBatcher, PacketLoss,
+                          signalDtype)
+from epoc_usb import (INTERFACE_DESC, MANUFACTURER_DESC, dongleKey, newCipher, openDongle,
+                      releaseDongle)
+from epoc_buffer import BLOCK_WRITER, DROP_NEWEST, DROP_OLDEST, RingReader, SampleRingBuffer
 
 # Enumerations for EEG channels (14 channels)
 CH_F3, CH_FC5, CH_AF3, CH_F7, CH_T7,  CH_P7, CH_O1,\
@@ -41,228 +40,173 @@ CH_O2, CH_P8,  CH_T8,  CH_F8, CH_AF4, CH_FC6,CH_F4 = range(14)
 class EmotivEPOCNotFoundException(Exception):
     pass
 
-class EmotivEPOC(object):
-    def __init__(self, serialNumber=None):
-        # These seem to be the same for every device
-        self.INTERFACE_DESC = "Emotiv RAW DATA"
-        self.MANUFACTURER_DESC = "Emotiv Systems Pty Ltd"
-
-        # Define a contact quality ordering
-        # See:
-        #   github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
-        # For counter values between 0-15
-        self.cqOrder = ["F3", "FC5", "AF3", "F7", "T7",  "P7",  "O1",
-                        "O2", "P8",  "T8",  "F8", "AF4", "FC6", "F4",
-                        "F8", "AF4"]
-        # 16-63 is currently unknown
-        self.cqOrder.extend([None,] * 48)
-        # Now the first 16 values repeat once more and ends with 'FC6'
-        self.cqOrder.extend(self.cqOrder[:16])
-        self.cqOrder.append("FC6")
-        # Finally pattern 77-80 repeats until 127
-        self.cqOrder.extend(self.cqOrder[-4:] * 12)
-
-        # Channel names
-        self.channelNames = ["F3", "FC5", "AF3", "F7", "T7", "P7", "O1",
-                             "O2", "P8",  "T8",  "F8", "AF4","FC6","F4"]
-
-        ##################
-        # ADC parameters #
-        # ################
-
-        # Sampling rate: 128Hz (Internal: 2048Hz)
-        self.sampling_rate = 128
-
-        # Vertical resolution (0.51 microVolt)
-        self.resolution = 0.51
-
-        # Each channel has 14 bits of data
-        self.ch_bits = 14
-
-        self.sample_buffer=np.ndarray([1,14])
-
-        # Battery levels
-        # github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
-        self.battery_levels = {247:99, 246:97, 245:93, 244:89, 243:85,
-                               242:82, 241:77, 240:72, 239:66, 238:62,
-                               237:55, 236:46, 235:32, 234:20, 233:12,
-                               232: 6, 231: 4, 230: 3, 229: 2, 228: 1,
-                               227: 1, 226: 1,
-                               }
-        # 100% for bit values between 248-255
-        self.battery_levels.update(dict([(k,100) for k in range(248, 256)]))
-        # 0% for bit values between 128-225
-        self.battery_levels.update(dict([(k,0)   for k in range(128, 226)]))
+class EmotivEPOC(DeviceTables):
+    # These seem to be the same for every device
+    INTERFACE_DESC = INTERFACE_DESC
+    MANUFACTURER_DESC = MANUFACTURER_DESC
+
+    def __init__(self, serialNumber=None, batchSize=1, maxLatency=None, bufferSize=4096,
+                 transport=None, fillGaps=False, signalFilter=None, signalFormat="float",
+                 overflow=DROP_OLDEST, backlogLimit=None):
+        self.sample_buffer=np.zeros((1, 14), dtype=signalDtype(signalFormat))
 
         # One can want to specify the dongle with its serial
         self.serialNumber = serialNumber
 
+        # Replaces the USB scan, e.g. epoc_sim.SimulatedTransport()
+        self.transport = transport
+
         # Serial number indexed device map
         self.devices = {}
         self.endpoints = {}
-        self.signal_q = Queue()
-        self.gyro_q= Queue()
+        # Samples are written in place by the acquisition process into shared
+        # memory and read here through our own cursor, without any pickling
+        self.ring = SampleRingBuffer(bufferSize, shared=True,
+                                     signalDtype=signalDtype(signalFormat))
+        # overflow / backlogLimit: what we lose when we fall behind, see epoc_buffer;
+        # with BLOCK_WRITER the acquisition process waits for us instead, with
+        # DROP_NEWEST it drops the new samples: both need us to keep reading,
+        # or to call closeReaders()
+        self.cursor = self.ring.openCursor(overflow, backlogLimit)
+        # The gyroscope is read as a stream of its own
+        if overflow in (BLOCK_WRITER, DROP_NEWEST):
+            self.gyroCursor = self.ring.openCursor()
+        else:
+            self.gyroCursor = self.ring.openCursor(overflow, backlogLimit)
+        # Raw reads are decrypted batchSize at a time (or after maxLatency seconds)
+        self.batcher = PacketBatcher(batchSize, maxLatency)
+        # Packet loss is counted by the acquisition process, in shared memory too.
+        # fillGaps inserts a NaN sample for every lost packet.
+        self.loss = PacketLoss(shared=True)
+        # signalFormat is one of epoc_decoder.SIGNAL_FORMATS
+        self.decoder = EmotivPacketDecoder(loss=self.loss, fillGaps=fillGaps,
+                                           signalFormat=signalFormat)
+        # Optional epoc_filter.SosFilter, run by the acquisition process
+        self.signalFilter = signalFilter
         self.record=True
         # Acquired data
-        self.packetLoss = 0
         self.counter = 0
-        self.battery = 0
         self.gyroX   = 0
         self.gyroY   = 0
-        self.quality = {
-                            "F3" : 0, "FC5" : 0, "AF3" : 0, "F7" : 0,
-                            "T7" : 0, "P7"  : 0, "O1"  : 0, "O2" : 0,
-                            "P8" : 0, "T8"  : 0, "F8"  : 0, "AF4": 0,
-                            "FC6": 0, "F4"  : 0,
-                       }
-
-    def _is_emotiv_epoc(self, device):
-        """Custom match function for libusb."""
-        try:
-            manu = usb.util.get_string(device, len(self.MANUFACTURER_DESC),
-                                       device.iManufacturer)
-        except usb.core.USBError, ue:
-            # Skip failing devices as it happens on Raspberry Pi
-            if ue.errno == 32:
-                return False
-            elif ue.errno == 13:
-                self.permissionProblem = True
-                pass
-        else:
-            if manu == self.MANUFACTURER_DESC:
-                # Found a dongle, check for interface class 3
-                for interf in device.get_active_configuration():
-                    ifStr = usb.util.get_string(device, len(self.INTERFACE_DESC),
-                                                interf.iInterface)
-                    if ifStr == self.INTERFACE_DESC:
-                        return True
+        # Battery level and contact quality are published by the acquisition
+        # process in the buffer header, see the battery and quality properties
 
     def enumerate(self):
-        devs = usb.core.find(find_all=True, custom_match=self._is_emotiv_epoc)
-
-        if not devs:
-            raise EmotivEPOCNotFoundException("No plugged Emotiv EPOC")
-
-        for dev in devs:
-            sn = usb.util.get_string(dev, 32, dev.iSerialNumber)
-            cfg = dev.get_active_configuration()
-
-            for interf in dev.get_active_configuration():
-                if dev.is_kernel_driver_active(interf.bInterfaceNumber):
-                    # Detach kernel drivers and claim through libusb
-                    dev.detach_kernel_driver(interf.bInterfaceNumber)
-                    usb.util.claim_interface(dev, interf.bInterfaceNumber)
-
-            # 2nd interface is the one we need
-            self.endpoints[sn] = usb.util.find_descriptor(interf,
-                                 bEndpointAddress=usb.ENDPOINT_IN|2)
-
-            self.devices[sn] = dev
+        if self.transport is not None:
+            sn, endpoint = self.transport.open(self.serialNumber)
+            self.endpoints[sn] = endpoint
             self.serialNumber = sn
+            return
 
-            # FIXME: Default to the first device for now
-            break
+        found = openDongle(self.serialNumber)
+        if found is None:
+            raise EmotivEPOCNotFoundException("No plugged Emotiv EPOC")
+        sn, endpoint = found
+        self.endpoints[sn] = endpoint
+        self.devices[sn] = endpoint.device
+        self.serialNumber = sn
 
     def setupEncryption(self, research=True):
         """Generate the encryption key and setup Crypto module.
         The key is based on the serial number of the device and the
         information whether it is a research or consumer device.
         """
-        if research:
-            self.key = ''.join([self.serialNumber[15], '\x00',
-                                self.serialNumber[14], '\x54',
-                                self.serialNumber[13], '\x10',
-                                self.serialNumber[12], '\x42',
-                                self.serialNumber[15], '\x00',
-                                self.serialNumber[14], '\x48',
-                                self.serialNumber[13], '\x00',
-                                self.serialNumber[12], '\x50'])
-        else:
-            self.key = ''.join([self.serialNumber[15], '\x00',
-                                self.serialNumber[14], '\x48',
-                                self.serialNumber[13], '\x00',
-                                self.serialNumber[12], '\x54',
-                                self.serialNumber[15], '\x10',
-                                self.serialNumber[14], '\x42',
-                                self.serialNumber[13], '\x00',
-                                self.serialNumber[12], '\x50'])
-
-        self.cipher = AES.new(self.key)
+        self.key = dongleKey(self.serialNumber, research)
+        self.cipher = newCipher(self.serialNumber, research)
 
     def startAcuisition(self):
+            from multiprocessing import Process
             Process(target=self.acquireSample).start()
 
     def acquireSample(self):
+        import usb
         while self.record==True:
             try:
                 raw = self.endpoints[self.serialNumber].read(32,timeout=10)
-                bits = BitArray(bytes=self.cipher.decrypt(raw))
 
             except usb.USBError as e:
                 if e.errno == 110:
                     print("Make sure that headset is turned on.")
+                    # maxLatency holds while no packet comes in
+                    if self.batcher.expired():
+                        self.publishBatch()
                 else:
                     print(e)
 
             else:
-                # Counter / Battery
-                if bits[0]:
-                    self.battery = self.battery_levels[bits[0:8].uint]
-                else:
-                    self.counter = bits[0:8].uint
-                    ## Connection quality available with counters
-                    try:
-                        self.quality[self.cqOrder[self.counter]] = bits[107:121].uint
-                        #print(self.quality[self.cqOrder[self.counter]])
-                    except KeyError:
-                        pass
-
-                    self.sample_buffer[0][CH_F3] = bits[8:22].uint
-                    self.sample_buffer[0][CH_FC5] = bits[22:36].uint
-                    self.sample_buffer[0][CH_AF3] = bits[36:50].uint
-                    self.sample_buffer[0][CH_F7] = bits[50:64].uint
-                    self.sample_buffer[0][CH_T7] = bits[64:78].uint
-                    self.sample_buffer[0][CH_P7] = bits[78:92].uint
-                    self.sample_buffer[0][CH_O1] = bits[92:106].uint
-                    self.sample_buffer[0][CH_O2] = bits[134:148].uint
-                    self.sample_buffer[0][CH_P8] = bits[148:162].uint
-                    self.sample_buffer[0][CH_T8] = bits[162:176].uint
-                    self.sample_buffer[0][CH_F8] = bits[176:190].uint
-                    self.sample_buffer[0][CH_AF4] = bits[190:204].uint
-                    self.sample_buffer[0][CH_FC6] = bits[204:218].uint
-                    self.sample_buffer[0][CH_F4] = bits[218:232].uint
-
-                    ## Gyroscope
-                    self.gyroX = bits[233:240].uint - 106
-                    self.gyroY = bits[240:248].uint - 106
-                    self.signal_q.put(self.sample_buffer[0])
-                    self.gyro_q.put((self.gyroX,self.gyroY))
+                if self.batcher.add(raw):
+                    self.publishBatch()
+
+    def publishBatch(self):
+        """Decrypt, decode and write the pending raw reads to the buffer."""
+        plain, readTimes = self.batcher.decrypt(self.cipher)
+        block = self.decoder.decode(plain, readTimes)
+        self.ring.publishStatus(self.decoder.battery, self.decoder.quality)
+        if self.signalFilter is not None:
+            block = block._replace(signal=self.signalFilter(block.signal))
+        self.ring.write(block)
 
     def getSignalFromQueue(self):
-        try:
-            sig = self.signal_q.get(block=False)
-            return sig
-        except Empty:
-            return None
+        """Read the next signal sample written by the acquisition process."""
+        signal, = self.ring.readFields(self.cursor, ("signal",), 1)
+        if len(signal):
+            return signal[0]
+        return None
 
     def getGyroFromQueue(self):
-        try:
-            sig = self.gyro_q.get(block=False)
-            return sig
-        except Empty:
-            return None
+        """Read the next gyroscope sample, independently of the signal."""
+        gyro, = self.ring.readFields(self.gyroCursor, ("gyro",), 1)
+        if len(gyro):
+            return tuple(gyro[0].tolist())
+        return None
+
+    def getSignals(self, max_n=None):
+        """Return every pending sample (at most max_n) in one call as
+        (signals (n,14), counters (n,), timestamps (n,)) arrays, n may be 0."""
+        return tuple(self.ring.readFields(self.cursor, ("signal", "counter", "timestamp"),
+                                          max_n))
+
+    def getGyros(self, max_n=None):
+        """Like getSignals(), with the (n,2) gyroscope values, read through
+        the gyroscope's own cursor."""
+        return tuple(self.ring.readFields(self.gyroCursor, ("gyro", "counter", "timestamp"),
+                                          max_n))
+
+    def wait_for_samples(self, n=1, timeout=None):
+        """Sleep until the acquisition process has written n samples we have
+        not read. Returns False if timeout seconds passed first."""
+        return self.ring.wait(self.cursor, n, timeout)
 
     def getSignal(self):
         signal = self.getSignalFromQueue()
         return signal
 
     def getGyroX(self):
-        if not self.getSignalFromQueue() == None:
-            return self.getGyroFromQueue()[0]
+        gyro = self.getGyroFromQueue()
+        if gyro is not None:
+            self.gyroX, self.gyroY = gyro
+            return self.gyroX
 
     def getGyroY(self):
-        if not self.getSignalFromQueue() == None:
-            return self.getGyroFromQueue()[1]
+        gyro = self.getGyroFromQueue()
+        if gyro is not None:
+            self.gyroX, self.gyroY = gyro
+            return self.gyroY
+
+    @property
+    def battery(self):
+        """Latest battery level published by the acquisition process."""
+        return self.ring.status().battery
+
+    @property
+    def quality(self):
+        """Latest contact quality of every electrode."""
+        return dict(zip(self.channelNames, self.ring.status().quality.tolist()))
+
+    def getStatus(self):
+        """Latest epoc_buffer.DeviceStatus, with sequence numbers telling
+        whether battery or quality changed since the previous call."""
+        return self.ring.status()
 
     def getContactQuality(self, electrode):
         "Return contact quality for the specified electrode."""
@@ -275,11 +219,35 @@ class EmotivEPOC(object):
         """Returns the battery level."""
         return self.battery
 
+    def getBufferStats(self):
+        """Samples we lost to the overflow policy, largest backlog seen and
+        writes of the acquisition process which waited for us."""
+        return self.ring.cursorStats(self.cursor)
+
+    def openReader(self, overflow=DROP_OLDEST, backlogLimit=None):
+        """Another consumer of every sample from now on, independent from
+        getSignals() and from other readers (see epoc_buffer.RingReader)."""
+        return RingReader(self.ring, overflow, backlogLimit)
+
+    @property
+    def packetLoss(self):
+        """Packets lost since the acquisition started."""
+        return self.loss.lost
+
+    def getLossRate(self, window=CYCLE):
+        """Returns the fraction of the last `window` packets (one second by
+        default) which were lost."""
+        return self.loss.rate(window)
+
+    def closeReaders(self):
+        """Stop our cursors from holding the acquisition process back; the
+        getters keep working, losing the oldest samples when we fall behind."""
+        self.ring.closeCursor(self.cursor)
+        self.ring.closeCursor(self.gyroCursor)
+
     def disconnect(self):
         """Release the claimed interfaces."""
+        self.closeReaders()
 
-        for dev in self.devices.values():
-            cfg = dev.get_active_configuration()
-
-            for interf in dev.get_active_configuration():
-                usb.util.release_interface(dev, interf.bInterfaceNumber)
+        for sn in list(self.devices):
+            releaseDongle(sn)
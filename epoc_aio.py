@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""asyncio bridge for EmotivDevice (Python 3.5+ only).
+
+SampleStream subscribes to the acquisition thread, which hands every batch
+to the event loop with call_soon_threadsafe(), so the consumer coroutine
+sleeps until data is there instead of polling getSignal() from an executor.
+
+At most `maxPending` batches are buffered for a slow consumer; when that
+bound is hit the oldest batch is dropped and counted in `dropped`.
+
+The stream is closed when the consumer leaves the `async with` block, calls
+aclose(), or is cancelled while waiting for a batch. Closing unsubscribes
+and, unless stopAcquisition is False, stops the acquisition thread, which
+the next stream of the device starts again. Joining
+that thread may take a while (a read-ahead poll, a writer blocked on a slow
+reader), so the asynchronous paths do it in the loop's default executor.
+"""
+
+import asyncio
+import collections
+
+class SampleStream(object):
+    """Asynchronous iterator over the SampleBlocks of an EmotivDevice."""
+
+    def __init__(self, device, batchSize=1, maxPending=256, stopAcquisition=True):
+        if maxPending < 1:
+            raise ValueError("maxPending must be at least 1")
+        self.device = device
+        self.batchSize = batchSize
+        self.maxPending = maxPending
+        self.stopAcquisition = stopAcquisition
+        # Samples in batches dropped because the consumer fell behind
+        self.dropped = 0
+        self._blocks = collections.deque()
+        self._loop = None
+        self._ready = None
+        self._subscription = None
+        self._closed = False
+
+    def _open(self):
+        self._loop = asyncio.get_event_loop()
+        self._ready = asyncio.Event()
+        self._subscription = self.device.subscribe(self._fromThread, self.batchSize)
+        if not self.device._ac_thread.is_alive():
+            self.device.startAcuisition()
+
+    def _fromThread(self, block):
+        # Called in the acquisition thread
+        self._loop.call_soon_threadsafe(self._push, block)
+
+    def _push(self, block):
+        if self._closed:
+            return
+        if len(self._blocks) >= self.maxPending:
+            self.dropped += len(self._blocks.popleft().counter)
+        self._blocks.append(block)
+        self._ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        if self._subscription is None:
+            self._open()
+        try:
+            while not self._blocks:
+                self._ready.clear()
+                await self._ready.wait()
+        except asyncio.CancelledError:
+            # Stop in the background rather than block the loop
+            if self._detach():
+                self._loop.run_in_executor(None, self.device.stopAcquisition)
+            raise
+        return self._blocks.popleft()
+
+    def _detach(self):
+        """Unsubscribe, returning True when the acquisition should be stopped."""
+        if self._closed:
+            return False
+        self._closed = True
+        self._blocks.clear()
+        if self._subscription is None:
+            return False
+        self.device.unsubscribe(self._subscription)
+        return self.stopAcquisition
+
+    def close(self):
+        """Unsubscribe and stop acquisition if asked to. Idempotent; blocks
+        until the acquisition thread exits, use aclose() from a coroutine."""
+        if self._detach():
+            self.device.stopAcquisition()
+
+    async def aclose(self):
+        if self._detach():
+            await self._loop.run_in_executor(None, self.device.stopAcquisition)
+
+    async def __aenter__(self):
+        if self._subscription is None:
+            self._open()
+        return self
+
+    async def __aexit__(self, excType, exc, tb):
+        await self.aclose()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Sliding window band power, e.g. for neurofeedback.
+
+BandPower keeps the last `window` samples of the 14 channels and, every
+`hop` samples, computes the power of each channel in every frequency band.
+Fed from a device subscription it publishes a (bands, 14) array several
+times per second instead of each consumer copying a window and running its
+own FFT.
+
+All the work of a hop is a handful of array operations on buffers
+allocated once:
+
+- the history is written twice, `window` samples apart, so the current
+  window is always a contiguous view of it and is never copied;
+- the window is split into `segments` half overlapping Hann tapered
+  segments (Welch's method, 1 is a single periodogram), with their mean
+  removed unless detrend is False (the raw signal sits on a ~8000 DC
+  offset), transformed at once for every segment and channel with one
+  rfft call;
+- the averaged power spectral density is turned into band powers with a
+  single matrix product.
+
+NumPy only takes an output array in rfft from version 2.0 on; with an
+older NumPy the spectrum is the one temporary allocated per hop.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from epoc_decoder import CHANNEL_NAMES
+
+BANDS = OrderedDict([("delta", (1.0, 4.0)),
+                     ("theta", (4.0, 8.0)),
+                     ("alpha", (8.0, 13.0)),
+                     ("beta", (13.0, 30.0)),
+                     ("gamma", (30.0, 45.0))])
+
+def _rfftTakesOut():
+    try:
+        np.fft.rfft(np.zeros(4), out=np.empty(3, dtype=complex))
+    except TypeError:
+        return False
+    return True
+
+_RFFT_OUT = _rfftTakesOut()
+
+class BandPower(object):
+    """Band power of the last `window` samples, every `hop` samples.
+
+    callback(timestamp, power) is called with the timestamp of the newest
+    sample of the window and a (bands, channels) array of power in signal
+    units squared. The array is reused for the next hop; copy it to keep it.
+    `psd` and `freqs` hold the averaged spectral density of the last hop.
+    """
+
+    def __init__(self, rate=128.0, window=256, hop=32, bands=BANDS, segments=1,
+                 detrend=True, channels=len(CHANNEL_NAMES), callback=None):
+        if not 1 <= hop <= window:
+            raise ValueError("hop must be between 1 and window")
+        if segments < 1:
+            raise ValueError("segments must be at least 1")
+        self.rate = rate
+        self.window = window
+        self.hop = hop
+        self.bandNames = list(bands)
+        self.callback = callback
+        self.detrend = detrend
+
+        segment = window if segments == 1 else 2 * window // (segments + 1)
+        step = (window - segment) // (segments - 1) if segments > 1 else 0
+        self._starts = [k * step for k in range(segments)]
+        self._segment = segment
+        self._taper = np.hanning(segment)[:, None]
+        self.freqs = np.fft.rfftfreq(segment, 1.0 / rate)
+
+        # One sided density scaling of |X|^2 averaged over segments
+        scale = np.full(len(self.freqs), 2.0 / (rate * np.sum(self._taper ** 2)))
+        scale[0] /= 2
+        if segment % 2 == 0:
+            scale[-1] /= 2
+        self._scale = (scale / segments)[:, None]
+        # Band power as a sum of psd * bin width
+        df = rate / float(segment)
+        self._bandMatrix = np.array([((self.freqs >= lo) & (self.freqs < hi)) * df
+                                     for lo, hi in bands.values()])
+
+        self._history = np.zeros((2 * window, channels))
+        self._frames = np.empty((segments, segment, channels))
+        self._means = np.empty((segments, 1, channels))
+        self._spectrum = np.empty((segments, len(self.freqs), channels), dtype=complex)
+        self._magnitude = np.empty((segments, len(self.freqs), channels))
+        self.psd = np.zeros((len(self.freqs), channels))
+        self.power = np.zeros((len(self.bandNames), channels))
+        self.count = 0
+        self._next = window
+
+    def _append(self, chunk):
+        """Write up to `window` samples in the history, twice."""
+        w = self.window
+        start = self.count % w
+        first = min(len(chunk), w - start)
+        h = self._history
+        h[start:start + first] = chunk[:first]
+        h[w + start:w + start + first] = chunk[:first]
+        rest = len(chunk) - first
+        if rest:
+            h[:rest] = chunk[first:]
+            h[w:w + rest] = chunk[first:]
+        self.count += len(chunk)
+
+    def _compute(self):
+        oldest = self.count % self.window
+        current = self._history[oldest:oldest + self.window]
+        for frame, start in zip(self._frames, self._starts):
+            frame[...] = current[start:start + self._segment]
+        if self.detrend:
+            np.mean(self._frames, axis=1, keepdims=True, out=self._means)
+            np.subtract(self._frames, self._means, out=self._frames)
+        np.multiply(self._frames, self._taper, out=self._frames)
+        if _RFFT_OUT:
+            np.fft.rfft(self._frames, axis=1, out=self._spectrum)
+            spectrum = self._spectrum
+        else:
+            spectrum = np.fft.rfft(self._frames, axis=1)
+        np.abs(spectrum, out=self._magnitude)
+        np.square(self._magnitude, out=self._magnitude)
+        np.sum(self._magnitude, axis=0, out=self.psd)
+        np.multiply(self.psd, self._scale, out=self.psd)
+        np.dot(self._bandMatrix, self.psd, out=self.power)
+        return self.power
+
+    def process(self, signal, timestamps=None):
+        """Feed (n, channels) samples; the callback is called for every hop
+        completed by them."""
+        done = 0
+        n = len(signal)
+        while done < n:
+            take = min(n - done, self._next - self.count, self.window)
+            self._append(signal[done:done + take])
+            done += take
+            if self.count == self._next:
+                self._next += self.hop
+                power = self._compute()
+                if self.callback is not None:
+                    t = timestamps[done - 1] if timestamps is not None else None
+                    self.callback(t, power)
+
+    def __call__(self, block):
+        """Feed a SampleBlock, so that a BandPower can be a subscriber."""
+        self.process(block.signal, block.timestamp)
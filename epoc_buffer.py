@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Fixed capacity sample buffers filled by the acquisition thread.
+
+SampleRingBuffer preallocates one column per SampleBlock field, so storing
+a sample is an array write: no dict, lock or object is created per sample
+and memory stays flat however long the session is.
+
+There is a single writer. Readers keep their own RingCursor and never take
+a lock: the writer publishes the range it is about to overwrite before
+touching the columns and the new head once it is done, so a reader which is
+lapped while copying simply drops the rows that were overwritten.
+
+With shared=True the header and columns live in a multiprocessing shared
+memory block, so a child process can write samples in place and the parent
+reads them without any pickling.
+
+Readers which would rather sleep than poll call wait(); the writer only
+touches the condition variable when somebody is actually waiting.
+
+Memory is bounded by the capacity whatever the readers do. What a reader
+which falls behind loses is chosen per cursor (see openCursor()):
+
+    DROP_OLDEST   (default) the oldest samples beyond `limit` pending ones
+    DROP_NEWEST   the samples arriving while `limit` are pending
+    LATEST        all but the newest `limit` samples (1 by default)
+    BLOCK_WRITER  nothing: the writer waits for the reader, for up to
+                  blockTimeout seconds, before overwriting its samples
+
+and counted on the cursor, with the largest backlog it has seen.
+
+DROP_NEWEST and BLOCK_WRITER cursors hold the writer back, and so every
+other reader, as they must not be lapped: once such a reader is a whole
+capacity behind, the writer drops the new samples (DROP_NEWEST) or waits
+(BLOCK_WRITER) until it reads. They need a reader which keeps reading, and
+must be closed with closeCursor() once nobody reads them any more.
+
+Any number of consumers (recorder, display, classifier ...) can read the
+same buffer, each through its own RingReader: every one of them gets every
+sample once, unless its own policy drops it, and none is slowed down by
+the others. Samples are stored once whatever the number of readers.
+
+A reader interested in some fields only calls readFields() with its own
+cursor, e.g. one cursor for the signal and one for the gyroscope, so that
+each stream is consumed independently of the other.
+
+The battery level and the contact quality of every electrode change far
+less often than samples arrive and are mostly wanted as their latest
+value. They are also kept as registers in the header, published by the
+writer with publishStatus() and read by status() without consuming any
+sample. Each register has a sequence number incremented whenever its value
+changes, and the writer brackets its update with a version number (odd
+while writing) so that readers in other processes never see half of one.
+"""
+
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+import numpy as np
+
+from epoc_decoder import CHANNEL_NAMES, SampleBlock, hostClock
+
+# Column layout: name, dtype, shape of one sample
+FIELDS = (("signal",    np.float64, (len(CHANNEL_NAMES),)),
+          ("gyro",      np.int16,   (2,)),
+          ("counter",   np.uint8,   ()),
+          ("timestamp", np.float64, ()),
+          ("battery",   np.int8,    ()),
+          ("quality",   np.uint16,  ()),
+          ("hostTime",  np.float64, ()))
+
+def fields(signalDtype=np.float64):
+    """FIELDS with the signal stored as `signalDtype` (see
+    epoc_decoder.SIGNAL_FORMATS)."""
+    return tuple((name, signalDtype if name == "signal" else dtype, shape)
+                 for name, dtype, shape in FIELDS)
+
+# Overflow policies of a cursor
+DROP_OLDEST = "dropOldest"
+DROP_NEWEST = "dropNewest"
+LATEST = "latest"
+BLOCK_WRITER = "blockWriter"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, LATEST, BLOCK_WRITER)
+
+# BLOCK_WRITER and DROP_NEWEST cursors a buffer can have at once, each
+MAX_BLOCKING = 4
+MAX_KEEPING = 4
+
+# Header words: ring positions, writer stalls, samples the writer dropped
+# for DROP_NEWEST cursors, the next sample every BLOCK_WRITER then every
+# DROP_NEWEST cursor needs (-1 for a free slot), then the status registers
+(_HEAD, _RESERVED, _WAITERS, _WRITER_WAITING, _STALLS, _BLOCKING, _KEEPING,
+ _REFUSED) = range(8)
+_GUARDS = 8
+_KEEPERS = _GUARDS + MAX_BLOCKING
+(_VERSION, _BATTERY, _BATTERY_SEQ, _QUALITY_SEQ,
+ _QUALITY) = range(_KEEPERS + MAX_KEEPING, _KEEPERS + MAX_KEEPING + 5)
+_HEADER_WORDS = _QUALITY + len(CHANNEL_NAMES)
+
+# Latest battery level and contact quality of every electrode (in
+# CHANNEL_NAMES order), with the number of times each has changed; a
+# sequence number of 0 means nothing was received yet
+DeviceStatus = namedtuple("DeviceStatus",
+                          "battery batterySequence quality qualitySequence")
+
+# Policies holding the writer back: first header word of their slots, word
+# counting the open ones, number of slots
+_GUARDED = {BLOCK_WRITER: (_GUARDS, _BLOCKING, MAX_BLOCKING),
+            DROP_NEWEST: (_KEEPERS, _KEEPING, MAX_KEEPING)}
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+class RingCursor(object):
+    """Read position of one consumer in a SampleRingBuffer.
+
+    position:    sequence number of the next sample to read
+    policy:      what to drop when the consumer falls behind, see POLICIES
+    limit:       most samples the consumer may have pending
+    overwritten: samples lost because the writer lapped this consumer
+    dropped:     samples skipped by the policy
+    highWater:   largest backlog seen by read()
+    """
+    __slots__ = ("position", "policy", "limit", "overwritten", "dropped", "highWater",
+                 "skipFrom", "skipTo", "guard", "refusedBase")
+
+    def __init__(self, position=0, policy=DROP_OLDEST, limit=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown overflow policy %r" % (policy,))
+        self.position = position
+        self.policy = policy
+        self.limit = limit
+        self.overwritten = 0
+        self.dropped = 0
+        self.highWater = 0
+        # DROP_NEWEST: samples skipped once the consumer reaches skipFrom
+        self.skipFrom = self.skipTo = 0
+        # BLOCK_WRITER and DROP_NEWEST: header word holding the next
+        # sample needed
+        self.guard = None
+        # SampleRingBuffer.refused when the cursor was opened
+        self.refusedBase = 0
+
+class SampleRingBuffer(object):
+    """Single writer ring buffer of samples with lock free readers.
+
+    Cursors are plain objects, so with shared=True each process reading the
+    buffer opens its own. The signal is stored as `signalDtype`, float64 by
+    default; the compact formats of the decoder take a quarter of that.
+    """
+
+    def __init__(self, capacity=4096, shared=False, signalDtype=np.float64):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.signalDtype = np.dtype(signalDtype)
+        size = self.nbytes(capacity, signalDtype)
+        if shared:
+            # Only imported by the users of shared buffers
+            import ctypes
+            import multiprocessing
+            # Zero filled and inherited by (or sent to) child processes
+            self._shared = multiprocessing.RawArray(ctypes.c_uint8, size)
+            self._buffer = np.frombuffer(self._shared, dtype=np.uint8)
+            self._cond = multiprocessing.Condition()
+        else:
+            self._shared = None
+            self._buffer = np.zeros(size, dtype=np.uint8)
+            self._cond = threading.Condition()
+        self._mapColumns()
+        self._header[_GUARDS:_KEEPERS + MAX_KEEPING] = -1
+        # Seconds the writer waits for a BLOCK_WRITER reader before
+        # overwriting its samples anyway, None to wait for as long as it takes
+        self.blockTimeout = 1.0
+
+    def __getstate__(self):
+        state = {"capacity": self.capacity, "signalDtype": self.signalDtype,
+                 "blockTimeout": self.blockTimeout}
+        if self._shared is None:
+            state["buffer"] = self._buffer
+        else:
+            # Only allowed while spawning a process, the child maps the same memory
+            state.update(shared=self._shared, cond=self._cond)
+        return state
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.signalDtype = state["signalDtype"]
+        self.blockTimeout = state["blockTimeout"]
+        self._shared = state.get("shared")
+        if self._shared is None:
+            self._buffer = state["buffer"]
+            self._cond = threading.Condition()
+        else:
+            self._buffer = np.frombuffer(self._shared, dtype=np.uint8)
+            self._cond = state["cond"]
+        self._mapColumns()
+
+    @property
+    def shared(self):
+        return self._shared is not None
+
+    @staticmethod
+    def nbytes(capacity, signalDtype=np.float64):
+        """Size of the header and columns for `capacity` samples."""
+        size = _HEADER_WORDS * 8
+        for name, dtype, shape in fields(signalDtype):
+            size = _align(size) + capacity * np.dtype(dtype).itemsize * int(np.prod(shape))
+        return size
+
+    def _mapColumns(self):
+        """Create the header and column views over self._buffer."""
+        offset = _HEADER_WORDS * 8
+        self._header = self._buffer[:offset].view(np.int64)
+        self.columns = []
+        self._columnIndex = {}
+        for name, dtype, shape in fields(self.signalDtype):
+            offset = _align(offset)
+            nbytes = self.capacity * np.dtype(dtype).itemsize * int(np.prod(shape))
+            column = self._buffer[offset:offset + nbytes].view(dtype)
+            self.columns.append(column.reshape((self.capacity,) + shape))
+            self._columnIndex[name] = self.columns[-1]
+            offset += nbytes
+
+    @property
+    def head(self):
+        """Sequence number of the next sample to be written."""
+        return int(self._header[_HEAD])
+
+    @property
+    def stalls(self):
+        """Writes which had to wait for a BLOCK_WRITER reader."""
+        return int(self._header[_STALLS])
+
+    @property
+    def refused(self):
+        """Samples dropped by the writer because a DROP_NEWEST reader was a
+        whole capacity behind; no reader gets them."""
+        return int(self._header[_REFUSED])
+
+    def write(self, block):
+        """Append the samples of a SampleBlock."""
+        n = len(block.counter)
+        if not n:
+            return
+        start = int(self._header[_HEAD])
+        if self._header[_KEEPING]:
+            # Rather than overwriting what a DROP_NEWEST reader keeps
+            room = self._keptRoom(start)
+            if room < n:
+                self._header[_REFUSED] += n - room
+                if room <= 0:
+                    return
+                block = SampleBlock(*[values[:room] for values in block])
+                n = room
+        if n > self.capacity:
+            # Only the newest samples would survive anyway
+            start += n - self.capacity
+            block = SampleBlock(*[values[n - self.capacity:] for values in block])
+            n = self.capacity
+        if self._header[_BLOCKING]:
+            self._waitForReaders(start + n)
+        # Announce the slots being overwritten before touching them
+        self._header[_RESERVED] = start + n
+        i = start % self.capacity
+        first = min(n, self.capacity - i)
+        for column, values in zip(self.columns, block):
+            column[i:i + first] = values[:first]
+            if first < n:
+                column[:n - first] = values[first:]
+        self._header[_HEAD] = start + n
+        if self._header[_WAITERS]:
+            with self._cond:
+                self._cond.notify_all()
+
+    def _readersAllow(self, end):
+        """True if writing up to sequence number `end` overwrites nothing a
+        BLOCK_WRITER cursor has not read."""
+        positions = [g for g in self._header[_GUARDS:_GUARDS + MAX_BLOCKING].tolist()
+                     if g >= 0]
+        return not positions or end - self.capacity <= min(positions)
+
+    def _keptRoom(self, start):
+        """Samples which can be written from sequence number `start` on
+        without overwriting any a DROP_NEWEST cursor keeps."""
+        needed = [k for k in self._header[_KEEPERS:_KEEPERS + MAX_KEEPING].tolist() if k >= 0]
+        if not needed:
+            return self.capacity
+        return min(needed) + self.capacity - start
+
+    def _waitForReaders(self, end):
+        """Wait until writing up to sequence number `end` overwrites nothing
+        a BLOCK_WRITER cursor has not read, or blockTimeout has passed."""
+        if self._readersAllow(end):
+            return
+        self._header[_STALLS] += 1
+        deadline = None if self.blockTimeout is None else hostClock() + self.blockTimeout
+        with self._cond:
+            # Set before checking the positions again: a reader moving its
+            # cursor after that check sees the flag and wakes us up
+            self._header[_WRITER_WAITING] = 1
+            try:
+                while not self._readersAllow(end):
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - hostClock()
+                        if remaining <= 0:
+                            return
+                        self._cond.wait(remaining)
+            finally:
+                self._header[_WRITER_WAITING] = 0
+
+    def openCursor(self, policy=DROP_OLDEST, limit=None):
+        """Return a cursor positioned at the next sample to be written.
+
+        `limit` bounds the samples pending for the cursor, the capacity by
+        default (half of it for DROP_NEWEST and 1 for LATEST). BLOCK_WRITER
+        and DROP_NEWEST cursors hold the writer back until they are closed
+        with closeCursor().
+        """
+        if limit is None:
+            limit = {DROP_NEWEST: self.capacity // 2, LATEST: 1}.get(policy, self.capacity)
+        if not 1 <= limit <= self.capacity:
+            raise ValueError("limit must be between 1 and %d" % self.capacity)
+        cursor = RingCursor(self.head, policy, limit)
+        if policy in _GUARDED:
+            first, count, slots = _GUARDED[policy]
+            with self._cond:
+                guards = self._header[first:first + slots]
+                free = np.flatnonzero(guards < 0)
+                if not len(free):
+                    raise ValueError("at most %d %s cursors" % (slots, policy))
+                cursor.guard = first + int(free[0])
+                cursor.position = self.head
+                self._header[cursor.guard] = cursor.position
+                self._header[count] += 1
+        cursor.refusedBase = self.refused
+        return cursor
+
+    def closeCursor(self, cursor):
+        """Stop the writer from holding back for a BLOCK_WRITER or
+        DROP_NEWEST cursor; it must not be read any more."""
+        if cursor.guard is not None:
+            with self._cond:
+                self._header[cursor.guard] = -1
+                self._header[_GUARDED[cursor.policy][1]] -= 1
+                cursor.guard = None
+                self._cond.notify_all()
+
+    def cursorStats(self, cursor):
+        """What `cursor` lost to its overflow policy, as a dict. `refused`
+        counts the samples the writer dropped for a DROP_NEWEST cursor,
+        this one (they are in `dropped` too) or another."""
+        refused = self.refused - cursor.refusedBase
+        return {"policy": cursor.policy,
+                "limit": cursor.limit,
+                "pending": self.pending(cursor),
+                "overwritten": cursor.overwritten,
+                "dropped": cursor.dropped + (refused if cursor.policy == DROP_NEWEST else 0),
+                "refused": refused,
+                "highWater": cursor.highWater,
+                "stalls": self.stalls if cursor.policy == BLOCK_WRITER else 0}
+
+    def pending(self, cursor):
+        """Number of samples `cursor` can still read."""
+        backlog = self.head - cursor.position
+        if cursor.skipTo > cursor.position:
+            backlog -= cursor.skipTo - cursor.skipFrom
+        return min(backlog, cursor.limit)
+
+    def wait(self, cursor, count=1, timeout=None):
+        """Block until `cursor` has at least `count` pending samples or
+        `timeout` seconds have passed. Returns True if the samples are there."""
+        if count > cursor.limit:
+            raise ValueError("cannot wait for more than %d samples" % cursor.limit)
+        if self.pending(cursor) >= count:
+            return True
+        deadline = None if timeout is None else hostClock() + timeout
+        with self._cond:
+            self._header[_WAITERS] += 1
+            try:
+                while self.pending(cursor) < count:
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - hostClock()
+                        if remaining <= 0:
+                            return False
+                        self._cond.wait(remaining)
+            finally:
+                self._header[_WAITERS] -= 1
+        return True
+
+    def read(self, cursor, maxCount=None):
+        """Copy up to `maxCount` pending samples for `cursor` into a new
+        SampleBlock and advance the cursor past them."""
+        return SampleBlock(*self.readFields(cursor, SampleBlock._fields, maxCount))
+
+    def readFields(self, cursor, names, maxCount=None, out=None):
+        """Like read(), copying only the columns of the SampleBlock fields
+        in `names`; returns a list of arrays in that order.
+
+        With `out`, arrays made by fieldBuffers(), the samples are copied
+        into them rather than into new arrays, up to their length, and
+        views of the rows written are returned."""
+        columns = [self._columnIndex[name] for name in names]
+        head = int(self._header[_HEAD])
+        start, end = self._readable(cursor, head)
+        n = end - start
+        if maxCount is not None:
+            n = min(n, maxCount)
+        if out is not None:
+            n = min(n, len(out[0]))
+
+        i = start % self.capacity
+        first = min(n, self.capacity - i)
+        values = []
+        for k, column in enumerate(columns):
+            if out is not None:
+                values.append(out[k][:n])
+                values[-1][:first] = column[i:i + first]
+                if first < n:
+                    values[-1][first:] = column[:n - first]
+            elif first < n:
+                values.append(np.concatenate((column[i:], column[:n - first])))
+            else:
+                values.append(column[i:i + n].copy())
+
+        # Drop what the writer overwrote while we were copying
+        lapped = int(self._header[_RESERVED]) - self.capacity - start
+        if lapped > 0:
+            lapped = min(lapped, n)
+            values = [v[lapped:] for v in values]
+            cursor.overwritten += lapped
+        cursor.position = start + n
+        if cursor.guard is not None:
+            # Position first, then the flag, see _waitForReaders()
+            needed = cursor.position
+            if cursor.skipFrom <= needed < cursor.skipTo:
+                needed = cursor.skipTo
+            self._header[cursor.guard] = needed
+            if self._header[_WRITER_WAITING]:
+                with self._cond:
+                    self._cond.notify_all()
+        return values
+
+    def fieldBuffers(self, names, count):
+        """Arrays of `count` rows for the fields in `names`, to read them
+        with readFields(out=...) without allocating."""
+        return [np.empty((count,) + self._columnIndex[name].shape[1:],
+                         dtype=self._columnIndex[name].dtype) for name in names]
+
+    def _readable(self, cursor, head):
+        """Range of sequence numbers `cursor` reads next, after applying
+        its overflow policy."""
+        start = cursor.position
+        if cursor.skipFrom <= start < cursor.skipTo:
+            # DROP_NEWEST: already counted as dropped
+            start = cursor.skipTo
+        backlog = head - start
+        if backlog > cursor.highWater:
+            cursor.highWater = backlog
+        if backlog > self.capacity:
+            cursor.overwritten += backlog - self.capacity
+            start = head - self.capacity
+        if cursor.policy != DROP_NEWEST:
+            if head - start > cursor.limit:
+                cursor.dropped += head - start - cursor.limit
+                start = head - cursor.limit
+            return start, head
+        if start < cursor.skipFrom:
+            # The rest of the kept samples
+            return start, cursor.skipFrom
+        if head - start > cursor.limit:
+            # Keep the oldest `limit` samples, skip the newer ones when we get there
+            cursor.skipFrom = start + cursor.limit
+            cursor.skipTo = head
+            cursor.dropped += head - cursor.skipFrom
+            return start, cursor.skipFrom
+        return start, head
+
+    def publishStatus(self, battery, quality):
+        """Writer side: update the battery level and the contact quality
+        registers (an array in CHANNEL_NAMES order); nothing is written when
+        neither changed."""
+        header = self._header
+        qualityRegister = header[_QUALITY:]
+        batteryChanged = battery != int(header[_BATTERY])
+        # Comparing lists is several times faster than NumPy for 14 values
+        qualityChanged = quality.tolist() != qualityRegister.tolist()
+        if not (batteryChanged or qualityChanged):
+            return
+        header[_VERSION] += 1
+        if batteryChanged:
+            header[_BATTERY] = battery
+            header[_BATTERY_SEQ] += 1
+        if qualityChanged:
+            qualityRegister[:] = quality
+            header[_QUALITY_SEQ] += 1
+        header[_VERSION] += 1
+
+    def status(self):
+        """Latest published DeviceStatus."""
+        header = self._header
+        while True:
+            version = header[_VERSION]
+            if not version & 1:
+                result = DeviceStatus(int(header[_BATTERY]), int(header[_BATTERY_SEQ]),
+                                      header[_QUALITY:].copy(), int(header[_QUALITY_SEQ]))
+                if header[_VERSION] == version:
+                    return result
+            # The writer is halfway through an update, let it finish
+            time.sleep(0)
+
+class RingReader(object):
+    """One consumer of a SampleRingBuffer, reading at its own pace through
+    its own cursor (see SampleRingBuffer.openCursor() for policy and limit).
+    """
+
+    def __init__(self, ring, policy=DROP_OLDEST, limit=None):
+        self.ring = ring
+        self.cursor = ring.openCursor(policy, limit)
+
+    def pending(self):
+        return self.ring.pending(self.cursor)
+
+    def wait(self, count=1, timeout=None):
+        return self.ring.wait(self.cursor, count, timeout)
+
+    def read(self, maxCount=None):
+        return self.ring.read(self.cursor, maxCount)
+
+    def readFields(self, names, maxCount=None):
+        return self.ring.readFields(self.cursor, names, maxCount)
+
+    def stats(self):
+        return self.ring.cursorStats(self.cursor)
+
+    def close(self):
+        """Needed for BLOCK_WRITER and DROP_NEWEST readers only, which hold
+        the writer back until they are closed."""
+        self.ring.closeCursor(self.cursor)
+
+class Subscription(object):
+    """A callback fed by the writer of a SampleRingBuffer.
+
+    The writer calls deliver() after every write; once `batchSize` samples
+    are pending the callback receives them as SampleBlocks of exactly
+    `batchSize` samples, in the writer's thread.
+
+    With `fields`, a list of SampleBlock field names, the callback rather
+    receives one array per field, callback(signal, timestamp) say. Only
+    those columns are copied, into arrays allocated once and reused for
+    the next batch.
+
+    cancel() waits for a delivery in progress, so that once it returns the
+    cursor and whatever the callback writes to are the caller's alone.
+    """
+    def __init__(self, ring, callback, batchSize=1, fields=None):
+        if batchSize < 1:
+            raise ValueError("batchSize must be at least 1")
+        self.ring = ring
+        self.callback = callback
+        self.batchSize = batchSize
+        self.fields = fields
+        self._out = None if fields is None else ring.fieldBuffers(fields, batchSize)
+        self.cursor = ring.openCursor()
+        self.active = True
+        # Held while delivering; reentrant so that a callback may cancel itself
+        self._lock = threading.RLock()
+
+    def deliver(self):
+        """Hand every complete batch to the callback. A callback raising an
+        exception is deactivated rather than stopping the writer."""
+        if not self.active or self.ring.pending(self.cursor) < self.batchSize:
+            return
+        with self._lock:
+            while self.active and self.ring.pending(self.cursor) >= self.batchSize:
+                if self.fields is None:
+                    values = (self.ring.read(self.cursor, self.batchSize),)
+                else:
+                    values = self.ring.readFields(self.cursor, self.fields, self.batchSize,
+                                                  self._out)
+                try:
+                    self.callback(*values)
+                except Exception:
+                    traceback.print_exc()
+                    self.active = False
+
+    def cancel(self):
+        """Stop the deliveries, waiting for the one in progress to finish."""
+        with self._lock:
+            self.active = False
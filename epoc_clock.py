@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Drift corrected sample timestamps.
+
+The host read time of a packet includes USB and scheduling latency, so
+consecutive reads are stamped with several milliseconds of jitter around
+the nominal 7.8ms period. The packet counter on the other hand is exact:
+unwrapped into a sequence number it says precisely how many sample periods
+separate two packets.
+
+SampleClock fits host time = offset + period * sequence with an
+exponentially weighted least squares over the last `memory` packets or so,
+and stamps every sample with the fitted line. The period converges to the
+headset's actual sampling clock rather than the nominal 128Hz, and the
+timestamps keep the long term alignment with the host clock while losing
+the read jitter.
+
+A late read (a stalled USB transfer, a descheduled thread) is pulled back
+to `maxResidual` from the model once it has settled, so a burst of stale
+packets cannot drag the line; only a batch which is entirely `resetAfter`
+away from the model, i.e. a discontinuity, starts a new one, as does a read
+time earlier than the previous one (a host clock stepped back, should
+epoc_decoder.hostClock not be monotonic).
+
+The sums are kept relative to the newest point so they never grow with the
+length of the session, and a batch of points is folded in with a handful of
+vectorized operations. timestamp() does the same for a single packet with
+plain float arithmetic, which is several times cheaper than the array code
+for batches of one.
+"""
+
+import numpy as np
+
+class SampleClock(object):
+    """Running linear model of host time against packet sequence number."""
+
+    def __init__(self, rate=128.0, memory=2048.0, maxDrift=0.05,
+                 maxResidual=0.02, resetAfter=1.0):
+        # Nominal packet period and how far the fit may stray from it
+        self.nominalPeriod = 1.0 / rate
+        self.maxDrift = maxDrift
+        # Forgetting factor of the weighted least squares
+        self.decay = 1.0 - 1.0 / memory
+        # Residuals (seconds) are clipped once this many points are fitted
+        self.maxResidual = maxResidual
+        self.settle = min(64.0, memory / 2)
+        # A batch further than this (seconds) from the model restarts it
+        self.resetAfter = resetAfter
+        self.reset()
+
+    def reset(self):
+        """Forget every point, e.g. after the headset was switched off."""
+        self._seq = None
+        self._time = 0.0
+        # Weighted sums of 1, x, y, x*x and x*y, as Python floats
+        self._sums = [0.0] * 5
+        self.period = self.nominalPeriod
+        self.offset = 0.0
+        self._last = -np.inf
+
+    @property
+    def rate(self):
+        """Estimated sampling rate of the headset, in Hz."""
+        return 1.0 / self.period
+
+    def _shift(self, dx, dy):
+        """Move the origin of the sums by (dx, dy)."""
+        w, sx, sy, sxx, sxy = self._sums
+        self._sums = [w,
+                      sx - dx * w,
+                      sy - dy * w,
+                      sxx - 2 * dx * sx + dx * dx * w,
+                      sxy - dx * sy - dy * sx + dx * dy * w]
+
+    def _fit(self):
+        w, sx, sy, sxx, sxy = self._sums
+        det = w * sxx - sx * sx
+        period = self.nominalPeriod
+        if det > 1e-9 * w * w:
+            period = (w * sxy - sx * sy) / det
+            limit = self.nominalPeriod * self.maxDrift
+            period = min(max(period, self.nominalPeriod - limit),
+                         self.nominalPeriod + limit)
+        self.period = period
+        self.offset = (sy - period * sx) / w
+
+    def at(self, sequence):
+        """Model time of `sequence` numbers, e.g. of packets which were lost."""
+        return self._time + self.offset + (np.asarray(sequence, dtype=float) - self._seq) * self.period
+
+    def timestamps(self, sequence, readTimes):
+        """Fold (sequence, readTimes) of consecutive packets into the model
+        and return their drift corrected timestamps."""
+        sequence = np.asarray(sequence, dtype=float)
+        readTimes = np.asarray(readTimes, dtype=float)
+        if not len(sequence):
+            return readTimes.copy()
+        if self._seq is not None:
+            predicted = self._time + self.offset + (sequence - self._seq) * self.period
+            residual = readTimes - predicted
+            if (np.all(np.abs(residual) > self.resetAfter) or
+                    readTimes[0] < self._time - self.maxResidual):
+                self.reset()
+            elif self._sums[0] >= self.settle:
+                readTimes = predicted + np.clip(residual, -self.maxResidual,
+                                                self.maxResidual)
+        if self._seq is None:
+            self._seq, self._time = sequence[0], readTimes[0]
+
+        # New origin on the newest point
+        self._shift(sequence[-1] - self._seq, readTimes[-1] - self._time)
+        self._seq, self._time = sequence[-1], readTimes[-1]
+
+        x = sequence - self._seq
+        y = readTimes - self._time
+        k = len(x)
+        weights = self.decay ** np.arange(k - 1, -1, -1, dtype=float)
+        decay = self.decay ** k
+        self._sums = [total * decay + float(new) for total, new in
+                      zip(self._sums, (weights.sum(), np.dot(weights, x), np.dot(weights, y),
+                                       np.dot(weights, x * x), np.dot(weights, x * y)))]
+        self._fit()
+
+        fitted = self._time + self.offset + x * self.period
+        # Never step back in time when the model moves between batches
+        fitted[0] = max(fitted[0], self._last)
+        np.maximum.accumulate(fitted, out=fitted)
+        self._last = fitted[-1]
+        return fitted
+
+    def timestamp(self, sequence, readTime):
+        """timestamps() of a single packet, with scalar arithmetic."""
+        sequence = float(sequence)
+        readTime = float(readTime)
+        if self._seq is not None:
+            predicted = self._time + self.offset + (sequence - self._seq) * self.period
+            residual = readTime - predicted
+            if abs(residual) > self.resetAfter or readTime < self._time - self.maxResidual:
+                self.reset()
+            elif self._sums[0] >= self.settle:
+                readTime = predicted + min(max(residual, -self.maxResidual),
+                                           self.maxResidual)
+        if self._seq is None:
+            self._seq, self._time = sequence, readTime
+
+        self._shift(sequence - self._seq, readTime - self._time)
+        self._seq, self._time = sequence, readTime
+        # The new point is the origin: it only adds its weight
+        decay = self.decay
+        w, sx, sy, sxx, sxy = self._sums
+        self._sums = [w * decay + 1.0, sx * decay, sy * decay, sxx * decay, sxy * decay]
+        self._fit()
+
+        fitted = max(self._time + self.offset, self._last)
+        self._last = fitted
+        return fitted
@@ -0,0 +1,709 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Vectorized decoder for decrypted Emotiv EPOC packets.
+
+Every USB read returns a 32 byte packet. Once decrypted the bits are laid out
+as follows (bit 0 is the most significant bit of the first byte):
+
+    0:8       counter (0-127) or battery level when bit 0 is set
+    8:106     F3, FC5, AF3, F7, T7, P7, O1 (14 bits each)
+    107:121   contact quality of the electrode given by the counter
+    134:232   O2, P8, T8, F8, AF4, FC6, F4 (14 bits each)
+    233:240   gyroscope X
+    240:248   gyroscope Y
+
+See: github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
+
+Instead of building a BitArray per packet and slicing it 17+ times, the bit
+offsets are turned into (byte index, shift) tables once and every field of
+every packet is extracted with a handful of NumPy operations.
+"""
+
+import math
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from epoc_clock import SampleClock
+
+PACKET_SIZE = 32
+
+# Channel names, in the order of the CH_* enumerations
+CHANNEL_NAMES = ("F3", "FC5", "AF3", "F7", "T7", "P7", "O1",
+                 "O2", "P8",  "T8",  "F8", "AF4", "FC6", "F4")
+
+# Sampling rate: 128Hz (Internal: 2048Hz)
+SAMPLING_RATE = 128
+
+# Each channel has 14 bits of data
+CH_BITS = 14
+
+# First bit of every channel, in channel order
+CHANNEL_BIT_OFFSETS = (8, 22, 36, 50, 64, 78, 92,
+                       134, 148, 162, 176, 190, 204, 218)
+
+QUALITY_BIT_OFFSET = 107
+
+# Gyroscope baseline
+GYRO_OFFSET = 106
+
+# Middle of the 14 bit ADC range and size of one step
+ADC_CENTER = 1 << (CH_BITS - 1)
+MICROVOLTS_PER_BIT = 0.51
+
+# Signal formats: dtype, offset and scale, value = (raw - offset) * scale.
+# "float" keeps raw values in float64 (112 bytes a sample), the others take
+# 28 bytes a sample.
+SIGNAL_FORMATS = {
+    "float":      (np.float64, 0, None),
+    "raw":        (np.uint16, 0, None),
+    "centered":   (np.int16, ADC_CENTER, None),
+    "microvolts": (np.float32, ADC_CENTER, MICROVOLTS_PER_BIT),
+}
+
+def signalDtype(signalFormat):
+    """NumPy dtype of a signal format."""
+    try:
+        return np.dtype(SIGNAL_FORMATS[signalFormat][0])
+    except KeyError:
+        raise ValueError("unknown signal format %r, use one of %s"
+                         % (signalFormat, ", ".join(sorted(SIGNAL_FORMATS))))
+
+def convertSignal(raw, signalFormat):
+    """Convert raw 14 bit values to `signalFormat`."""
+    dtype = signalDtype(signalFormat)
+    offset, scale = SIGNAL_FORMATS[signalFormat][1:]
+    signal = raw.astype(dtype)
+    if offset:
+        signal -= offset
+    if scale is not None:
+        signal *= scale
+    return signal
+
+def _monotonicClock():
+    """A clock which NTP or the user cannot step: time.monotonic, or on
+    Python 2 the monotonic backport when installed, clock_gettime() through
+    ctypes on Linux, time.clock on Windows. time.time as a last resort."""
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        from monotonic import monotonic
+        return monotonic
+    except (ImportError, RuntimeError):
+        pass
+    if sys.platform.startswith("linux"):
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"))
+            clock_gettime = lib.clock_gettime
+        except (OSError, AttributeError):
+            return time.time
+        # No argtypes: checking them would double the cost of a call
+        now = timespec()
+        nowRef = ctypes.byref(now)
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, nowRef)
+            return now.tv_sec + now.tv_nsec * 1e-9
+        return monotonic
+    if sys.platform == "win32":
+        return time.clock
+    return time.time
+
+# Host clock used to timestamp USB reads
+hostClock = _monotonicClock()
+
+def _buildQualityOrder():
+    """Channel index whose contact quality is sent with each counter value,
+    -1 where it is unknown."""
+    # For counter values between 0-15
+    order = ["F3", "FC5", "AF3", "F7", "T7",  "P7",  "O1",
+             "O2", "P8",  "T8",  "F8", "AF4", "FC6", "F4",
+             "F8", "AF4"]
+    # 16-63 is currently unknown
+    order.extend([None,] * 48)
+    # Now the first 16 values repeat once more and ends with 'FC6'
+    order.extend(order[:16])
+    order.append("FC6")
+    # Finally pattern 77-80 repeats until 127
+    order.extend(order[-4:] * 12)
+    return np.array([CHANNEL_NAMES.index(name) if name else -1
+                     for name in order[:128]], dtype=np.int8)
+
+def _buildBatteryLevels():
+    """Battery percentage for every value of the first byte, -1 for the
+    counter values (0-127)."""
+    levels = np.full(256, -1, dtype=np.int8)
+    # 0% for bit values between 128-225
+    levels[128:226] = 0
+    levels[226:248] = [1, 1, 1, 2, 3, 4, 6, 12, 20, 32, 46,
+                       55, 62, 66, 72, 77, 82, 85, 89, 93, 97, 99]
+    # 100% for bit values between 248-255
+    levels[248:256] = 100
+    return levels
+
+QUALITY_CHANNELS = _buildQualityOrder()
+# The same as electrode names, None where unknown
+QUALITY_ORDER = tuple(CHANNEL_NAMES[i] if i >= 0 else None for i in QUALITY_CHANNELS)
+BATTERY_LEVELS = _buildBatteryLevels()
+
+class DeviceTables(object):
+    """Mixin giving the device classes the tables above as class attributes."""
+    __slots__ = ()
+
+    # Lookup tables shared by every instance, built once:
+    # electrode whose contact quality comes with each counter value (None
+    # where unknown) and battery percentage of every value of the first byte
+    # (-1 for counter values)
+    cqOrder = QUALITY_ORDER
+    battery_levels = BATTERY_LEVELS
+    channelNames = CHANNEL_NAMES
+
+    # ADC parameters: 128Hz sampling rate (Internal: 2048Hz), 0.51 microVolt
+    # vertical resolution, 14 bits of data per channel
+    sampling_rate = SAMPLING_RATE
+    resolution = MICROVOLTS_PER_BIT
+    ch_bits = CH_BITS
+
+def _fieldTable(bitOffsets, width):
+    """Return the first byte and right shift which extract fields of `width`
+    bits starting at `bitOffsets` from a big endian 24 bit word."""
+    bitOffsets = np.asarray(bitOffsets)
+    return bitOffsets // 8, 24 - width - bitOffsets % 8
+
+_CH_BYTES, _CH_SHIFTS = _fieldTable(CHANNEL_BIT_OFFSETS, CH_BITS)
+_QUALITY_BYTE, _QUALITY_SHIFT = _fieldTable(QUALITY_BIT_OFFSET, CH_BITS)
+_CH_MASK = (1 << CH_BITS) - 1
+# The same as Python ints, for decoding a single packet without arrays
+_CH_FIELDS = list(zip(_CH_BYTES.tolist(), _CH_SHIFTS.tolist()))
+_QUALITY_FIELD = (int(_QUALITY_BYTE), int(_QUALITY_SHIFT))
+
+def _extract(packets, byteIdx, shifts):
+    """Extract 14 bit fields from (N, 32) uint8 packets."""
+    words = packets[:, byteIdx].astype(np.uint32) << 16
+    words |= packets[:, byteIdx + 1].astype(np.uint32) << 8
+    words |= packets[:, byteIdx + 2]
+    return (words >> shifts) & _CH_MASK
+
+class DecodedPackets(object):
+    """Column arrays for N decoded packets.
+
+    counter:   (N,) counter value, meaningless for battery packets
+    isBattery: (N,) True for battery packets, which carry no sample
+    battery:   (N,) battery level in percent, -1 for non battery packets
+    signal:    (N, 14) raw ADC values in CH_* order
+    quality:   (N,) contact quality value
+    qualityChannel: (N,) channel index the quality belongs to, -1 if unknown
+    gyro:      (N, 2) gyroscope X and Y
+    """
+    __slots__ = ("counter", "isBattery", "battery", "signal", "quality",
+                 "qualityChannel", "gyro")
+
+    def __len__(self):
+        return len(self.counter)
+
+def toPackets(data):
+    """View decrypted bytes (one or many packets) as an (N, 32) uint8 array."""
+    if isinstance(data, np.ndarray):
+        return data.reshape(-1, PACKET_SIZE)
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, PACKET_SIZE)
+
+def decodePackets(data):
+    """Decode one or many decrypted 32 byte packets.
+
+    `data` is either the bytes returned by cipher.decrypt() (any multiple of
+    32 bytes) or an (N, 32) uint8 array. Values are bit identical to slicing
+    a BitArray of each packet.
+    """
+    packets = toPackets(data)
+    first = packets[:, 0]
+
+    decoded = DecodedPackets()
+    decoded.counter = first & 0x7F
+    decoded.isBattery = first >= 128
+    decoded.battery = BATTERY_LEVELS[first]
+    decoded.signal = _extract(packets, _CH_BYTES, _CH_SHIFTS)
+    decoded.quality = _extract(packets, _QUALITY_BYTE[None], _QUALITY_SHIFT)[:, 0]
+    decoded.qualityChannel = np.where(decoded.isBattery, -1,
+                                      QUALITY_CHANNELS[decoded.counter])
+    gyro = np.empty((len(packets), 2), dtype=np.int16)
+    gyro[:, 0] = packets[:, 29] & 0x7F
+    gyro[:, 1] = packets[:, 30]
+    gyro -= GYRO_OFFSET
+    decoded.gyro = gyro
+    return decoded
+
+# dtype of the quality column (that of the shifted words, which depends on numpy)
+_QUALITY_DTYPE = decodePackets(bytes(bytearray(PACKET_SIZE))).quality.dtype
+
+def _insert(packets, byteIdx, shifts, values):
+    """OR 14 bit fields into (N, 32) uint8 packets, the inverse of _extract."""
+    words = (values.astype(np.uint32) & _CH_MASK) << shifts
+    for k, byte in enumerate(byteIdx):
+        packets[:, byte] |= (words[:, k] >> 16).astype(np.uint8)
+        packets[:, byte + 1] |= ((words[:, k] >> 8) & 0xFF).astype(np.uint8)
+        packets[:, byte + 2] |= (words[:, k] & 0xFF).astype(np.uint8)
+
+def encodePackets(first, signal, quality=0, gyro=(0, 0)):
+    """Build decrypted packets, the inverse of decodePackets().
+
+    `first` holds the first byte of each packet: the counter (0-127) or a
+    battery byte (see batteryByte). signal, quality and gyro broadcast
+    against it. Bits which carry no field are left to zero.
+    """
+    first = np.asarray(first, dtype=np.uint8).reshape(-1)
+    n = len(first)
+    packets = np.zeros((n, PACKET_SIZE), dtype=np.uint8)
+    packets[:, 0] = first
+    _insert(packets, _CH_BYTES, _CH_SHIFTS,
+            np.broadcast_to(signal, (n, len(CHANNEL_NAMES))))
+    _insert(packets, _QUALITY_BYTE[None], _QUALITY_SHIFT,
+            np.broadcast_to(quality, (n,)).reshape(n, 1))
+    gyro = np.broadcast_to(gyro, (n, 2)).astype(np.int16) + GYRO_OFFSET
+    packets[:, 29] |= (gyro[:, 0] & 0x7F).astype(np.uint8)
+    packets[:, 30] = gyro[:, 1].astype(np.uint8)
+    return packets
+
+def batteryByte(level):
+    """First byte of a battery packet reporting at least `level` percent."""
+    return int(np.nonzero(BATTERY_LEVELS >= level)[0][0])
+
+def deriveKey(serialNumber, research=True):
+    """Generate the AES key of a device.
+    The key is based on the serial number of the device and the
+    information whether it is a research or consumer device.
+    """
+    sn = serialNumber
+    if not isinstance(sn, str):
+        # bytes on Python 3
+        sn = sn.decode("latin-1")
+    if research:
+        key = ''.join([sn[15], '\x00', sn[14], '\x54',
+                       sn[13], '\x10', sn[12], '\x42',
+                       sn[15], '\x00', sn[14], '\x48',
+                       sn[13], '\x00', sn[12], '\x50'])
+    else:
+        key = ''.join([sn[15], '\x00', sn[14], '\x48',
+                       sn[13], '\x00', sn[12], '\x54',
+                       sn[15], '\x10', sn[14], '\x42',
+                       sn[13], '\x00', sn[12], '\x50'])
+    if not isinstance(key, bytes):
+        key = key.encode("latin-1")
+    return key
+
+class PacketBatcher(object):
+    """Accumulate raw USB reads so that they are decrypted with one cipher call.
+
+    AES ECB encrypts every 16 byte block independently, so decrypting the
+    concatenation of N packets is exactly the same as decrypting them one by
+    one, while paying the call overhead only once.
+
+    A batch is ready when `batchSize` packets are pending or when the oldest
+    pending packet has waited `maxLatency` seconds (None disables it).
+    """
+    def __init__(self, batchSize=1, maxLatency=None):
+        if batchSize < 1:
+            raise ValueError("batchSize must be at least 1")
+        self.batchSize = batchSize
+        self.maxLatency = maxLatency
+        self._raw = bytearray()
+        self._readTimes = []
+
+    def __len__(self):
+        return len(self._readTimes)
+
+    def add(self, raw, readTime=None):
+        """Queue one raw read, stamped with the host clock when `readTime` is
+        not given. Returns True when the batch should be flushed."""
+        if readTime is None:
+            readTime = hostClock()
+        self._raw.extend(raw)
+        self._readTimes.append(readTime)
+        return self._ready()
+
+    def extend(self, raw, readTimes):
+        """Queue several raw reads at once: the concatenated bytes of
+        len(readTimes) packets, e.g. from epoc_readahead. Returns True when
+        the batch should be flushed."""
+        self._raw.extend(raw)
+        self._readTimes.extend(readTimes)
+        return self._ready()
+
+    def _ready(self):
+        if len(self._readTimes) >= self.batchSize:
+            return True
+        return (self.maxLatency is not None and
+                self._readTimes[-1] - self._readTimes[0] >= self.maxLatency)
+
+    def timeLeft(self, now=None):
+        """Seconds before the oldest pending packet has waited maxLatency,
+        None when nothing is pending or there is no bound."""
+        if self.maxLatency is None or not self._readTimes:
+            return None
+        if now is None:
+            now = hostClock()
+        return self._readTimes[0] + self.maxLatency - now
+
+    def expired(self, now=None):
+        """True when the pending packets should be flushed although no packet
+        arrived, e.g. after a read timeout."""
+        left = self.timeLeft(now)
+        return left is not None and left <= 0
+
+    def decrypt(self, cipher):
+        """Decrypt all pending packets in one call and reset the batch.
+
+        Returns the plain text and the host read time of every packet.
+        """
+        plain = cipher.decrypt(bytes(self._raw))
+        readTimes = np.array(self._readTimes)
+        del self._raw[:]
+        del self._readTimes[:]
+        return plain, readTimes
+
+# Per sample columns produced by EmotivPacketDecoder and stored by the sample
+# buffers: signal (n, 14), gyro (n, 2), counter, timestamp (drift corrected,
+# see epoc_clock), battery level, the raw contact quality value carried by
+# the packet and hostTime, the host clock when the packet was read.
+SampleBlock = namedtuple("SampleBlock",
+                         "signal gyro counter timestamp battery quality hostTime")
+
+def joinBlocks(blocks):
+    """Concatenate SampleBlocks into one."""
+    return SampleBlock(*[np.concatenate(columns) for columns in zip(*blocks)])
+
+# Counter slots per cycle: 0-127 then the battery packet
+CYCLE = 129
+
+class PacketLoss(object):
+    """Counter continuity statistics, updated by EmotivPacketDecoder.
+
+    received:    packets received (battery packets included)
+    lost:        packets missing from the counter sequence
+    samplesLost: lost packets which carried a sample, i.e. not the battery
+                 packet of slot 128
+
+    rate() is the fraction of packets lost over the last slots, up to
+    `history` of them. With shared=True the statistics live in shared memory
+    so that the process reading samples sees those of the acquisition
+    process.
+    """
+    _RECEIVED, _LOST, _SAMPLES_LOST, _FIRST, _LAST = range(5)
+
+    def __init__(self, history=10 * CYCLE, shared=False):
+        self.history = history
+        if shared:
+            import ctypes
+            import multiprocessing
+            self._shared = (multiprocessing.RawArray(ctypes.c_int64, 5),
+                            multiprocessing.RawArray(ctypes.c_uint8, history))
+        else:
+            self._shared = None
+        self._map(self._shared)
+
+    def _map(self, shared):
+        if shared is None:
+            self._state = np.zeros(5, dtype=np.int64)
+            self._received = np.zeros(self.history, dtype=np.uint8)
+        else:
+            self._state = np.frombuffer(shared[0], dtype=np.int64)
+            self._received = np.frombuffer(shared[1], dtype=np.uint8)
+        self._state[self._FIRST] = self._state[self._LAST] = -1
+
+    def __getstate__(self):
+        if self._shared is None:
+            return self.__dict__.copy()
+        return {"history": self.history, "shared": self._shared}
+
+    def __setstate__(self, state):
+        if "shared" not in state:
+            self.__dict__.update(state)
+            return
+        self.history = state["history"]
+        self._shared = state["shared"]
+        self._state = np.frombuffer(self._shared[0], dtype=np.int64)
+        self._received = np.frombuffer(self._shared[1], dtype=np.uint8)
+
+    def updateOne(self, sequence, slot):
+        """update() for a single packet, with scalar arithmetic."""
+        state = self._state
+        previous = int(state[self._LAST])
+        if previous < 0:
+            previous = sequence - 1
+            state[self._FIRST] = sequence
+        lost = sequence - previous - 1
+        shift = slot - sequence - (CYCLE - 1)
+        batteryLost = ((sequence + shift) // CYCLE - (previous + shift) // CYCLE -
+                       (slot == CYCLE - 1))
+        state[self._RECEIVED] += 1
+        if lost:
+            state[self._LOST] += lost
+            state[self._SAMPLES_LOST] += lost - batteryLost
+            if lost + 1 >= self.history:
+                self._received[:] = 0
+            else:
+                self._received[np.arange(previous + 1, sequence) % self.history] = 0
+        self._received[sequence % self.history] = 1
+        state[self._LAST] = sequence
+
+    @property
+    def received(self):
+        return int(self._state[self._RECEIVED])
+
+    @property
+    def lost(self):
+        return int(self._state[self._LOST])
+
+    @property
+    def samplesLost(self):
+        return int(self._state[self._SAMPLES_LOST])
+
+    def update(self, sequence, slots):
+        """Account for packets received with increasing `sequence` numbers,
+        `slots` being their position (0-128) in the counter cycle."""
+        state = self._state
+        last = int(sequence[-1])
+        previous = int(state[self._LAST])
+        if previous < 0:
+            previous = int(sequence[0]) - 1
+            state[self._FIRST] = sequence[0]
+        lost = last - previous - len(sequence)
+        # Battery slots in (previous, last], minus those which were received
+        shift = int(slots[0] - sequence[0]) - (CYCLE - 1)
+        batteryLost = ((last + shift) // CYCLE - (previous + shift) // CYCLE -
+                       int(np.count_nonzero(slots == CYCLE - 1)))
+        state[self._RECEIVED] += len(sequence)
+        state[self._LOST] += lost
+        state[self._SAMPLES_LOST] += lost - batteryLost
+
+        # Slots of the sliding window, by sequence number modulo history
+        if last - previous >= self.history:
+            self._received[:] = 0
+        else:
+            self._received[np.arange(previous + 1, last + 1) % self.history] = 0
+        recent = sequence[sequence > last - self.history]
+        self._received[recent % self.history] = 1
+        state[self._LAST] = last
+
+    def rate(self, packets=CYCLE):
+        """Fraction of the last `packets` counter slots (about one second by
+        default) which were lost."""
+        last = int(self._state[self._LAST])
+        if last < 0:
+            return 0.0
+        packets = min(packets, self.history, last - int(self._state[self._FIRST]) + 1)
+        slots = np.arange(last - packets + 1, last + 1) % self.history
+        return 1.0 - np.count_nonzero(self._received[slots]) / float(packets)
+
+class EmotivPacketDecoder(object):
+    """Decode batches of packets into per sample columns.
+
+    Battery packets replace a sample, so the decoder keeps the latest battery
+    level, counter and per channel contact quality between batches and
+    attaches them to the samples that follow.
+
+    Counters are unwrapped into a sequence number (battery packets take slot
+    128 of the cycle) which `clock` maps to drift corrected timestamps and
+    `loss` uses to count lost packets.
+
+    With fillGaps=True every lost sample is replaced by a row with a NaN
+    signal, zero gyro and quality, the expected counter and the timestamp
+    the clock gives it, so that sample n of the output always lies n periods
+    after the first one. Gaps longer than `maxGap` packets (headset switched
+    off, out of range) are only counted. NaN needs one of the floating point
+    signal formats.
+
+    The signal is converted to `signalFormat` (see SIGNAL_FORMATS) as it is
+    decoded.
+    """
+    def __init__(self, clock=None, loss=None, fillGaps=False, maxGap=10 * CYCLE,
+                 signalFormat="float"):
+        if fillGaps and signalDtype(signalFormat).kind != "f":
+            raise ValueError("fillGaps needs a floating point signal format")
+        self.signalFormat = signalFormat
+        self.counter = 0
+        self.battery = 0
+        self.quality = np.zeros(len(CHANNEL_NAMES), dtype=np.uint16)
+        self.clock = SampleClock() if clock is None else clock
+        self.loss = PacketLoss() if loss is None else loss
+        self.fillGaps = fillGaps
+        self.maxGap = maxGap
+        # Output of a battery packet alone
+        self._empty = SampleBlock(signal=np.zeros((0, len(CHANNEL_NAMES)),
+                                                  dtype=signalDtype(signalFormat)),
+                                  gyro=np.zeros((0, 2), dtype=np.int16),
+                                  counter=np.zeros(0, dtype=np.uint8),
+                                  timestamp=np.zeros(0),
+                                  battery=np.zeros(0, dtype=np.int8),
+                                  quality=np.zeros(0, dtype=_QUALITY_DTYPE),
+                                  hostTime=np.zeros(0))
+        # Sequence number, slot and read time of the last packet
+        self.sequence = -1
+        self._slot = None
+        self._readTime = None
+
+    def _unwrap(self, packets, readTimes):
+        """Sequence number and cycle slot of every packet."""
+        slots = np.where(packets.isBattery, CYCLE - 1, packets.counter).astype(np.int64)
+        previous = np.empty_like(slots)
+        previous[1:] = slots[:-1]
+        previous[0] = slots[0] - 1 if self._slot is None else self._slot
+        step = (slots - previous) % CYCLE
+        # A repeated slot is a whole cycle lost rather than a duplicate
+        step[step == 0] = CYCLE
+        if self._readTime is not None:
+            # Whole cycles lost (e.g. out of range) are only seen on the clock
+            elapsed = np.diff(np.concatenate(([self._readTime], readTimes)))
+            missed = np.floor((elapsed / self.clock.period - step) / CYCLE + 0.25)
+            step += np.maximum(missed, 0).astype(np.int64) * CYCLE
+        sequence = self.sequence + np.cumsum(step)
+        self.sequence = int(sequence[-1])
+        self._slot = int(slots[-1])
+        self._readTime = readTimes[-1]
+        return sequence, slots
+
+    def _withGaps(self, block, first, sequence, slots, battery):
+        """Insert a row for every sample lost from sequence number `first`
+        on, `battery` being the level in effect before the block."""
+        full = np.arange(first, sequence[-1] + 1)
+        fullSlots = (slots[0] + full - sequence[0]) % CYCLE
+        rows = full[fullSlots != CYCLE - 1]
+        n = len(rows)
+        if n == len(block.counter):
+            return block
+        at = np.searchsorted(rows, sequence[slots != CYCLE - 1])
+
+        signal = np.full((n, len(CHANNEL_NAMES)), np.nan, dtype=block.signal.dtype)
+        signal[at] = block.signal
+        gyro = np.zeros((n, 2), dtype=block.gyro.dtype)
+        gyro[at] = block.gyro
+        timestamp = self.clock.at(rows)
+        timestamp[at] = block.timestamp
+        np.maximum.accumulate(timestamp, out=timestamp)
+        quality = np.zeros(n, dtype=block.quality.dtype)
+        quality[at] = block.quality
+        hostTime = np.full(n, np.nan)
+        hostTime[at] = block.hostTime
+        # Lost samples keep the battery level of the sample before them
+        received = np.full(n, -1)
+        received[at] = at
+        np.maximum.accumulate(received, out=received)
+        levels = np.concatenate(([battery], block.battery))
+        previous = np.searchsorted(at, received, side="left")
+        # np.where evaluates both branches: clip for blocks without samples
+        batteryRows = np.where(received >= 0,
+                               levels[np.minimum(previous + 1, len(levels) - 1)], battery)
+
+        return SampleBlock(signal=signal,
+                           gyro=gyro,
+                           counter=((rows + slots[0] - sequence[0]) % CYCLE).astype(np.uint8),
+                           timestamp=timestamp,
+                           battery=batteryRows.astype(block.battery.dtype),
+                           quality=quality,
+                           hostTime=hostTime)
+
+    def _decodeOne(self, data, readTime):
+        """decode() of a single packet with scalar arithmetic: with the
+        default batches of one, the fixed cost of the array code would exceed
+        the decoding itself."""
+        raw = bytearray(data)
+        first = raw[0]
+        isBattery = first >= 128
+        slot = CYCLE - 1 if isBattery else first
+
+        # Unwrap the counter, as _unwrap() does
+        step = (slot - (slot - 1 if self._slot is None else self._slot)) % CYCLE or CYCLE
+        if self._readTime is not None:
+            missed = math.floor(((readTime - self._readTime) / self.clock.period - step) /
+                                CYCLE + 0.25)
+            if missed > 0:
+                step += int(missed) * CYCLE
+        previousSequence = self.sequence
+        previousBattery = self.battery
+        sequence = self.sequence + step
+        self.sequence = sequence
+        self._slot = slot
+        self._readTime = readTime
+        self.loss.updateOne(sequence, slot)
+        timestamp = self.clock.timestamp(sequence, readTime)
+
+        if isBattery:
+            self.battery = int(BATTERY_LEVELS[first])
+            block = self._empty
+        else:
+            self.counter = first
+            signal = [(((raw[byte] << 16) | (raw[byte + 1] << 8) | raw[byte + 2]) >> shift) &
+                      _CH_MASK for byte, shift in _CH_FIELDS]
+            byte, shift = _QUALITY_FIELD
+            quality = (((raw[byte] << 16) | (raw[byte + 1] << 8) | raw[byte + 2]) >> shift) & _CH_MASK
+            channel = QUALITY_CHANNELS[first]
+            if channel >= 0:
+                self.quality[channel] = quality
+            block = SampleBlock(signal=convertSignal(np.array([signal]), self.signalFormat),
+                                gyro=np.array([[(raw[29] & 0x7F) - GYRO_OFFSET,
+                                                raw[30] - GYRO_OFFSET]], dtype=np.int16),
+                                counter=np.array([first], dtype=np.uint8),
+                                timestamp=np.array([timestamp]),
+                                battery=np.array([self.battery], dtype=np.int8),
+                                quality=np.array([quality], dtype=_QUALITY_DTYPE),
+                                hostTime=np.array([readTime]))
+        if self.fillGaps and previousSequence >= 0 and sequence - previousSequence > 1:
+            if sequence - previousSequence - 1 <= self.maxGap:
+                block = self._withGaps(block, previousSequence + 1, np.array([sequence]),
+                                       np.array([slot]), previousBattery)
+        return block
+
+    def decode(self, data, readTimes):
+        """Decode decrypted `data` read at `readTimes` into a SampleBlock."""
+        if len(data) == PACKET_SIZE and not isinstance(data, np.ndarray):
+            return self._decodeOne(data, float(readTimes[0]))
+        packets = decodePackets(data)
+        isSample = ~packets.isBattery
+        readTimes = np.asarray(readTimes, dtype=np.float64)
+        previousSequence = self.sequence
+        previousBattery = self.battery
+        if len(packets):
+            sequence, slots = self._unwrap(packets, readTimes)
+            self.loss.update(sequence, slots)
+            timestamps = self.clock.timestamps(sequence, readTimes)
+        else:
+            timestamps = readTimes
+
+        # Battery level in effect for every packet
+        batteryAt = np.where(packets.isBattery, np.arange(len(packets)), -1)
+        np.maximum.accumulate(batteryAt, out=batteryAt)
+        battery = np.where(batteryAt >= 0, packets.battery[batteryAt],
+                           self.battery)
+        if len(packets):
+            self.battery = int(battery[-1])
+
+        counter = packets.counter[isSample]
+        if len(counter):
+            self.counter = int(counter[-1])
+        # Connection quality available with counters
+        channel = packets.qualityChannel
+        known = channel >= 0
+        self.quality[channel[known]] = packets.quality[known]
+
+        block = SampleBlock(signal=convertSignal(packets.signal[isSample],
+                                                 self.signalFormat),
+                            gyro=packets.gyro[isSample],
+                            counter=counter,
+                            timestamp=timestamps[isSample],
+                            battery=battery[isSample],
+                            quality=packets.quality[isSample],
+                            hostTime=readTimes[isSample])
+        if self.fillGaps and len(packets):
+            # Gaps inside the first block are filled too
+            first = previousSequence + 1 if previousSequence >= 0 else int(sequence[0])
+            if sequence[-1] - first + 1 - len(packets) <= self.maxGap:
+                block = self._withGaps(block, first, sequence, slots, previousBattery)
+        return block
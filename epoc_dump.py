@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Load the timestamped text dumps printed by the former logging scripts.
+
+A dump such as output_signal_with_timestamps is a float timestamp followed
+by the repr of a 14 value NumPy array, which NumPy wraps over two lines:
+
+    13.5259628296 [ 8161.  7675.  7418.  8833.  8632.  8403.  8957.  8394.  9006.  8287.
+      8501.  8639.  8027.  8705.]
+
+mixed with header lines, "<timestamp> None" lines for reads which returned
+no sample and timing statistics at the end.
+
+The file is read in fixed size chunks; one regular expression pass finds
+the complete records of a chunk and one np.fromstring() call parses all
+their values, so memory is bounded by the chunk size whatever the length of
+the session. A record cut by the end of a chunk is carried over to the next
+one, a truncated final record is dropped.
+"""
+
+import re
+
+import numpy as np
+
+from epoc_decoder import CHANNEL_NAMES, SampleBlock
+from epoc_record import SessionRecorder
+
+_RECORD = re.compile(r"(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)[ \t]+\[([^\[\]]*)\]")
+
+def _parseRecords(records):
+    """(timestamps, samples) of a list of (timestamp, values) strings."""
+    channels = len(CHANNEL_NAMES)
+    timestamps = np.array([ts for ts, values in records], dtype=float)
+    values = np.fromstring(" ".join([v for ts, v in records]), sep=" ")
+    if values.size != channels * len(records):
+        # Some record does not hold 14 values (e.g. a "..." summary), only
+        # then pay for parsing them one by one
+        keep = []
+        rows = []
+        for i, (ts, v) in enumerate(records):
+            row = np.fromstring(v, sep=" ")
+            if row.size == channels:
+                keep.append(i)
+                rows.append(row)
+        timestamps = timestamps[keep]
+        values = np.array(rows)
+    return timestamps, values.reshape(-1, channels)
+
+def iterDump(path, chunkSize=1 << 20):
+    """Yield (timestamps (n,), samples (n, 14)) arrays, one pair per chunk of
+    `chunkSize` characters of the dump."""
+    carry = ""
+    with open(path) as f:
+        while True:
+            text = f.read(chunkSize)
+            if not text:
+                break
+            text = carry + text
+            end = text.rfind("]") + 1
+            carry = text[end:]
+            records = _RECORD.findall(text, 0, end)
+            if records:
+                yield _parseRecords(records)
+    # Whatever is left in carry is a truncated final record
+
+def loadDump(path, chunkSize=1 << 20):
+    """Return (timestamps, samples) of a whole dump."""
+    chunks = list(iterDump(path, chunkSize))
+    if not chunks:
+        return np.zeros(0), np.zeros((0, len(CHANNEL_NAMES)))
+    return (np.concatenate([ts for ts, samples in chunks]),
+            np.concatenate([samples for ts, samples in chunks]))
+
+def convertDump(src, dst, chunkSize=1 << 20):
+    """Convert a text dump into a session recording (see epoc_record) without
+    loading it whole: 44 bytes per sample instead of ~170 characters, which
+    SessionReader can memory map. Counter, gyro, battery and quality are
+    not in the dump and are left to zero. Returns the number of samples."""
+    recorder = SessionRecorder(dst)
+    try:
+        for timestamps, samples in iterDump(src, chunkSize):
+            n = len(timestamps)
+            recorder.write(SampleBlock(signal=samples,
+                                       gyro=np.zeros((n, 2), dtype=np.int16),
+                                       counter=np.zeros(n, dtype=np.uint8),
+                                       timestamp=timestamps,
+                                       battery=np.zeros(n, dtype=np.int8),
+                                       quality=np.zeros(n, dtype=np.uint16),
+                                       hostTime=timestamps))
+    finally:
+        recorder.close()
+    return recorder.count
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Streaming IIR filters for the acquisition path.
+
+Raw samples sit on a ~8000 DC offset and carry mains interference, which
+every consumer used to remove on its own copy. A SosFilter given to the
+device filters each decoded batch once, in the acquisition thread, before
+it is stored, for all 14 channels at once.
+
+Filters are cascades of second order sections in the layout used by
+scipy.signal (one [b0, b1, b2, 1, a1, a2] row per section), so a design
+from scipy.signal.butter(..., output="sos") can be used as well as the
+ones below (Robert Bristow-Johnson's audio EQ cookbook biquads, Butterworth
+for the band edges). The sections run in transposed direct form II and
+their state is kept between batches, so filtering a session batch by batch
+gives the same values as filtering it in one go. scipy.signal.sosfilt() is
+used when SciPy is installed; otherwise a loop over the samples of the
+batch, vectorized across channels, computes the same recurrence.
+
+Rows of lost samples (NaN, see EmotivPacketDecoder.fillGaps) are skipped
+and stay NaN, so that they do not spoil the filter state.
+"""
+
+import math
+
+import numpy as np
+
+try:
+    from scipy.signal import sosfilt
+except ImportError:
+    sosfilt = None
+
+from epoc_decoder import CHANNEL_NAMES
+
+def _section(b0, b1, b2, a0, a1, a2):
+    return np.array([[b0 / a0, b1 / a0, b2 / a0, 1.0, a1 / a0, a2 / a0]])
+
+def _cookbook(freq, rate):
+    w = 2 * math.pi * freq / rate
+    return math.cos(w), math.sin(w)
+
+def lowpassSection(cutoff, rate=128.0, q=math.sqrt(0.5)):
+    """Second order low pass section."""
+    cos, sin = _cookbook(cutoff, rate)
+    alpha = sin / (2 * q)
+    return _section((1 - cos) / 2, 1 - cos, (1 - cos) / 2,
+                    1 + alpha, -2 * cos, 1 - alpha)
+
+def highpassSection(cutoff, rate=128.0, q=math.sqrt(0.5)):
+    """Second order high pass section."""
+    cos, sin = _cookbook(cutoff, rate)
+    alpha = sin / (2 * q)
+    return _section((1 + cos) / 2, -(1 + cos), (1 + cos) / 2,
+                    1 + alpha, -2 * cos, 1 - alpha)
+
+def notchSection(freq, rate=128.0, q=30.0):
+    """Notch at `freq`, -3dB bandwidth of freq / q."""
+    cos, sin = _cookbook(freq, rate)
+    alpha = sin / (2 * q)
+    return _section(1, -2 * cos, 1, 1 + alpha, -2 * cos, 1 - alpha)
+
+def _butterworthQ(sections):
+    """Q of each section of a Butterworth filter of order 2 * sections."""
+    order = 2 * sections
+    return [1 / (2 * math.cos(math.pi * (2 * k + 1) / (2 * order)))
+            for k in range(sections)]
+
+def designSos(rate=128.0, band=(1.0, 40.0), notch=(50.0,), sections=2, q=30.0):
+    """SOS array of a Butterworth band pass (order 2 * sections per edge,
+    either edge may be None) followed by a notch at every frequency of
+    `notch` which lies below the Nyquist frequency."""
+    rows = []
+    low, high = band if band is not None else (None, None)
+    for sectionQ in _butterworthQ(sections):
+        if low:
+            rows.append(highpassSection(low, rate, sectionQ))
+        if high:
+            rows.append(lowpassSection(high, rate, sectionQ))
+    for freq in notch or ():
+        if freq < rate / 2:
+            rows.append(notchSection(freq, rate, q))
+    if not rows:
+        raise ValueError("empty filter design")
+    return np.concatenate(rows)
+
+def _sosfilt(sos, x, zi):
+    """Transposed direct form II over the rows of x, updating zi in place."""
+    for section, z in zip(sos, zi):
+        b0, b1, b2, a0, a1, a2 = section
+        y = np.empty_like(x)
+        for n in range(len(x)):
+            xn = x[n]
+            yn = b0 * xn + z[0]
+            z[0] = b1 * xn - a1 * yn + z[1]
+            z[1] = b2 * xn - a2 * yn
+            y[n] = yn
+        x = y
+    return x
+
+class SosFilter(object):
+    """Cascade of second order sections applied to (n, channels) batches,
+    with its state carried from one batch to the next.
+
+    With steadyState=True the state is initialized from the first sample
+    as if the input had always been at that value, which avoids a long
+    transient of the high pass sections on the DC offset.
+    """
+
+    def __init__(self, sos, channels=len(CHANNEL_NAMES), steadyState=True):
+        self.sos = np.atleast_2d(np.asarray(sos, dtype=np.float64))
+        if self.sos.shape[1] != 6:
+            raise ValueError("sos must have 6 columns")
+        self.channels = channels
+        self.steadyState = steadyState
+        self.reset()
+
+    def reset(self):
+        """Forget the state, the next batch starts a new signal."""
+        self.zi = np.zeros((len(self.sos), 2, self.channels))
+        self._started = False
+
+    def _initialize(self, first):
+        """Steady state for a constant input equal to `first`."""
+        x = first
+        for section, z in zip(self.sos, self.zi):
+            b0, b1, b2, a0, a1, a2 = section
+            y = x * (b0 + b1 + b2) / (1 + a1 + a2)
+            z[1] = b2 * x - a2 * y
+            z[0] = b1 * x - a1 * y + z[1]
+            x = y
+
+    def process(self, signal):
+        """Filter an (n, channels) batch and return the result."""
+        signal = np.asarray(signal, dtype=np.float64)
+        valid = ~np.isnan(signal).any(axis=1)
+        if not valid.all():
+            out = np.full(signal.shape, np.nan)
+            out[valid] = self.process(signal[valid])
+            return out
+        if not len(signal):
+            return signal.copy()
+        if not self._started:
+            if self.steadyState:
+                self._initialize(signal[0])
+            self._started = True
+        if sosfilt is not None:
+            out, self.zi = sosfilt(self.sos, signal, axis=0, zi=self.zi)
+            return out
+        return _sosfilt(self.sos, signal, self.zi)
+
+    __call__ = process
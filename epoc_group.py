@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Acquisition from several headsets at once.
+
+EmotivDeviceGroup opens one EmotivDevice per dongle, each with its own
+acquisition thread, key and sample buffer. USB reads block outside of the
+interpreter lock and decoding is vectorized, so headsets do not wait for
+each other: a slow or silent one only delays its own samples.
+
+read() merges the buffers into one stream keyed by serial number. Every
+call returns, for each headset, the samples stamped up to the same
+watermark: the latest drift corrected timestamp (see epoc_clock) that
+every headset has reached. Samples past it are held back until the others
+catch up, so the blocks of one read cover the same stretch of time.
+
+A headset lagging more than `maxSkew` seconds behind the most recent one
+(switched off, out of range) stops holding the watermark back; its samples
+are then handed out as they come.
+
+    group = EmotivDeviceGroup()
+    group.startAcquisition()
+    while recording:
+        for serialNumber, block in group.read(timeout=1.0).items():
+            ...
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from epoc_decoder import SampleBlock, hostClock, joinBlocks
+from epoc_iohub import EmotivDevice, EPOCNotFoundError
+
+class _Wakeup(object):
+    """Subscription-like object setting an event after every write of the
+    acquisition thread, without reading anything from the buffer."""
+
+    def __init__(self, event):
+        self.event = event
+        self.active = True
+
+    def deliver(self):
+        self.event.set()
+
+    def cancel(self):
+        self.active = False
+
+class EmotivDeviceGroup(object):
+    """Several EmotivDevices read as one time aligned stream.
+
+    `serialNumbers` defaults to every plugged dongle (every dongle of the
+    transport if one is given); other keyword arguments are passed to each
+    EmotivDevice.
+    """
+
+    def __init__(self, serialNumbers=None, transport=None, maxSkew=0.5, **deviceArgs):
+        if serialNumbers is None:
+            if transport is None:
+                serialNumbers = EmotivDevice.listSerialNumbers()
+            else:
+                serialNumbers = transport.enumerate()
+        if not serialNumbers:
+            raise EPOCNotFoundError("No plugged Emotiv EPOC")
+        self.maxSkew = maxSkew
+        self.devices = OrderedDict()
+        for sn in serialNumbers:
+            self.devices[sn] = EmotivDevice(sn, transport=transport, **deviceArgs)
+        # Samples read from each device but past the watermark
+        self._pending = dict((sn, []) for sn in self.devices)
+        # Latest timestamp read from each device
+        self._latest = dict((sn, -np.inf) for sn in self.devices)
+        self._ready = threading.Event()
+        self._wakeup = _Wakeup(self._ready)
+        self.watermark = -np.inf
+
+    @property
+    def serialNumbers(self):
+        return list(self.devices)
+
+    def startAcquisition(self):
+        for device in self.devices.values():
+            device._ac_thread.subscriptions += (self._wakeup,)
+            device.startAcuisition()
+
+    def stopAcquisition(self, timeout=1.0):
+        for device in self.devices.values():
+            device.unsubscribe(self._wakeup)
+            device.stopAcquisition(timeout)
+
+    def disconnect(self):
+        for device in self.devices.values():
+            device.disconnect()
+
+    def _collect(self):
+        """Move the samples written since the last call to the pending lists."""
+        for sn, device in self.devices.items():
+            block = device.getSamples()
+            if len(block.counter) or not self._pending[sn]:
+                self._pending[sn].append(block)
+            if len(block.counter):
+                self._latest[sn] = block.timestamp[-1]
+
+    def _release(self):
+        """Split the pending samples at the watermark."""
+        newest = max(self._latest.values())
+        inStep = [t for t in self._latest.values() if t >= newest - self.maxSkew]
+        self.watermark = max(self.watermark, min(inStep))
+        blocks = OrderedDict()
+        for sn in self.devices:
+            pending = self._pending[sn]
+            block = joinBlocks(pending) if len(pending) > 1 else pending[0]
+            n = int(np.searchsorted(block.timestamp, self.watermark, side="right"))
+            blocks[sn] = SampleBlock(*[column[:n] for column in block])
+            rest = SampleBlock(*[column[n:] for column in block])
+            self._pending[sn] = [rest]
+        return blocks
+
+    def read(self, timeout=0):
+        """Return an OrderedDict of serial number: SampleBlock of the samples
+        up to the common watermark, empty for a headset which has none. With
+        a timeout (seconds, None waits forever) wait until some samples are
+        released."""
+        if timeout is not None:
+            deadline = hostClock() + timeout
+        while True:
+            self._ready.clear()
+            self._collect()
+            blocks = self._release()
+            if any(len(block.counter) for block in blocks.values()):
+                return blocks
+            if timeout is None:
+                self._ready.wait()
+            else:
+                remaining = deadline - hostClock()
+                if remaining <= 0:
+                    return blocks
+                self._ready.wait(remaining)
+
+    def getPacketLoss(self):
+        """Packets lost by every headset, by serial number."""
+        return OrderedDict((sn, device.getPacketLoss())
+                           for sn, device in self.devices.items())
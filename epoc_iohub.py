@@ -1,9 +1,15 @@
 import numpy as np
 import threading
-from Queue import Queue, Empty
-import usb
-from bitstring import BitArray
-from Crypto.Cipher import AES
+# usb, Crypto and the modules of the optional features are imported where
+# they are first needed, so that importing this module stays cheap
+from epoc_decoder import (CHANNEL_NAMES, CYCLE, DeviceTables, EmotivPacketDecoder, PacketBatcher,
+                          hostClock, signalDtype)
+from epoc_buffer import (BLOCK_WRITER, DROP_NEWEST, DROP_OLDEST, RingReader, SampleRingBuffer,
+                         Subscription)
+from epoc_readahead import READ_AHEAD, ReadAheadEndpoint
+from epoc_stats import AcquisitionStats, StatsReporter
+from epoc_usb import (INTERFACE_DESC, MANUFACTURER_DESC, DongleMonitor, dongleKey,
+                      findDongles, newCipher, openDongle, releaseDongle)
 
 CH_F3, CH_FC5, CH_AF3, CH_F7, CH_T7,  CH_P7, CH_O1,\
 CH_O2, CH_P8,  CH_T8,  CH_F8, CH_AF4, CH_FC6,CH_F4 = range(14)
@@ -19,132 +25,194 @@ class EPOCUSBError(EPOCError):
     """Exception raised when error occurs during I/O operations."""
     pass
 
-class EmotivDataAcquisitionThread(threading.Thread):
-    def __init__(self, msg_queue, device, cipher, group=None, target=None, name=None, args=(), kwargs={}):
-        # So the Queue should be created in the iohub EmotivDevice and then passed into the
-        # EmotivDataAcquisitionThread init method.
-        self.msg_queue=msg_queue
+class EPOCNotFoundError(EPOCError):
+    """Exception raised when no (matching) dongle is plugged."""
+    pass
+
+class EmotivDataAcquisitionThread(DeviceTables, threading.Thread):
+    def __init__(self, ring, device, cipher, batchSize=1, maxLatency=None, fillGaps=False,
+                 cursor=None, offTimeout=1.0, signalFilter=None, signalFormat="float",
+                 readAhead=None, group=None, target=None, name=None, args=(), kwargs={}):
+        # So the SampleRingBuffer should be created in the iohub EmotivDevice and then passed
+        # into the EmotivDataAcquisitionThread init method. This thread is its only writer.
+        self.ring=ring
         self.device = device
         self.cipher = cipher
+        # Raw reads are decrypted batchSize at a time (or after maxLatency seconds)
+        self.batcher = PacketBatcher(batchSize, maxLatency)
+        # Keeps battery level, contact quality and packet loss between packets
+        self.decoder = EmotivPacketDecoder(fillGaps=fillGaps, signalFormat=signalFormat)
+        # Callbacks fed after every write, replaced rather than mutated
+        self.subscriptions = ()
+        # Optional epoc_filter.SosFilter applied to every decoded batch
+        self.signalFilter = signalFilter
+        # Loop instrumentation; the backlog is measured against the reader's cursor
+        self.stats = AcquisitionStats()
+        self.cursor = cursor
+        # Reads may time out now and then, none for offTimeout seconds means the
+        # headset is off
+        self.offTimeout = offTimeout
+        # Packets read ahead by a reader thread of its own (True for the default
+        # queue size), None or False reads the endpoint from this thread
+        if readAhead is True:
+            readAhead = READ_AHEAD
+        self.readAhead = readAhead or None
 
         self.is_running=False
         threading.Thread.__init__(self,group, target, name, args, kwargs)
 
-        # Define a contact quality ordering
-        # See:
-        #   github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
-        # For counter values between 0-15
-        self.cqOrder = ["F3", "FC5", "AF3", "F7", "T7",  "P7",  "O1",
-                        "O2", "P8",  "T8",  "F8", "AF4", "FC6", "F4",
-                        "F8", "AF4"]
-        # 16-63 is currently unknown
-        self.cqOrder.extend([None,] * 48)
-        # Now the first 16 values repeat once more and ends with 'FC6'
-        self.cqOrder.extend(self.cqOrder[:16])
-        self.cqOrder.append("FC6")
-        # Finally pattern 77-80 repeats until 127
-        self.cqOrder.extend(self.cqOrder[-4:] * 12)
-
-        # Channel names
-        self.channelNames = ["F3", "FC5", "AF3", "F7", "T7", "P7", "O1",
-                             "O2", "P8",  "T8",  "F8", "AF4","FC6","F4"]
-
-        ##################
-        # ADC parameters #
-        # ################
-
-        # Sampling rate: 128Hz (Internal: 2048Hz)
-        self.sampling_rate = 128
-
-        # Vertical resolution (0.51 microVolt)
-        self.resolution = 0.51
-
-        # Each channel has 14 bits of data
-        self.ch_bits = 14
-
-        self.sample_buffer=np.ndarray([1,14])
-
-        # Battery levels
-        # github.com/openyou/emokit/blob/master/doc/emotiv_protocol.asciidoc
-        self.battery_levels = {247:99, 246:97, 245:93, 244:89, 243:85,
-                               242:82, 241:77, 240:72, 239:66, 238:62,
-                               237:55, 236:46, 235:32, 234:20, 233:12,
-                               232: 6, 231: 4, 230: 3, 229: 2, 228: 1,
-                               227: 1, 226: 1,
-                               }
-        # 100% for bit values between 248-255
-        self.battery_levels.update(dict([(k,100) for k in range(248, 256)]))
-        # 0% for bit values between 128-225
-        self.battery_levels.update(dict([(k,0)   for k in range(128, 226)]))
-        self.battery = 0
-        self.quality = {
-                            "F3" : 0, "FC5" : 0, "AF3" : 0, "F7" : 0,
-                            "T7" : 0, "P7"  : 0, "O1"  : 0, "O2" : 0,
-                            "P8" : 0, "T8"  : 0, "F8"  : 0, "AF4": 0,
-                            "FC6": 0, "F4"  : 0,
-                       }
+    def restart(self):
+        """A new thread carrying on where this one, which has exited,
+        stopped: same decoder, statistics and subscriptions. The packets
+        not read in between count as lost."""
+        thread = EmotivDataAcquisitionThread(self.ring, self.device, self.cipher,
+                                             cursor=self.cursor, offTimeout=self.offTimeout,
+                                             signalFilter=self.signalFilter,
+                                             readAhead=self.readAhead)
+        thread.batcher = self.batcher
+        thread.decoder = self.decoder
+        thread.stats = self.stats
+        thread.subscriptions = self.subscriptions
+        return thread
+
     def run(self):
         # This is called when the thread is started, and is where you would get any new event data from
-        # the actual emotive device. Any new events would be put in the msg_queue so the iohub
-        # EmotivDevice can get events on the queue
+        # the actual emotive device. Any new samples are written to the ring buffer so the iohub
+        # EmotivDevice can read them
         self.is_running=True
+        try:
+            if self.readAhead:
+                self._runReadAhead()
+            else:
+                self._runDirect()
+        finally:
+            # Packets of an incomplete batch are published too
+            if len(self.batcher):
+                self._flush()
+
+    def _runDirect(self):
+        import usb
+        stats = self.stats
+        clock = hostClock
+        lastRead = clock()
         while self.is_running==True:
+            # One read in sampleEvery is timed
+            timed = not stats.packets % stats.sampleEvery
+            if timed:
+                start = clock()
             try:
                 raw = self.device.read(32,timeout=10)
-                bits = BitArray(bytes=self.cipher.decrypt(raw))
             except usb.USBError as e:
                 if e.errno == 110:
-                    raise EPOCTurnedOffError("Make sure that headset is turned on")
+                    stats.timeouts += 1
+                    now = clock()
+                    if now - lastRead > self.offTimeout:
+                        raise EPOCTurnedOffError("Make sure that headset is turned on")
+                    # maxLatency holds while no packet comes in
+                    if self.batcher.expired(now):
+                        self._flush()
                 else:
-                    raise EPOCUSBError("USB I/O error with errno = %d" % usb_exception.errno)
+                    raise EPOCUSBError("USB I/O error with errno = %d" % e.errno)
             else:
-                # Counter / Battery
-                if bits[0]:
-                    self.battery = self.battery_levels[bits[0:8].uint]
-                else:
-                    self.counter = bits[0:8].uint
-                    ## Connection quality available with counters
-                    try:
-                        self.quality[self.cqOrder[self.counter]] = bits[107:121].uint
-                        #print(self.quality[self.cqOrder[self.counter]])
-                    except KeyError:
-                        pass
-
-                    #signal
-                    self.sample_buffer[0][CH_F3] = bits[8:22].uint
-                    self.sample_buffer[0][CH_FC5] = bits[22:36].uint
-                    self.sample_buffer[0][CH_AF3] = bits[36:50].uint
-                    self.sample_buffer[0][CH_F7] = bits[50:64].uint
-                    self.sample_buffer[0][CH_T7] = bits[64:78].uint
-                    self.sample_buffer[0][CH_P7] = bits[78:92].uint
-                    self.sample_buffer[0][CH_O1] = bits[92:106].uint
-                    self.sample_buffer[0][CH_O2] = bits[134:148].uint
-                    self.sample_buffer[0][CH_P8] = bits[148:162].uint
-                    self.sample_buffer[0][CH_T8] = bits[162:176].uint
-                    self.sample_buffer[0][CH_F8] = bits[176:190].uint
-                    self.sample_buffer[0][CH_AF4] = bits[190:204].uint
-                    self.sample_buffer[0][CH_FC6] = bits[204:218].uint
-                    self.sample_buffer[0][CH_F4] = bits[218:232].uint
-
-                    ## Gyroscope
-                    self.gyroX = bits[233:240].uint - 106
-                    self.gyroY = bits[240:248].uint - 106
-
-                    # we put a 4 element dict in the msg queue
-                    self.msg_queue.put({'signal':self.sample_buffer[0],
-                                        'gyro':(self.gyroX,self.gyroY),
-                                        'battery':self.battery,
-                                        'quality':self.quality})
+                lastRead = clock()
+                if timed:
+                    stats.readWait.add(lastRead - start)
+                stats.packets += 1
+                if self.batcher.add(raw, lastRead):
+                    self._flush()
+
+    def _runReadAhead(self):
+        # The endpoint is read by a thread of its own (see epoc_readahead), which
+        # keeps reading while we decode or feed slow subscribers; we take
+        # whatever it read since our last pass
+        import usb
+        reader = ReadAheadEndpoint(self.device, self.readAhead, self.stats)
+        reader.start()
+        lastRead = hostClock()
+        try:
+            while self.is_running==True:
+                # Wake up in time for maxLatency
+                timeout = 0.1
+                left = self.batcher.timeLeft()
+                if left is not None:
+                    timeout = max(0.0, min(timeout, left))
+                try:
+                    raw, readTimes = reader.readBatch(timeout=timeout)
+                except usb.USBError as e:
+                    raise EPOCUSBError("USB I/O error with errno = %d" % e.errno)
+                if len(readTimes):
+                    lastRead = readTimes[-1]
+                    if self.batcher.extend(raw, readTimes):
+                        self._flush()
+                    continue
+                now = hostClock()
+                if now - lastRead > self.offTimeout:
+                    raise EPOCTurnedOffError("Make sure that headset is turned on")
+                if self.batcher.expired(now):
+                    self._flush()
+        finally:
+            reader.stop()
+
+    def _flush(self):
+        """Decrypt, decode and publish the pending batch. One batch in
+        stats.sampleEvery is timed stage by stage."""
+        stats = self.stats
+        timed = not stats.batches % stats.sampleEvery
+        stats.batches += 1
+        if timed:
+            clock = hostClock
+            t0 = clock()
+        plain, readTimes = self.batcher.decrypt(self.cipher)
+        if timed:
+            t1 = clock()
+        block = self.decoder.decode(plain, readTimes)
+        self.ring.publishStatus(self.decoder.battery, self.decoder.quality)
+        if timed:
+            t2 = t3 = clock()
+        if self.signalFilter is not None:
+            block = block._replace(signal=self.signalFilter(block.signal))
+            if timed:
+                t3 = clock()
+        self.ring.write(block)
+        for subscription in self.subscriptions:
+            subscription.deliver()
+        if timed:
+            t4 = clock()
+            stats.decrypt.add(t1 - t0)
+            stats.decode.add(t2 - t1)
+            if self.signalFilter is not None:
+                stats.filter.add(t3 - t2)
+            stats.publish.add(t4 - t3)
+            if self.cursor is not None:
+                stats.backlog.add(self.ring.head - self.cursor.position)
+
+    @property
+    def battery(self):
+        return self.decoder.battery
+
+    @property
+    def quality(self):
+        """Latest contact quality of every electrode."""
+        return dict(zip(CHANNEL_NAMES, self.decoder.quality.tolist()))
+
+    @property
+    def sampleRate(self):
+        """Sampling rate of the headset as estimated by the sample clock."""
+        return self.decoder.clock.rate
+
 class EmotivDevice(object):
 
     # These seem to be the same for every device
 
-    INTERFACE_DESC = "Emotiv RAW DATA"
-    MANUFACTURER_DESC = "Emotiv Systems Pty Ltd"
-    __slots__=("_packetLoss","_counter","_battery","_quality","_gyro", "_signal", "_msg_q", "_device",
-               "_serial", "_key", "_cipher", "_ac_thread")
+    INTERFACE_DESC = INTERFACE_DESC
+    MANUFACTURER_DESC = MANUFACTURER_DESC
+    __slots__=("_counter","_battery","_quality","_gyro", "_signal", "_ring", "_cursor",
+               "_gyroCursor", "_qualityCursor", "_device", "_serial", "_key", "_cipher",
+               "_ac_thread")
 
-    def __init__(self, serialNumber=None):
+    def __init__(self, serialNumber=None, batchSize=1, maxLatency=None, bufferSize=4096,
+                 transport=None, fillGaps=False, signalFilter=None, signalFormat="float",
+                 overflow=DROP_OLDEST, backlogLimit=None, readAhead=None):
 
         # Any attributes of the class that can / should have the same
         # value across instances of the class should be moved
@@ -154,133 +222,295 @@ class EmotivDevice(object):
 
         # All the recoding specific code has been moved to
         # EmotivDataAcquisitionThread class
-        # EmotivDevice scans for the device, defines queues, starts the acquisition thread and gets
-        # the data from it in a non-blocking way
+        # EmotivDevice scans for the device, defines the sample buffer, starts the acquisition
+        # thread and gets the data from it in a non-blocking way
+        # bufferSize is the number of samples kept (4096 is 32 seconds at 128Hz).
+        # overflow is what the getters lose when they fall more than backlogLimit
+        # samples behind, one of the epoc_buffer policies: DROP_OLDEST (default),
+        # DROP_NEWEST, LATEST (only the freshest samples) or BLOCK_WRITER (nothing,
+        # the acquisition thread waits, see SampleRingBuffer.blockTimeout). See
+        # getBufferStats() for what was lost. DROP_NEWEST and BLOCK_WRITER hold
+        # the acquisition thread back, and so subscribers and readers, until the
+        # getters catch up: they need a program which keeps polling, and
+        # closeReaders() once it stops.
+        # batchSize / maxLatency control how many raw reads the thread decrypts and decodes
+        # at once; the default of 1 keeps the per packet latency.
+        # transport replaces the USB scan, e.g. epoc_sim.SimulatedTransport() to run
+        # without a headset.
+        # fillGaps inserts a NaN sample for every lost packet, so that samples stay
+        # evenly spaced in time; lost packets are counted either way.
+        # signalFilter, e.g. epoc_filter.SosFilter(epoc_filter.designSos()), filters the
+        # signal once in the acquisition thread, before it is buffered.
+        # signalFormat is one of epoc_decoder.SIGNAL_FORMATS: "float" (raw values as
+        # float64), "raw" (uint16), "centered" (int16) or "microvolts" (float32); the
+        # last three take a quarter of the memory. Filters need a float format.
+        # readAhead, True or a queue size in packets (1024, 8 seconds, for True),
+        # keeps packets read by a thread which does nothing else, so that no packet
+        # is lost while the acquisition thread decodes or feeds slow subscribers;
+        # see epoc_readahead.
+        dtype = signalDtype(signalFormat)
+        if signalFilter is not None and dtype.kind != "f":
+            raise ValueError("signalFilter needs a floating point signal format")
 
         # Acquired data
-        self._packetLoss = 0
         self._counter = 0
         self._battery = 0
         self._gyro = 0
         self._signal = []
         self._quality = []
 
-        # Queue
-        self._msg_q = Queue()
+        # Sample buffer
+        self._ring = SampleRingBuffer(bufferSize, signalDtype=dtype)
+        # The gyroscope and the per sample contact quality are read as streams
+        # of their own, with their own cursors; everything else (signal,
+        # getSamples() ...) goes through self._cursor. Only the latter may hold
+        # the writer back.
+        self._cursor = self._ring.openCursor(overflow, backlogLimit)
+        if overflow in (BLOCK_WRITER, DROP_NEWEST):
+            self._gyroCursor = self._ring.openCursor()
+            self._qualityCursor = self._ring.openCursor()
+        else:
+            self._gyroCursor = self._ring.openCursor(overflow, backlogLimit)
+            self._qualityCursor = self._ring.openCursor(overflow, backlogLimit)
 
         # Initialize device
-        self._enumerate()
+        if transport is None:
+            self._enumerate(serialNumber)
+        else:
+            self._serial, self._device = transport.open(serialNumber)
         self._setupEncryption()
         # acquisition thread
-        self._ac_thread=EmotivDataAcquisitionThread(self._msg_q, self._device, self._cipher)
-
-    def _is_emotiv_epoc(self, device):
-        """Custom match function for libusb."""
-        try:
-            manu = usb.util.get_string(device, len(self.MANUFACTURER_DESC),
-                                       device.iManufacturer)
-        except usb.core.USBError, ue:
-            # Skip failing devices as it happens on Raspberry Pi
-            if ue.errno == 32:
-                return False
-            elif ue.errno == 13:
-                pass
-        else:
-            if manu == self.MANUFACTURER_DESC:
-                # Found a dongle, check for interface class 3
-                for interf in device.get_active_configuration():
-                    ifStr = usb.util.get_string(device, len(self.INTERFACE_DESC),
-                                                interf.iInterface)
-                    if ifStr == self.INTERFACE_DESC:
-                        return True
-
-    def _enumerate(self):
-        """Scans the usb system for the device"""
-        devs = usb.core.find(find_all=True, custom_match=self._is_emotiv_epoc)
-
-        if not devs:
-            raise EmotivEPOCNotFoundException("No plugged Emotiv EPOC")
-
-        for dev in devs:
-            sn = usb.util.get_string(dev, 32, dev.iSerialNumber)
-            cfg = dev.get_active_configuration()
-
-            for interf in dev.get_active_configuration():
-                if dev.is_kernel_driver_active(interf.bInterfaceNumber):
-                    # Detach kernel drivers and claim through libusb
-                    dev.detach_kernel_driver(interf.bInterfaceNumber)
-                    usb.util.claim_interface(dev, interf.bInterfaceNumber)
-
-            # 2nd interface is the one we need
-            self._device = usb.util.find_descriptor(interf,
-                                 bEndpointAddress=usb.ENDPOINT_IN|2)
-            self._serial = sn
-            break
+        self._ac_thread=EmotivDataAcquisitionThread(self._ring, self._device, self._cipher,
+                                                     batchSize, maxLatency, fillGaps,
+                                                     self._cursor, signalFilter=signalFilter,
+                                                     signalFormat=signalFormat,
+                                                     readAhead=readAhead)
+
+    @classmethod
+    def listSerialNumbers(cls):
+        """Serial numbers of every plugged dongle, e.g. to open them all with
+        epoc_group.EmotivDeviceGroup."""
+        return [sn for sn, dev in findDongles()]
+
+    @classmethod
+    def watchDongles(cls, callback, interval=1.0):
+        """Call callback(added, removed) with the serial numbers of the
+        dongles plugged and unplugged, rescanning the bus every interval
+        seconds in the background. Returns the epoc_usb.DongleMonitor, call
+        its stop() method to end it."""
+        monitor = DongleMonitor(callback, interval)
+        monitor.start()
+        return monitor
+
+    def _enumerate(self, serialNumber=None):
+        """Scans the usb system for the device, the first one unless a serial
+        number is given"""
+        found = openDongle(serialNumber)
+        if found is None:
+            raise EPOCNotFoundError("No plugged Emotiv EPOC %s" % (serialNumber or ""))
+        self._serial, self._device = found
 
     def _setupEncryption(self, research=True):
         """Generate the encryption key and setup Crypto module.
         The key is based on the serial number of the device and the
         information whether it is a research or consumer device.
         """
-        if research:
-            self._key = ''.join([self._serial[15], '\x00',
-                                self._serial[14], '\x54',
-                                self._serial[13], '\x10',
-                                self._serial[12], '\x42',
-                                self._serial[15], '\x00',
-                                self._serial[14], '\x48',
-                                self._serial[13], '\x00',
-                                self._serial[12], '\x50'])
-        else:
-            self._key = ''.join([self._serial[15], '\x00',
-                                self._serial[14], '\x48',
-                                self._serial[13], '\x00',
-                                self._serial[12], '\x54',
-                                self._serial[15], '\x10',
-                                self._serial[14], '\x42',
-                                self._serial[13], '\x00',
-                                self._serial[12], '\x50'])
-
-        self._cipher = AES.new(self._key)
+        self._key = dongleKey(self._serial, research)
+        self._cipher = newCipher(self._serial, research)
 
 
     def startAcuisition(self):
+        if self._ac_thread.ident is not None and not self._ac_thread.is_alive():
+            # A thread runs once only, after stopAcquisition() a new one takes over
+            self._ac_thread = self._ac_thread.restart()
         self._ac_thread.start()
 
+    def stopAcquisition(self, timeout=1.0):
+        """Ask the acquisition thread to stop and wait for it to exit."""
+        self._ac_thread.is_running = False
+        if self._ac_thread.is_alive():
+            self._ac_thread.join(timeout)
+
     def getSignal(self):
-        try:
-            sig = self._msg_q.get(block=False)['signal']
-            return sig
-        except Empty:
-            return None
+        """Returns the next sample of the signal, None if there is none."""
+        signal, = self._ring.readFields(self._cursor, ("signal",), 1)
+        if len(signal):
+            return signal[0]
+        return None
 
     def getGyro(self):
-        try:
-            sig = self._msg_q.get(block=False)['gyro']
-            return sig
-        except Empty:
-            return None
+        """Returns the next (x, y) gyroscope sample, None if there is none.
+        The gyroscope has its own cursor: reading it does not consume signal
+        samples and vice versa."""
+        gyro, = self._ring.readFields(self._gyroCursor, ("gyro",), 1)
+        if len(gyro):
+            return tuple(gyro[0].tolist())
+        return None
+
+    def getStatus(self):
+        """Returns the latest epoc_buffer.DeviceStatus: battery level and
+        contact quality of every electrode, with sequence numbers telling
+        whether they changed since the previous call. Consumes no sample."""
+        return self._ring.status()
 
     def getContactQuality(self):
-        try:
-            sig = self._msg_q.get(block=False)['quality']
-            return sig
-        except Empty:
-            return None
+        """Returns the latest contact quality of every electrode."""
+        return dict(zip(CHANNEL_NAMES, self._ring.status().quality.tolist()))
 
     def getBatteryLevel(self):
         """Returns the battery level."""
-        try:
-            sig = self._msg_q.get(block=False)['battery']
-            return sig
-        except Empty:
-            return None
+        return self._ring.status().battery
+
+    def getStats(self):
+        """Snapshot of the acquisition loop instrumentation (see epoc_stats)."""
+        return self._ac_thread.stats.snapshot()
+
+    def startStatsReporter(self, interval=10.0, report=None):
+        """Print (or pass to report(snapshot, previous)) the acquisition
+        statistics every interval seconds. Returns the StatsReporter, call
+        its stop() method to end it."""
+        reporter = StatsReporter(self._ac_thread.stats, interval, report)
+        reporter.start()
+        return reporter
+
+    def getPacketLoss(self):
+        """Returns the number of packets lost since the acquisition started."""
+        return self._ac_thread.decoder.loss.lost
+
+    def getLossRate(self, window=CYCLE):
+        """Returns the fraction of the last `window` packets (one second by
+        default) which were lost."""
+        return self._ac_thread.decoder.loss.rate(window)
+
+    def getBufferStats(self):
+        """Returns what the getters lost to the overflow policy: samples
+        overwritten by the acquisition thread and dropped by the policy, the
+        largest backlog seen, and the writes which waited for a BLOCK_WRITER
+        reader (stalls)."""
+        return self._ring.cursorStats(self._cursor)
+
+    def openReader(self, overflow=DROP_OLDEST, backlogLimit=None):
+        """Returns a new epoc_buffer.RingReader: an independent consumer of
+        every sample acquired from now on, with its own overflow policy and
+        counters. The getters of this class are one such consumer; readers
+        do not take samples from them nor from each other."""
+        return RingReader(self._ring, overflow, backlogLimit)
+
+    def getSampleRate(self):
+        """Returns the actual sampling rate of the headset (nominally 128Hz)."""
+        return self._ac_thread.sampleRate
+
+    def getSamples(self, max_n=None):
+        """Return every pending sample (at most max_n) with all its columns,
+        as a SampleBlock."""
+        return self._ring.read(self._cursor, max_n)
+
+    def getSignals(self, max_n=None):
+        """Return every pending sample (at most max_n) in one call as
+        (signals (n,14), counters (n,), timestamps (n,)) arrays, n may be 0.
+        Timestamps are drift corrected host clock times (see epoc_clock)."""
+        return tuple(self._ring.readFields(self._cursor, ("signal", "counter", "timestamp"),
+                                           max_n))
+
+    def getGyros(self, max_n=None):
+        """Like getSignals(), with the (n,2) gyroscope values, read through
+        the gyroscope's own cursor."""
+        return tuple(self._ring.readFields(self._gyroCursor, ("gyro", "counter", "timestamp"),
+                                           max_n))
+
+    def getContactQualities(self, max_n=None):
+        """Like getSignals(), with the contact quality value of each sample,
+        read through a cursor of its own. The electrode it belongs to is
+        epoc_decoder.QUALITY_CHANNELS[counter]."""
+        return tuple(self._ring.readFields(self._qualityCursor,
+                                           ("quality", "counter", "timestamp"), max_n))
+
+    def wait_for_samples(self, n=1, timeout=None):
+        """Sleep until n samples are pending. Returns False if timeout
+        seconds passed first."""
+        return self._ring.wait(self._cursor, n, timeout)
+
+    def subscribe(self, callback, batch_size=1, fields=None):
+        """Call callback(SampleBlock) from the acquisition thread with every
+        batch_size new samples, or callback(*arrays) with the arrays of the
+        SampleBlock fields named in `fields` (reused from one call to the
+        next). Subscribers have their own position in the buffer, so they do
+        not take samples from the getters.
+        Returns the Subscription to pass to unsubscribe()."""
+        subscription = Subscription(self._ring, callback, batch_size, fields)
+        self._ac_thread.subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop feeding the subscription. Returns once a callback running in
+        the acquisition thread has returned, so the subscription's cursor and
+        whatever its callback writes to can then be used safely."""
+        subscription.cancel()
+        self._ac_thread.subscriptions = tuple(s for s in self._ac_thread.subscriptions
+                                              if s is not subscription)
+
+    def _recordSignalDtype(self):
+        """Signal dtype of recordings: that of the buffer, unless it holds the
+        unaltered raw values in float64, which are recorded in 16 bits."""
+        dtype = self._ring.signalDtype
+        if (dtype == np.float64 and self._ac_thread.signalFilter is None and
+                not self._ac_thread.decoder.fillGaps):
+            return "<u2"
+        return dtype
+
+    def startRecording(self, path, batch_size=32, **recorderArgs):
+        """Record every sample from now on to `path` (see epoc_record), written
+        from the acquisition thread batch_size samples at a time. Returns the
+        SessionRecorder to pass to stopRecording()."""
+        from epoc_record import SessionRecorder
+        recorderArgs.setdefault("signalDtype", self._recordSignalDtype())
+        recorder = SessionRecorder(path, **recorderArgs)
+        recorder.subscription = self.subscribe(recorder.write, batch_size)
+        return recorder
+
+    def stopRecording(self, recorder):
+        """Detach the recorder, write what it buffered and close it. Samples
+        of an incomplete batch are written too."""
+        self.unsubscribe(recorder.subscription)
+        recorder.write(self._ring.read(recorder.subscription.cursor))
+        recorder.close()
+
+    def startBandPower(self, callback, window=256, hop=32, **bandPowerArgs):
+        """Call callback(timestamp, power) from the acquisition thread every hop
+        samples with the (bands, 14) power of the last window samples (see
+        epoc_bandpower). Returns the BandPower to pass to stopBandPower()."""
+        from epoc_bandpower import BandPower
+        bandPower = BandPower(window=window, hop=hop, callback=callback, **bandPowerArgs)
+        # Only the signal and the timestamps are copied, into the same arrays
+        # every hop
+        bandPower.subscription = self.subscribe(bandPower.process, hop,
+                                                fields=("signal", "timestamp"))
+        return bandPower
+
+    def stopBandPower(self, bandPower):
+        self.unsubscribe(bandPower.subscription)
+
+    def stream(self, batch_size=1, max_pending=256, stop_acquisition=True):
+        """Asynchronous iterator over SampleBlocks of batch_size samples, for
+        use from an asyncio event loop (Python 3.5+):
+
+            async with device.stream(batch_size=8) as stream:
+                async for block in stream:
+                    ...
+
+        See epoc_aio.SampleStream for the buffering and cancellation rules."""
+        from epoc_aio import SampleStream
+        return SampleStream(self, batch_size, max_pending, stop_acquisition)
+
+    def closeReaders(self):
+        """Stop the cursors of the getters from holding the acquisition
+        thread back (see overflow). The getters keep working, losing the
+        oldest samples when they fall behind."""
+        for cursor in (self._cursor, self._gyroCursor, self._qualityCursor):
+            self._ring.closeCursor(cursor)
 
     def disconnect(self):
         """Release the claimed interfaces."""
-
-        for dev in self.devices.values():
-            cfg = dev.get_active_configuration()
-
-            for interf in dev.get_active_configuration():
-                usb.util.release_interface(dev, interf.bInterfaceNumber)
+        self.closeReaders()
+        # Nothing to release for a simulated dongle
+        releaseDongle(self._serial)
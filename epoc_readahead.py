@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Read ahead of the decoder, from a thread of its own.
+
+The dongle only holds a few packets. When the acquisition loop issues one
+synchronous read at a time, every hiccup between two reads (a slow
+subscriber, a garbage collection, the decode of a large batch) leaves no
+transfer pending and packets are lost once the dongle's buffer is full.
+
+ReadAheadEndpoint runs a thread which does nothing but read the endpoint
+and copy the raw packets, with their read time, into a preallocated ring.
+A new transfer is issued as soon as the previous one completes, whatever
+the consumer is doing, and the consumer takes everything read so far in
+one readBatch() call, ready to be decrypted and decoded at once. pyusb
+offers no asynchronous transfers, so there is one transfer in flight at a
+time; the ring is what absorbs the stalls of the consumer.
+
+Packets arriving while the ring is full are dropped and counted
+(overruns); USB errors other than timeouts stop the thread and are raised
+by the next readBatch().
+"""
+
+import threading
+
+import numpy as np
+
+from epoc_decoder import PACKET_SIZE, hostClock
+
+# Default queue size, in packets: 8 seconds at 128Hz
+READ_AHEAD = 1024
+
+class ReadAheadEndpoint(threading.Thread):
+    """Thread reading `endpoint` into a ring of `capacity` packets. Read
+    waits and timeouts are recorded in `stats` (an
+    epoc_stats.AcquisitionStats) when one is given."""
+
+    def __init__(self, endpoint, capacity=READ_AHEAD, stats=None, timeout=10):
+        threading.Thread.__init__(self, name="ReadAhead")
+        self.daemon = True
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.endpoint = endpoint
+        self.capacity = capacity
+        self.stats = stats
+        # USB read timeout, in milliseconds
+        self.timeout = timeout
+        self.overruns = 0
+        self.error = None
+        self._packets = np.zeros((capacity, PACKET_SIZE), dtype=np.uint8)
+        self._readTimes = np.zeros(capacity)
+        # Written by this thread only
+        self._head = 0
+        # Written by the consumer only
+        self._tail = 0
+        self._running = True
+        self._cond = threading.Condition()
+        self._waiting = False
+
+    @property
+    def pending(self):
+        """Packets read but not taken by readBatch() yet."""
+        return self._head - self._tail
+
+    def run(self):
+        import usb
+        stats = self.stats
+        clock = hostClock
+        try:
+            while self._running:
+                # One read in sampleEvery is timed
+                timed = stats is not None and not stats.packets % stats.sampleEvery
+                if timed:
+                    start = clock()
+                try:
+                    raw = self.endpoint.read(PACKET_SIZE, timeout=self.timeout)
+                except usb.USBError as e:
+                    if e.errno == 110:
+                        if stats is not None:
+                            stats.timeouts += 1
+                        continue
+                    self.error = e
+                    break
+                now = clock()
+                if stats is not None:
+                    if timed:
+                        stats.readWait.add(now - start)
+                    stats.packets += 1
+                if self._head - self._tail >= self.capacity:
+                    self.overruns += 1
+                    if stats is not None:
+                        stats.overruns += 1
+                    continue
+                i = self._head % self.capacity
+                self._packets[i] = np.frombuffer(raw, dtype=np.uint8)
+                self._readTimes[i] = now
+                # Publish the packet, then look for a sleeping consumer
+                self._head += 1
+                if self._waiting:
+                    with self._cond:
+                        self._cond.notify()
+        finally:
+            self._running = False
+            with self._cond:
+                self._cond.notify()
+
+    def readBatch(self, maxCount=None, timeout=None):
+        """Take the packets read so far (at most maxCount), waiting up to
+        `timeout` seconds (None for ever) for at least one. Returns the raw
+        bytes of the packets and their read times, empty after a timeout."""
+        if self._head == self._tail and self._running:
+            with self._cond:
+                self._waiting = True
+                try:
+                    if self._head == self._tail and self._running:
+                        self._cond.wait(timeout)
+                finally:
+                    self._waiting = False
+        head = self._head
+        tail = self._tail
+        n = head - tail
+        if not n and self.error is not None:
+            raise self.error
+        if maxCount is not None:
+            n = min(n, maxCount)
+        i = tail % self.capacity
+        first = min(n, self.capacity - i)
+        if first < n:
+            raw = (self._packets[i:].tobytes() + self._packets[:n - first].tobytes())
+            readTimes = np.concatenate((self._readTimes[i:], self._readTimes[:n - first]))
+        else:
+            raw = self._packets[i:i + n].tobytes()
+            readTimes = self._readTimes[i:i + n].copy()
+        self._tail = tail + n
+        return raw, readTimes
+
+    def stop(self, timeout=1.0):
+        """Stop reading and wait for the thread to exit."""
+        self._running = False
+        if self.is_alive():
+            self.join(timeout)
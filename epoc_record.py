@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Append only binary session recordings.
+
+A recording is a .npy file of fixed width records (see recordDtype), one
+per sample (44 bytes with 16 bit signal values, at 128Hz ~20MB per hour;
+readers take the layout from the file header), next to a sparse time index
+in <path>.idx: the timestamp and position of every `indexInterval`-th
+sample. Both are regular .npy files that np.load(..., mmap_mode='r') can
+open, and the sample count can always be recovered from the file size if a
+session ends without close().
+
+SessionRecorder is fed with SampleBlocks, typically by subscribing it to
+the acquisition thread (EmotivDevice.startRecording). Samples are gathered
+in a preallocated record array and written `flushSize` at a time, so the
+acquisition thread only pays for a column copy per batch and an occasional
+large write.
+
+sampleAtTime() finds the first sample at or after a time with a binary
+search of the index, then of one index interval of the recording.
+SessionReader uses it to hand out windows of long recordings by time or
+sample position.
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from epoc_decoder import CHANNEL_NAMES
+
+def recordDtype(signalDtype="<u2"):
+    """Record layout with the signal stored as `signalDtype`."""
+    return np.dtype([("counter", "u1"),
+                     ("battery", "i1"),
+                     ("quality", "<u2"),
+                     ("gyro", "<i2", (2,)),
+                     ("timestamp", "<f8"),
+                     ("signal", np.dtype(signalDtype).newbyteorder("<"),
+                      (len(CHANNEL_NAMES),))])
+
+# Raw 14 bit values, whatever the signal format of the device
+RECORD_DTYPE = recordDtype()
+
+INDEX_DTYPE = np.dtype([("timestamp", "<f8"), ("sample", "<i8")])
+
+def npyHeader(dtype, count):
+    """Header of a .npy file holding `count` records of `dtype`.
+
+    The count is padded to a fixed width, so the header keeps its size and
+    can be rewritten in place once the final count is known. np.load (with
+    mmap_mode too) reads the result as a regular .npy file.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%20d,), }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), count)
+    # magic (6) + version (2) + header length (2), total aligned on 64 bytes
+    size = (10 + len(header) + 1 + 63) // 64 * 64
+    header = header.ljust(size - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin-1")
+
+def indexPath(path):
+    return path + ".idx"
+
+class _RecordFile(object):
+    """An append only .npy file of `dtype` records."""
+
+    def __init__(self, path, dtype):
+        self.dtype = dtype
+        self.count = 0
+        self._file = open(path, "wb")
+        self._file.write(npyHeader(dtype, 0))
+
+    def append(self, records):
+        self._file.write(records.tobytes())
+        self.count += len(records)
+
+    def close(self):
+        """Write the final count in the header and close."""
+        self._file.seek(0)
+        self._file.write(npyHeader(self.dtype, self.count))
+        self._file.close()
+
+class SessionRecorder(object):
+    """Write SampleBlocks to a recording at `path`, the signal as
+    `signalDtype` (raw values as 16 bit integers by default)."""
+
+    def __init__(self, path, indexInterval=128, flushSize=1024, signalDtype="<u2"):
+        self.path = path
+        self.indexInterval = indexInterval
+        dtype = recordDtype(signalDtype)
+        self._records = _RecordFile(path, dtype)
+        self._index = _RecordFile(indexPath(path), INDEX_DTYPE)
+        self._buffer = np.zeros(flushSize, dtype=dtype)
+        self._fill = 0
+        self.closed = False
+
+    @property
+    def count(self):
+        """Samples recorded so far."""
+        return self._records.count + self._fill
+
+    def write(self, block):
+        """Append the samples of a SampleBlock."""
+        n = len(block.counter)
+        done = 0
+        while done < n:
+            take = min(n - done, len(self._buffer) - self._fill)
+            rows = self._buffer[self._fill:self._fill + take]
+            rows["counter"] = block.counter[done:done + take]
+            rows["battery"] = block.battery[done:done + take]
+            rows["quality"] = block.quality[done:done + take]
+            rows["gyro"] = block.gyro[done:done + take]
+            rows["timestamp"] = block.timestamp[done:done + take]
+            rows["signal"] = block.signal[done:done + take]
+            self._fill += take
+            done += take
+            if self._fill == len(self._buffer):
+                self.flush()
+
+    __call__ = write
+
+    def flush(self):
+        """Write the buffered samples and their index entries."""
+        if not self._fill:
+            return
+        first = self._records.count
+        rows = self._buffer[:self._fill]
+        # Index every indexInterval-th sample of the session
+        offsets = np.arange(-first % self.indexInterval, self._fill,
+                            self.indexInterval)
+        if len(offsets):
+            entries = np.empty(len(offsets), dtype=INDEX_DTYPE)
+            entries["timestamp"] = rows["timestamp"][offsets]
+            entries["sample"] = first + offsets
+            self._index.append(entries)
+        self._records.append(rows)
+        self._fill = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self._records.close()
+        self._index.close()
+        self.closed = True
+
+def openRecords(path):
+    """Memory map the records of a .npy recording, counting them from the
+    file size so that a recording which was not closed can be read too."""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+def sampleAtTime(records, index, t):
+    """Position of the first sample recorded at or after `t`.
+
+    `records` and `index` are the arrays returned by openRecords() for a
+    recording and its index; O(log n) as only one index interval of the
+    recording is searched.
+    """
+    if not len(records):
+        return 0
+    if len(index):
+        i = int(np.searchsorted(index["timestamp"], t, side="left"))
+        lo = int(index["sample"][i - 1]) if i > 0 else 0
+        hi = int(index["sample"][i]) + 1 if i < len(index) else len(records)
+    else:
+        lo, hi = 0, len(records)
+    return lo + int(np.searchsorted(records["timestamp"][lo:hi], t, side="left"))
+
+class SessionReader(object):
+    """Random access to a recording without loading it.
+
+    The recording and its index are memory mapped, so opening a multi
+    gigabyte session is instant and only the pages of the windows that are
+    asked for are read. Samples are returned as views of the mapping:
+
+        reader = SessionReader("session.npy")
+        eeg = reader.timeRange(120.0, 125.0, channels=["O1", "O2"])
+
+    `channels` takes names from CHANNEL_NAMES (or indexes); a single channel
+    or a run of neighbouring channels in CH_* order stays a view, any other
+    subset is copied by NumPy's fancy indexing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = openRecords(path)
+        if os.path.exists(indexPath(path)):
+            self.index = openRecords(indexPath(path))
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self):
+        return self.records["timestamp"]
+
+    def _channels(self, channels):
+        if channels is None:
+            return slice(None)
+        if isinstance(channels, (str, int)):
+            channels = [channels]
+        idx = [CHANNEL_NAMES.index(c) if isinstance(c, str) else int(c)
+               for c in channels]
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            return slice(idx[0], idx[0] + len(idx))
+        return idx
+
+    def sampleRange(self, start, stop, channels=None):
+        """Signal (n, channels) of the samples start to stop."""
+        return self.records["signal"][start:stop][:, self._channels(channels)]
+
+    def recordRange(self, start, stop):
+        """Every field (counter, timestamp, gyro, ...) of the samples start to
+        stop, as a view of the records."""
+        return self.records[start:stop]
+
+    def timeRange(self, t0, t1, channels=None):
+        """Signal of the samples recorded in [t0, t1)."""
+        start, stop = self.timeToSample(t0), self.timeToSample(t1)
+        return self.sampleRange(start, stop, channels)
+
+    def timeToSample(self, t):
+        """Position of the first sample recorded at or after `t`."""
+        return sampleAtTime(self.records, self.index, t)
+
+    def windows(self, size, step=None, channels=None, start=0, stop=None):
+        """Lazily yield (first sample, signal view) for consecutive windows
+        of `size` samples, `step` samples apart (size by default)."""
+        step = step or size
+        stop = len(self.records) if stop is None else min(stop, len(self.records))
+        for first in range(start, stop - size + 1, step):
+            yield first, self.sampleRange(first, first + size, channels)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Simulated Emotiv EPOC dongle for runs and benchmarks without a headset.
+
+SimulatedEndpoint stands in for the USB IN endpoint the device classes read
+from: read(32, timeout) returns a properly AES encrypted packet, with the
+counter wrapping from 127 to a battery packet and back to 0, exactly as the
+dongle sends them. Samples come either from a synthetic generator or from a
+recording: an (n, 14) array or the path of a text dump like
+output_signal_with_timestamps.
+
+With realtime=True packets are paced at `rate` Hz and a read which would
+wait longer than its timeout fails with the same USBError (errno 110) as
+libusb; with realtime=False packets are returned as fast as they are asked
+for, which is what the benchmarks want.
+
+The real dongle only holds a few packets for the host: with realtime=True
+and `dongleBuffer` set, the packets which fell due more than dongleBuffer
+packets before a read are lost (counted in `dropped`), so that a stalled
+reader loses packets the way it would with a headset.
+
+A transport is what the device classes use to find their endpoint:
+
+    emotiv = EmotivDevice(transport=SimulatedTransport())
+"""
+
+import array
+import time
+
+import numpy as np
+
+from epoc_decoder import (CHANNEL_NAMES, CYCLE, PACKET_SIZE, QUALITY_CHANNELS,
+                          batteryByte, encodePackets, hostClock)
+from epoc_dump import loadDump
+from epoc_usb import newCipher
+
+DEFAULT_SERIAL = "SN20130116000287"
+
+# Packets generated and encrypted at once
+_CHUNK = 1032
+
+def syntheticSignal(count, start=0, rate=128.0, seed=0):
+    """Raw ADC values (count, 14) around the ~8000 DC offset of the
+    headset: a per channel offset, a 10Hz alpha rhythm and noise."""
+    rng = np.random.RandomState(seed + start)
+    offsets = np.random.RandomState(seed).randint(7400, 9000, len(CHANNEL_NAMES))
+    t = (start + np.arange(count)) / rate
+    alpha = 40.0 * np.sin(2 * np.pi * 10.0 * t)[:, None]
+    noise = rng.normal(0, 8.0, (count, len(CHANNEL_NAMES)))
+    return np.clip(np.round(offsets + alpha + noise), 0, (1 << 14) - 1)
+
+class SimulatedEndpoint(object):
+    """Stand in for the dongle's USB IN endpoint."""
+
+    def __init__(self, serialNumber=DEFAULT_SERIAL, source=None, rate=128.0,
+                 realtime=True, research=True, battery=100, seed=0, dongleBuffer=None):
+        self.serialNumber = serialNumber
+        self.rate = float(rate)
+        self.realtime = realtime
+        self.dongleBuffer = dongleBuffer
+        self.battery = battery
+        self.seed = seed
+        if isinstance(source, str):
+            timestamps, source = loadDump(source)
+        self.source = None if source is None else np.asarray(source)
+        self._cipher = newCipher(serialNumber, research)
+        # Next counter slot and sample to encode
+        self._slot = 0
+        self._sample = 0
+        # Encrypted packets not read yet
+        self._packets = b""
+        self._offset = 0
+        # Packets handed out (or lost) and due time of the first one
+        self.sent = 0
+        self.dropped = 0
+        self._start = None
+
+    def _samples(self, count):
+        if self.source is None:
+            return syntheticSignal(count, self._sample, self.rate, self.seed)
+        index = (self._sample + np.arange(count)) % len(self.source)
+        return self.source[index]
+
+    def _generate(self):
+        """Encode and encrypt the next _CHUNK packets."""
+        slots = (self._slot + np.arange(_CHUNK)) % CYCLE
+        isBattery = slots == CYCLE - 1
+        first = np.where(isBattery, batteryByte(self.battery), slots)
+
+        # Battery packets repeat the previous sample, they do not consume one
+        sampleIdx = np.cumsum(~isBattery) - 1
+        samples = self._samples(int(sampleIdx[-1]) + 1)
+        signal = samples[np.maximum(sampleIdx, 0)]
+        quality = np.where(QUALITY_CHANNELS[slots % 128] >= 0, 4000, 0)
+        gyro = np.zeros((_CHUNK, 2), dtype=np.int16)
+
+        plain = encodePackets(first, signal, quality, gyro)
+        self._packets = self._cipher.encrypt(plain.tobytes())
+        self._offset = 0
+        self._slot = int(slots[-1] + 1) % CYCLE
+        self._sample += int(sampleIdx[-1]) + 1
+
+    def _skip(self, count):
+        """Lose the next count packets."""
+        self.sent += count
+        self.dropped += count
+        while count:
+            if self._offset >= len(self._packets):
+                self._generate()
+            skipped = min(count, (len(self._packets) - self._offset) // PACKET_SIZE)
+            self._offset += skipped * PACKET_SIZE
+            count -= skipped
+
+    def _timedOut(self):
+        # pyusb is only needed for the error libusb would raise
+        import usb.core
+        return usb.core.USBError("Operation timed out", errno=110)
+
+    def read(self, size, timeout=None):
+        """Return the next encrypted packet as pyusb does (array of bytes).
+        `timeout` is in milliseconds, 0 or None waits forever."""
+        if self.realtime:
+            now = hostClock()
+            if self._start is None:
+                self._start = now
+            due = self._start + self.sent / self.rate
+            if due > now:
+                if timeout and due - now > timeout / 1000.0:
+                    time.sleep(timeout / 1000.0)
+                    raise self._timedOut()
+                time.sleep(due - now)
+            elif self.dongleBuffer is not None:
+                late = int((now - self._start) * self.rate) + 1 - self.sent - self.dongleBuffer
+                if late > 0:
+                    self._skip(late)
+        if self._offset >= len(self._packets):
+            self._generate()
+        packet = self._packets[self._offset:self._offset + PACKET_SIZE]
+        self._offset += PACKET_SIZE
+        self.sent += 1
+        return array.array('B', packet)
+
+class SimulatedTransport(object):
+    """Transport handing out SimulatedEndpoints instead of USB devices, one
+    per serial number in `serialNumbers`. Keyword arguments are passed to
+    every SimulatedEndpoint; each dongle gets its own seed so that the
+    headsets do not send the same signal."""
+
+    def __init__(self, serialNumbers=(DEFAULT_SERIAL,), **endpointArgs):
+        self.serialNumbers = list(serialNumbers)
+        self.endpointArgs = endpointArgs
+
+    def enumerate(self):
+        """Serial numbers of the simulated dongles."""
+        return list(self.serialNumbers)
+
+    def open(self, serialNumber=None):
+        """Return (serial number, endpoint) of a simulated dongle, the first
+        one unless a serial number is given."""
+        serialNumber = serialNumber or self.serialNumbers[0]
+        args = dict(self.endpointArgs)
+        if serialNumber in self.serialNumbers:
+            args["seed"] = args.get("seed", 0) + self.serialNumbers.index(serialNumber)
+        endpoint = SimulatedEndpoint(serialNumber, **args)
+        return endpoint.serialNumber, endpoint
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Always on instrumentation of the acquisition loop.
+
+The acquisition thread updates plain integer counters and fixed bucket
+histograms as it goes; nothing is allocated and no lock is taken. A
+histogram add() costs 0.4 to 0.7us on Python 3 and about 1.2us on Python 2,
+plus the clock reads around the timed stage: timing every stage of every
+batch of one would cost 4us (12us on Python 2) per sample. So only one
+batch and one packet read in `sampleEvery` (64 by default, twice a second at
+128Hz) is timed; the others cost an integer increment and a test. With
+batches of one this comes to about 0.3us per sample on Python 3 and 0.8us
+on Python 2, which lets the instrumentation stay on permanently.
+
+Histogram buckets are powers of two: bucket i counts the values in
+[2**(low + i - 1), 2**(low + i)), found with math.frexp() instead of a
+search. The first and last reported buckets also count whatever falls
+below or above the range. Percentiles read from a snapshot are the upper edge of the
+bucket they fall in, i.e. at most a factor 2 above the true value.
+
+snapshot() copies everything into a dict which can be logged or sent as
+JSON; StatsReporter does that periodically from its own thread.
+"""
+
+from __future__ import print_function
+
+import math
+import threading
+
+# Histograms count every binary exponent from -64 to 63 (any duration or
+# size the loop can see) so that add() needs no range check
+_EXPONENTS = 128
+_OFFSET = 64
+
+class Histogram(object):
+    """Power of two histogram, reported from 2**(low - 1) to 2**(low + buckets - 1)."""
+    __slots__ = ("low", "buckets", "counts", "total", "max")
+
+    def __init__(self, low, buckets):
+        self.low = low
+        self.buckets = buckets
+        self.counts = [0] * _EXPONENTS
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value, frexp=math.frexp):
+        if value > 0:
+            self.counts[frexp(value)[1] + _OFFSET] += 1
+        else:
+            # frexp(0.0) gives exponent 0, i.e. [0.5, 1): zeros (an empty
+            # backlog, a duration below the clock resolution) go in the first bucket
+            self.counts[0] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def folded(self):
+        """Counts of the reported buckets."""
+        counts = list(self.counts)
+        first = self.low + _OFFSET
+        last = first + self.buckets - 1
+        return ([sum(counts[:first + 1])] + counts[first + 1:last] +
+                [sum(counts[last:])])
+
+    def edges(self):
+        """Upper edge of every bucket."""
+        return [2.0 ** (self.low + i) for i in range(self.buckets)]
+
+    def snapshot(self, percentiles=(50, 99, 99.9)):
+        counts = self.folded()
+        count = sum(counts)
+        result = {"count": count,
+                  "mean": self.total / count if count else 0.0,
+                  "max": self.max,
+                  "buckets": list(zip(self.edges(), counts))}
+        for p in percentiles:
+            result["p%g" % p] = self._percentile(counts, count, p)
+        return result
+
+    def _percentile(self, counts, count, p):
+        if not count:
+            return 0.0
+        rank = p / 100.0 * count
+        seen = 0
+        for edge, n in zip(self.edges(), counts):
+            seen += n
+            if seen >= rank:
+                return min(edge, self.max)
+        return self.max
+
+def durationHistogram():
+    """Durations in seconds, 1us to 4s."""
+    return Histogram(-19, 22)
+
+def countHistogram():
+    """Sizes from 0 to 32768."""
+    return Histogram(0, 16)
+
+class AcquisitionStats(object):
+    """Counters and histograms of one acquisition loop.
+
+    packets:   packets read
+    batches:   batches decrypted and published
+    timeouts:  reads which timed out
+    overruns:  packets dropped because the read-ahead queue was full
+    readWait:  time blocked in the USB read, per packet
+    decrypt, decode, filter, publish:  durations per batch (filter only
+               with a signalFilter, publish is the ring buffer write plus
+               the subscription callbacks)
+    backlog:   samples written but not read yet by the device's getters,
+               after a batch
+
+    Histograms only see one packet (readWait) or batch (the others) in
+    `sampleEvery`; counters see them all.
+    """
+    COUNTERS = ("packets", "batches", "timeouts", "overruns")
+    HISTOGRAMS = ("readWait", "decrypt", "decode", "filter", "publish", "backlog")
+
+    def __init__(self, sampleEvery=64):
+        if sampleEvery < 1:
+            raise ValueError("sampleEvery must be at least 1")
+        self.sampleEvery = sampleEvery
+        self.packets = 0
+        self.batches = 0
+        self.timeouts = 0
+        self.overruns = 0
+        self.readWait = durationHistogram()
+        self.decrypt = durationHistogram()
+        self.decode = durationHistogram()
+        self.filter = durationHistogram()
+        self.publish = durationHistogram()
+        self.backlog = countHistogram()
+
+    def snapshot(self):
+        """Copy of every counter and histogram summary as a dict."""
+        result = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        result["sampleEvery"] = self.sampleEvery
+        for name in self.HISTOGRAMS:
+            result[name] = getattr(self, name).snapshot()
+        return result
+
+def formatSnapshot(snapshot, previous=None):
+    """One line summary of a snapshot; counters are given as the increase
+    since `previous` when there is one."""
+    parts = []
+    for name in AcquisitionStats.COUNTERS:
+        value = snapshot[name]
+        if previous is not None:
+            value -= previous[name]
+        parts.append("%s=%d" % (name, value))
+    for name in AcquisitionStats.HISTOGRAMS:
+        h = snapshot[name]
+        if name == "backlog":
+            parts.append("%s p50=%d p99=%d max=%d" % (name, h["p50"], h["p99"], h["max"]))
+        else:
+            parts.append("%s p50=%.0fus p99=%.0fus max=%.0fus" % (
+                name, h["p50"] * 1e6, h["p99"] * 1e6, h["max"] * 1e6))
+    return ", ".join(parts)
+
+class StatsReporter(threading.Thread):
+    """Call report(snapshot, previous) every `interval` seconds, printing a
+    one line summary by default, until stop() is called."""
+
+    def __init__(self, stats, interval=10.0, report=None):
+        threading.Thread.__init__(self, name="StatsReporter")
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.report = report or (lambda snapshot, previous:
+                                 print(formatSnapshot(snapshot, previous)))
+        self._stopped = threading.Event()
+
+    def run(self):
+        previous = None
+        while not self._stopped.wait(self.interval):
+            snapshot = self.stats.snapshot()
+            self.report(snapshot, previous)
+            previous = snapshot
+
+    def stop(self):
+        self._stopped.set()
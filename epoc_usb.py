@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Discovery of the Emotiv EPOC dongles on the USB bus.
+
+Matching a device on its manufacturer and interface strings takes a
+control transfer per string, which is slow on hubs with many devices and
+fails on some of them (errno 32 on a Raspberry Pi, 13 without
+permission). findDongles() therefore only looks at the strings of the
+devices whose vendor and product IDs are those of a dongle, and remembers
+the outcome by bus and address: a device which is still plugged is never
+asked twice, unless it could not be opened for lack of permission, which
+may be granted meanwhile. Unknown IDs can be added to DONGLE_IDS.
+
+openDongle() claims a dongle and returns its IN endpoint. The endpoint and
+the AES key (dongleKey()) of every serial number are kept until the dongle
+is unplugged or released with releaseDongle(), so reconnecting to a dongle
+costs no USB transfer.
+newCipher() returns the cipher decrypting the packets of a dongle.
+
+DongleMonitor rescans the bus in the background and reports dongles being
+plugged and unplugged:
+
+    monitor = DongleMonitor(lambda added, removed: ...)
+    monitor.start()
+"""
+
+import errno
+import threading
+
+from epoc_decoder import deriveKey
+
+MANUFACTURER_DESC = "Emotiv Systems Pty Ltd"
+INTERFACE_DESC = "Emotiv RAW DATA"
+
+# (idVendor, idProduct) of the known dongles
+DONGLE_IDS = set([(0x1234, 0xED02), (0x21A1, 0x0001), (0x21A1, 0x0002)])
+
+_lock = threading.Lock()
+# (bus, address): serial number, None for a device which is no dongle
+_identified = {}
+# _identify() result of a device to ask again next time
+_UNKNOWN = object()
+# serial number: (device, endpoint) of the dongles opened so far
+_opened = {}
+# (serial number, research): AES key
+_keys = {}
+
+def _location(device):
+    return device.bus, device.address
+
+def _isDongleId(device):
+    return (device.idVendor, device.idProduct) in DONGLE_IDS
+
+def _identify(device):
+    """Serial number of a dongle, None for any other device, _UNKNOWN if we
+    may not ask it."""
+    import usb.core
+    import usb.util
+    try:
+        manu = usb.util.get_string(device, len(MANUFACTURER_DESC), device.iManufacturer)
+        if manu != MANUFACTURER_DESC:
+            return None
+        for interf in device.get_active_configuration():
+            ifStr = usb.util.get_string(device, len(INTERFACE_DESC), interf.iInterface)
+            if ifStr == INTERFACE_DESC:
+                return usb.util.get_string(device, 32, device.iSerialNumber)
+    except usb.core.USBError as e:
+        # Skip failing devices (errno 32 on a Raspberry Pi, 13 without the
+        # permission to open them, which may be fixed while we run)
+        return _UNKNOWN if e.errno == errno.EACCES else None
+    return None
+
+def findDongles(rescan=False):
+    """Return (serial number, usb device) of every plugged dongle. Devices
+    seen by a previous call are not identified again unless rescan is True."""
+    # Imported here, so that the device modules can be imported without pyusb
+    import usb.core
+    devices = list(usb.core.find(find_all=True, custom_match=_isDongleId))
+    present = set(_location(dev) for dev in devices)
+    with _lock:
+        # Forget the devices which were unplugged, a new one may get their address
+        for location in list(_identified):
+            if location not in present:
+                del _identified[location]
+        known = dict((_location(dev), _identified.get(_location(dev), _UNKNOWN))
+                     for dev in devices)
+    # The string descriptors are read without holding the lock, several
+    # control transfers per device
+    for dev in devices:
+        location = _location(dev)
+        if rescan or known[location] is _UNKNOWN:
+            known[location] = _identify(dev)
+    dongles = [(known[_location(dev)], dev) for dev in devices
+               if known[_location(dev)] not in (None, _UNKNOWN)]
+    plugged = set(sn for sn, dev in dongles)
+    with _lock:
+        for location, sn in known.items():
+            if sn is not _UNKNOWN:
+                _identified[location] = sn
+        for sn in list(_opened):
+            if sn not in plugged:
+                del _opened[sn]
+    return dongles
+
+def openDongle(serialNumber=None):
+    """Return (serial number, IN endpoint) of a plugged dongle, the first one
+    unless a serial number is given, claiming its interfaces. None if there
+    is no such dongle."""
+    import usb.util
+    for sn, dev in findDongles():
+        if serialNumber is not None and sn != serialNumber:
+            continue
+        with _lock:
+            if sn in _opened:
+                return sn, _opened[sn][1]
+        for interf in dev.get_active_configuration():
+            if dev.is_kernel_driver_active(interf.bInterfaceNumber):
+                # Detach kernel drivers and claim through libusb
+                dev.detach_kernel_driver(interf.bInterfaceNumber)
+                usb.util.claim_interface(dev, interf.bInterfaceNumber)
+        # 2nd interface is the one we need
+        endpoint = usb.util.find_descriptor(interf, bEndpointAddress=usb.ENDPOINT_IN | 2)
+        with _lock:
+            _opened[sn] = (dev, endpoint)
+        return sn, endpoint
+    return None
+
+def releaseDongle(serialNumber):
+    """Release the interfaces of a dongle returned by openDongle(); the
+    next openDongle() claims them again. Does nothing for other dongles."""
+    with _lock:
+        opened = _opened.pop(serialNumber, None)
+    if opened is None:
+        return
+    import usb.util
+    dev = opened[0]
+    for interf in dev.get_active_configuration():
+        usb.util.release_interface(dev, interf.bInterfaceNumber)
+
+def dongleKey(serialNumber, research=True):
+    """AES key of a dongle (see epoc_decoder.deriveKey), derived once."""
+    with _lock:
+        if (serialNumber, research) not in _keys:
+            _keys[serialNumber, research] = deriveKey(serialNumber, research)
+        return _keys[serialNumber, research]
+
+def newCipher(serialNumber, research=True):
+    """AES cipher of the packets of a dongle; Crypto is imported here."""
+    from Crypto.Cipher import AES
+    # ECB is PyCrypto's default, pycryptodome wants it spelled out
+    return AES.new(dongleKey(serialNumber, research), AES.MODE_ECB)
+
+class DongleMonitor(threading.Thread):
+    """Rescan the bus every `interval` seconds and call
+    callback(added, removed) with the serial numbers of the dongles plugged
+    and unplugged since the previous scan, until stop() is called.
+    `dongles` holds the serial numbers plugged at the last scan."""
+
+    def __init__(self, callback, interval=1.0):
+        threading.Thread.__init__(self, name="DongleMonitor")
+        self.daemon = True
+        self.callback = callback
+        self.interval = interval
+        self.dongles = set()
+        self._stopped = threading.Event()
+
+    def scan(self):
+        plugged = set(sn for sn, dev in findDongles())
+        added = sorted(plugged - self.dongles)
+        removed = sorted(self.dongles - plugged)
+        self.dongles = plugged
+        if added or removed:
+            self.callback(added, removed)
+
+    def run(self):
+        self.scan()
+        while not self._stopped.wait(self.interval):
+            self.scan()
+
+    def stop(self):
+        self._stopped.set()
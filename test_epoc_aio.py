@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_aio (Python 3.5+), run with pytest."""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("usb")
+
+from epoc_iohub import EmotivDevice
+from epoc_sim import SimulatedTransport
+
+async def readBlocks(device, count):
+    """The first `count` blocks of a new stream, closed afterwards."""
+    blocks = []
+    async with device.stream(batch_size=8) as stream:
+        async for block in stream:
+            blocks.append(block)
+            if len(blocks) == count:
+                break
+    return blocks
+
+def test_streamReopened():
+    device = EmotivDevice(transport=SimulatedTransport(realtime=False))
+    decoder = device._ac_thread.decoder
+
+    async def openCloseOpen():
+        first = await readBlocks(device, 4)
+        assert not device._ac_thread.is_alive()
+        second = await readBlocks(device, 4)
+        assert not device._ac_thread.is_alive()
+        return first, second
+
+    loop = asyncio.new_event_loop()
+    try:
+        first, second = loop.run_until_complete(openCloseOpen())
+    finally:
+        loop.close()
+    assert [len(block.counter) for block in first + second] == [8] * 8
+    # The second acquisition carries on with the same decoder
+    assert device._ac_thread.decoder is decoder
+    assert second[0].hostTime[0] > first[-1].hostTime[-1]
+    assert device._ac_thread.subscriptions == ()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_buffer, run with pytest."""
+
+import time
+
+import numpy as np
+import pytest
+
+from epoc_buffer import (BLOCK_WRITER, DROP_NEWEST, DROP_OLDEST, LATEST, RingReader,
+                         SampleRingBuffer, Subscription)
+from epoc_decoder import CHANNEL_NAMES, SampleBlock
+
+def makeBlock(first, count):
+    """SampleBlock of `count` samples numbered from `first` on, the number
+    stored in the timestamp (the counter wraps)."""
+    numbers = np.arange(first, first + count)
+    return SampleBlock(signal=np.repeat(numbers[:, None], len(CHANNEL_NAMES), 1).astype(float),
+                       gyro=np.zeros((count, 2), dtype=np.int16),
+                       counter=(numbers % 128).astype(np.uint8),
+                       timestamp=numbers.astype(float),
+                       battery=np.zeros(count, dtype=np.int8),
+                       quality=np.zeros(count, dtype=np.uint16),
+                       hostTime=numbers.astype(float))
+
+def numbers(block):
+    return block.timestamp.astype(int).tolist()
+
+def test_dropNewestNotLappedByWriter():
+    ring = SampleRingBuffer(16)
+    cursor = ring.openCursor(DROP_NEWEST, 4)
+    other = ring.openCursor(DROP_OLDEST)
+    ring.write(makeBlock(0, 12))
+    assert numbers(ring.read(cursor)) == list(range(4))
+    assert numbers(ring.read(other)) == list(range(12))
+    # The reader keeps 12-15; the writer stops before lapping them
+    for i in range(12, 40):
+        ring.write(makeBlock(i, 1))
+    assert ring.head == 12 + 16
+    assert ring.refused == 40 - 28
+    assert numbers(ring.read(cursor)) == [12, 13, 14, 15]
+    stats = ring.cursorStats(cursor)
+    assert stats["overwritten"] == 0
+    # Skipped when read, then refused by the writer
+    assert stats["dropped"] == 8 + 12 + 12
+    # Every reader misses the refused samples, none is lapped
+    assert numbers(ring.read(other)) == list(range(12, 28))
+    assert ring.cursorStats(other)["overwritten"] == 0
+    assert ring.cursorStats(other)["refused"] == 12
+    # Once read, the skipped samples may be overwritten
+    ring.write(makeBlock(28, 16))
+    assert ring.refused == 12
+    assert numbers(ring.read(cursor)) == [28, 29, 30, 31]
+
+def test_dropNewestClosedReleasesWriter():
+    ring = SampleRingBuffer(16)
+    cursor = ring.openCursor(DROP_NEWEST, 4)
+    ring.write(makeBlock(0, 20))
+    assert ring.head == 16
+    ring.closeCursor(cursor)
+    ring.write(makeBlock(20, 20))
+    assert ring.head == 36
+    assert ring.refused == 4
+
+def test_closeReadersReleasesAcquisition():
+    pytest.importorskip("usb")
+    from epoc_iohub import EmotivDevice
+    from epoc_sim import SimulatedTransport
+    device = EmotivDevice(transport=SimulatedTransport(realtime=False), bufferSize=64,
+                          overflow=BLOCK_WRITER)
+    received = []
+    device.subscribe(lambda block: received.append(len(block.counter)))
+    # Nobody polls the getters
+    device.closeReaders()
+    device.startAcuisition()
+    time.sleep(0.5)
+    device.stopAcquisition()
+    device.disconnect()
+    assert device._ring.stalls == 0
+    assert sum(received) > 4 * 64
+
+def test_readFieldsIntoBuffers():
+    ring = SampleRingBuffer(16)
+    copied = ring.openCursor()
+    reused = ring.openCursor()
+    out = ring.fieldBuffers(("signal", "timestamp"), 8)
+    for first in range(0, 40, 5):
+        # Wraps around every few writes
+        ring.write(makeBlock(first, 5))
+        signal, timestamp = ring.readFields(reused, ("signal", "timestamp"), out=out)
+        expected = ring.readFields(copied, ("signal", "timestamp"), 8)
+        assert np.shares_memory(signal, out[0]) and np.shares_memory(timestamp, out[1])
+        assert signal.tolist() == expected[0].tolist()
+        assert timestamp.tolist() == expected[1].tolist()
+
+def test_subscriptionFields():
+    ring = SampleRingBuffer(16)
+    received = []
+    subscription = Subscription(ring, lambda signal, timestamp: received.append(
+        (signal.shape, timestamp.tolist())), 4, fields=("signal", "timestamp"))
+    ring.write(makeBlock(0, 10))
+    subscription.deliver()
+    assert received == [((4, len(CHANNEL_NAMES)), [0, 1, 2, 3]),
+                        ((4, len(CHANNEL_NAMES)), [4, 5, 6, 7])]
+
+def test_wraparoundKeepsOrder():
+    ring = SampleRingBuffer(16)
+    cursor = ring.openCursor()
+    read = []
+    for first in range(0, 100, 7):
+        ring.write(makeBlock(first, 7))
+        read += numbers(ring.read(cursor))
+    assert read == list(range(105))
+    # A block larger than the buffer keeps its newest samples
+    ring.write(makeBlock(105, 40))
+    assert numbers(ring.read(cursor)) == list(range(129, 145))
+    assert ring.cursorStats(cursor)["overwritten"] == 24
+
+def test_policies():
+    ring = SampleRingBuffer(16)
+    oldest = ring.openCursor(DROP_OLDEST, 5)
+    latest = ring.openCursor(LATEST)
+    lapped = ring.openCursor()
+    ring.write(makeBlock(0, 12))
+    assert ring.pending(oldest) == 5
+    assert numbers(ring.read(oldest)) == list(range(7, 12))
+    assert numbers(ring.read(latest)) == [11]
+    assert ring.cursorStats(oldest)["dropped"] == 7
+    assert ring.cursorStats(latest)["dropped"] == 11
+    ring.write(makeBlock(12, 20))
+    assert numbers(ring.read(lapped)) == list(range(16, 32))
+    stats = ring.cursorStats(lapped)
+    assert stats["overwritten"] == 16 and stats["highWater"] == 32
+
+def test_blockWriterWaitsForReader():
+    ring = SampleRingBuffer(16)
+    ring.blockTimeout = 0.05
+    cursor = ring.openCursor(BLOCK_WRITER)
+    ring.write(makeBlock(0, 16))
+    start = time.time()
+    ring.write(makeBlock(16, 4))
+    # Waited for blockTimeout, then overwrote
+    assert time.time() - start >= 0.04
+    assert ring.stalls == 1
+    ring.read(cursor)
+    ring.write(makeBlock(20, 16))
+    assert ring.stalls == 1
+    ring.closeCursor(cursor)
+    ring.write(makeBlock(36, 32))
+    assert ring.stalls == 1
+
+def writeInChild(ring, count):
+    for first in range(0, count, 10):
+        ring.write(makeBlock(first, 10))
+    quality = np.arange(len(CHANNEL_NAMES))
+    ring.publishStatus(55, quality)
+
+def test_sharedRingAcrossProcesses():
+    import multiprocessing
+    ring = SampleRingBuffer(256, shared=True)
+    cursor = ring.openCursor()
+    child = multiprocessing.Process(target=writeInChild, args=(ring, 200))
+    child.start()
+    child.join(10)
+    assert child.exitcode == 0
+    assert ring.head == 200
+    assert numbers(ring.read(cursor)) == list(range(200))
+    status = ring.status()
+    assert status.battery == 55 and status.batterySequence == 1
+    assert status.quality.tolist() == list(range(len(CHANNEL_NAMES)))
+
+def test_waitWakesOnWrite():
+    import threading
+    ring = SampleRingBuffer(64)
+    cursor = ring.openCursor()
+    assert not ring.wait(cursor, 1, timeout=0.01)
+    writer = threading.Timer(0.05, ring.write, (makeBlock(0, 8),))
+    writer.start()
+    start = time.time()
+    assert ring.wait(cursor, 8, timeout=5)
+    assert time.time() - start < 1
+    writer.join()
+
+def test_subscriptionBatchesAndErrors():
+    ring = SampleRingBuffer(64)
+    batches = []
+    subscription = Subscription(ring, lambda block: batches.append(numbers(block)), 3)
+    ring.write(makeBlock(0, 5))
+    subscription.deliver()
+    ring.write(makeBlock(5, 4))
+    subscription.deliver()
+    assert batches == [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+    def failing(block):
+        raise ValueError("subscriber bug")
+    broken = Subscription(ring, failing)
+    ring.write(makeBlock(9, 1))
+    # Reported and deactivated, the writer goes on
+    broken.deliver()
+    assert not broken.active
+
+def test_waitForSamplesAndSubscribe():
+    pytest.importorskip("usb")
+    from epoc_iohub import EmotivDevice
+    from epoc_sim import SimulatedTransport
+    device = EmotivDevice(transport=SimulatedTransport())
+    received = []
+    subscription = device.subscribe(lambda block: received.append(block.counter.tolist()), 16)
+    device.startAcuisition()
+    try:
+        assert device.wait_for_samples(32, timeout=2)
+        assert len(device.getSamples(32).counter) == 32
+    finally:
+        device.unsubscribe(subscription)
+        count = len(received)
+        device.stopAcquisition()
+    assert count >= 2 and len(received) == count
+    assert all(len(batch) == 16 for batch in received)
+
+def test_readersDoNotStealSamples():
+    ring = SampleRingBuffer(128)
+    fast, slow = RingReader(ring), RingReader(ring, DROP_OLDEST, 8)
+    signal = ring.openCursor()
+    gyro = ring.openCursor()
+    read = dict(fast=[], signal=[], gyro=[])
+    for first in range(0, 100, 10):
+        ring.write(makeBlock(first, 10))
+        read["fast"] += numbers(fast.read())
+        signalColumn, = ring.readFields(signal, ("signal",))
+        read["signal"] += signalColumn[:, 0].astype(int).tolist()
+        # Read one write late, at its own pace
+        if first:
+            timestamps, = ring.readFields(gyro, ("timestamp",), 10)
+            read["gyro"] += timestamps.astype(int).tolist()
+    for name in ("fast", "signal"):
+        assert read[name] == list(range(100)), name
+    assert read["gyro"] == list(range(90))
+    # The slow reader only loses what its own limit drops
+    assert numbers(slow.read()) == list(range(92, 100))
+    assert slow.stats()["dropped"] == 92
+    assert fast.stats()["dropped"] == 0
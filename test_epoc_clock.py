@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_clock, run with pytest."""
+
+import numpy as np
+
+from epoc_clock import SampleClock
+from epoc_decoder import hostClock
+
+def test_hostClockMonotonic():
+    times = [hostClock() for _ in range(1000)]
+    assert all(b >= a for a, b in zip(times, times[1:]))
+
+def test_clockStepBackResets():
+    clock = SampleClock()
+    sequence = np.arange(512)
+    clock.timestamps(sequence, 1000.0 + sequence / 128.0)
+    # The host clock is stepped back by half a second
+    readTimes = 1000.0 + (512 + np.arange(8)) / 128.0 - 0.5
+    stamps = clock.timestamps(512 + np.arange(8), readTimes)
+    assert abs(stamps[-1] - readTimes[-1]) < 0.01
+    stamp = clock.timestamp(520, readTimes[-1] - 0.5 + 1 / 128.0)
+    assert abs(stamp - (readTimes[-1] - 0.5 + 1 / 128.0)) < 0.01
+
+def test_clockConvergesUnderDrift():
+    rng = np.random.RandomState(0)
+    # Headset clock 300 ppm slow, reads late by 0.5-4 ms and 1% of them stalled
+    period = (1 + 300e-6) / 128.0
+    sequence = np.arange(30000)
+    sampled = 500.0 + sequence * period
+    latency = rng.uniform(0.0005, 0.004, len(sequence))
+    stalled = rng.uniform(size=len(sequence)) < 0.01
+    latency[stalled] += rng.uniform(0.01, 0.05, stalled.sum())
+    readTimes = sampled + latency
+    for batchSize in (1, 8):
+        clock = SampleClock()
+        stamps = []
+        for i in range(0, len(sequence), batchSize):
+            if batchSize == 1:
+                stamps.append(clock.timestamp(i, readTimes[i]))
+            else:
+                stamps.extend(clock.timestamps(sequence[i:i + batchSize],
+                                               readTimes[i:i + batchSize]))
+        assert abs(clock.period / period - 1) < 5e-6
+        # The read jitter is gone, what is left is the typical latency
+        error = (np.array(stamps) - sampled)[-5000:]
+        assert error.std() < 0.1e-3
+        assert 0 < error.mean() < 4e-3
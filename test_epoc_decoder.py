@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_decoder, run with pytest."""
+
+import numpy as np
+import pytest
+
+from epoc_decoder import (ADC_CENTER, CHANNEL_BIT_OFFSETS, CH_BITS, CYCLE, GYRO_OFFSET,
+                          MICROVOLTS_PER_BIT, PACKET_SIZE, QUALITY_BIT_OFFSET, SIGNAL_FORMATS,
+                          EmotivPacketDecoder, PacketBatcher, batteryByte, decodePackets,
+                          encodePackets)
+
+PERIOD = 1.0 / 128
+
+def slotStream(count):
+    """First bytes of `count` packets: counters 0-127 then a battery packet."""
+    slots = np.arange(count) % CYCLE
+    return np.where(slots == CYCLE - 1, batteryByte(80), slots)
+
+def decodeSlots(decoder, slots, readTimes):
+    packets = encodePackets(slots, 8000)
+    return decoder.decode(packets.tobytes(), readTimes)
+
+def bitArrayDecode(packet):
+    """Fields of one packet sliced from a BitArray, the way the device
+    classes did before the vectorized decoder."""
+    from bitstring import BitArray
+    if hasattr(BitArray, "from_bytes"):
+        # Recent bitstring versions dropped the bytes keyword
+        bits = BitArray.from_bytes(packet)
+    else:
+        bits = BitArray(bytes=packet)
+    signal = [bits[offset:offset + CH_BITS].uint for offset in CHANNEL_BIT_OFFSETS]
+    quality = bits[QUALITY_BIT_OFFSET:QUALITY_BIT_OFFSET + CH_BITS].uint
+    gyro = (bits[233:240].uint - GYRO_OFFSET, bits[240:248].uint - GYRO_OFFSET)
+    return bits[0:8].uint, bool(bits[0]), signal, quality, gyro
+
+def test_decodePacketsMatchesBitArray():
+    pytest.importorskip("bitstring")
+    rng = np.random.RandomState(0)
+    packets = rng.randint(0, 256, (1000, PACKET_SIZE)).astype(np.uint8)
+    decoded = decodePackets(packets.tobytes())
+    for i, packet in enumerate(packets):
+        first, isBattery, signal, quality, gyro = bitArrayDecode(packet.tobytes())
+        assert decoded.isBattery[i] == isBattery
+        if not isBattery:
+            assert decoded.counter[i] == first
+        assert decoded.signal[i].tolist() == signal
+        assert decoded.quality[i] == quality
+        assert tuple(decoded.gyro[i].tolist()) == gyro
+
+def test_decodePacketsOneOrMany():
+    rng = np.random.RandomState(1)
+    packets = rng.randint(0, 256, (10, PACKET_SIZE)).astype(np.uint8)
+    many = decodePackets(packets)
+    for i in range(len(packets)):
+        one = decodePackets(packets[i].tobytes())
+        assert one.signal[0].tolist() == many.signal[i].tolist()
+        assert one.gyro[0].tolist() == many.gyro[i].tolist()
+
+def test_lossCounted():
+    first = slotStream(3 * CYCLE)
+    kept = np.ones(len(first), dtype=bool)
+    kept[[5, 6, 128, 300]] = False
+    decoder = EmotivPacketDecoder()
+    block = decodeSlots(decoder, first[kept], np.arange(len(first))[kept] * PERIOD)
+    assert decoder.loss.lost == 4
+    # The battery packet of slot 128 carried no sample
+    assert decoder.loss.samplesLost == 3
+    assert len(block.counter) == kept.sum() - 2
+
+def test_fillGapsBatteryPacketAlone():
+    # Counter 127 lost, then the battery packet decoded on its own
+    decoder = EmotivPacketDecoder(fillGaps=True)
+    decodeSlots(decoder, [126], [126 * PERIOD])
+    block = decodeSlots(decoder, [batteryByte(80)], [128 * PERIOD])
+    assert block.counter.tolist() == [127]
+    assert np.isnan(block.signal).all()
+    assert decoder.battery >= 80
+
+def test_fillGapsInFirstBlock():
+    rng = np.random.RandomState(2)
+    first = slotStream(200)
+    kept = rng.uniform(size=len(first)) > 0.1
+    kept[0] = True
+    kept[-1] = True
+    decoder = EmotivPacketDecoder(fillGaps=True)
+    block = decodeSlots(decoder, first[kept], np.arange(len(first))[kept] * PERIOD)
+    # One row per sample slot from the first packet on, lost or not
+    samples = first < 128
+    assert len(block.counter) == samples.sum()
+    assert block.counter.tolist() == first[samples].tolist()
+    assert np.isnan(block.signal[:, 0]).sum() == (samples & ~kept).sum()
+
+def test_batcherLatency():
+    batcher = PacketBatcher(batchSize=4, maxLatency=0.1)
+    assert batcher.timeLeft(0.0) is None
+    assert not batcher.add(b"\0" * PACKET_SIZE, 1.0)
+    assert not batcher.expired(1.05)
+    # Expires without another packet, e.g. after read timeouts
+    assert batcher.expired(1.1)
+    assert batcher.add(b"\0" * PACKET_SIZE, 1.1)
+    assert not PacketBatcher(batchSize=4).expired(100.0)
+
+def test_singlePacketPathMatchesArrays():
+    rng = np.random.RandomState(3)
+    first = slotStream(4 * CYCLE)
+    kept = rng.uniform(size=len(first)) > 0.05
+    # A whole cycle lost, only seen on the clock
+    kept[300:300 + CYCLE] = False
+    readTimes = np.arange(len(first))[kept] * PERIOD + rng.uniform(0, 0.003, kept.sum())
+    packets = encodePackets(first[kept], rng.randint(0, 1 << CH_BITS, (kept.sum(), 14)),
+                            rng.randint(0, 1 << CH_BITS, kept.sum()),
+                            rng.randint(-100, 100, (kept.sum(), 2)))
+    for signalFormat in sorted(SIGNAL_FORMATS):
+        for fillGaps in (False, True):
+            if fillGaps and signalFormat in ("raw", "centered"):
+                continue
+            scalar = EmotivPacketDecoder(fillGaps=fillGaps, signalFormat=signalFormat)
+            arrays = EmotivPacketDecoder(fillGaps=fillGaps, signalFormat=signalFormat)
+            for packet, readTime in zip(packets, readTimes):
+                one = scalar.decode(packet.tobytes(), [readTime])
+                # An array goes through the vectorized code
+                many = arrays.decode(packet[None], [readTime])
+                for name in one._fields:
+                    a, b = getattr(one, name), getattr(many, name)
+                    assert a.dtype == b.dtype and a.shape == b.shape, name
+                    np.testing.assert_allclose(a, b, rtol=0, atol=1e-9)
+            assert scalar.loss.lost == arrays.loss.lost > CYCLE
+            assert scalar.loss.samplesLost == arrays.loss.samplesLost
+            assert scalar.loss.rate() == arrays.loss.rate()
+            assert scalar.quality.tolist() == arrays.quality.tolist()
+            assert scalar.battery == arrays.battery
+            assert abs(scalar.clock.period - arrays.clock.period) < 1e-12
+
+def test_signalFormatsMatchFloat():
+    rng = np.random.RandomState(4)
+    first = slotStream(2 * CYCLE)
+    packets = encodePackets(first, rng.randint(0, 1 << CH_BITS, (len(first), 14)))
+    readTimes = np.arange(len(first)) * PERIOD
+    raw = EmotivPacketDecoder().decode(packets.tobytes(), readTimes).signal
+    assert raw.dtype == np.float64
+    for signalFormat, (dtype, offset, scale) in SIGNAL_FORMATS.items():
+        signal = EmotivPacketDecoder(signalFormat=signalFormat).decode(packets.tobytes(),
+                                                                       readTimes).signal
+        assert signal.dtype == np.dtype(dtype), signalFormat
+        expected = (raw - offset) * (scale or 1)
+        if signalFormat == "microvolts":
+            # float32 holds ~7 significant digits
+            np.testing.assert_allclose(signal, expected, rtol=1e-6, atol=1e-3)
+        else:
+            assert signal.tolist() == expected.tolist(), signalFormat
+    # 8192 is the middle of the 14 bit range
+    assert ADC_CENTER == 8192 and MICROVOLTS_PER_BIT == 0.51
+
+def test_signalFormatErrors():
+    with pytest.raises(ValueError):
+        EmotivPacketDecoder(signalFormat="int8")
+    with pytest.raises(ValueError):
+        EmotivPacketDecoder(fillGaps=True, signalFormat="raw")
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_filter, run with pytest."""
+
+import numpy as np
+import pytest
+
+import epoc_filter
+from epoc_filter import SosFilter, designSos
+
+def chunked(sosFilter, signal, seed=0):
+    """Filter `signal` in chunks of random sizes, some empty."""
+    rng = np.random.RandomState(seed)
+    out = []
+    start = 0
+    while start < len(signal):
+        stop = start + rng.randint(0, 40)
+        out.append(sosFilter.process(signal[start:stop]))
+        start = stop
+    return np.concatenate(out)
+
+def directForm(sos, x):
+    """Reference: every section as its difference equation, one channel
+    at rest before the first sample."""
+    for b0, b1, b2, a0, a1, a2 in sos:
+        # Two zeros of history before the signal
+        xp = np.concatenate(([0.0, 0.0], x))
+        yp = np.zeros(len(xp))
+        for n in range(2, len(xp)):
+            yp[n] = (b0 * xp[n] + b1 * xp[n - 1] + b2 * xp[n - 2]
+                     - a1 * yp[n - 1] - a2 * yp[n - 2])
+        x = yp[2:]
+    return x
+
+def signal(count=600, channels=14):
+    rng = np.random.RandomState(1)
+    t = np.arange(count)[:, None] / 128.0
+    return 8000 + 50 * np.sin(2 * np.pi * 10 * t) + 20 * rng.standard_normal((count, channels))
+
+def test_chunksMatchScipy():
+    scipySignal = pytest.importorskip("scipy.signal")
+    sos = designSos()
+    x = signal()
+    y = chunked(SosFilter(sos, steadyState=False), x)
+    np.testing.assert_allclose(y, scipySignal.sosfilt(sos, x, axis=0), rtol=1e-9, atol=1e-6)
+
+def test_fallbackChunksMatchDifferenceEquation():
+    sos = designSos()
+    x = signal(300, channels=2)
+    saved = epoc_filter.sosfilt
+    epoc_filter.sosfilt = None
+    try:
+        y = chunked(SosFilter(sos, channels=2, steadyState=False), x)
+    finally:
+        epoc_filter.sosfilt = saved
+    for channel in range(2):
+        np.testing.assert_allclose(y[:, channel], directForm(sos, x[:, channel]),
+                                   rtol=1e-9, atol=1e-6)
+
+def test_steadyStateAndLostRows():
+    sosFilter = SosFilter(designSos(), channels=2)
+    x = np.full((256, 2), 8000.0)
+    x[100:103] = np.nan
+    y = sosFilter.process(x)
+    # No transient on the DC offset, which the band pass removes
+    assert np.isnan(y[100:103]).all()
+    valid = ~np.isnan(y[:, 0])
+    assert np.abs(y[valid]).max() < 1e-6
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_group against simulated dongles, run with pytest."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("usb")
+
+from epoc_decoder import CHANNEL_NAMES, SampleBlock
+from epoc_group import EmotivDeviceGroup
+from epoc_sim import SimulatedTransport
+
+PERIOD = 1.0 / 128
+
+def stampedBlock(timestamps):
+    count = len(timestamps)
+    return SampleBlock(signal=np.zeros((count, len(CHANNEL_NAMES))),
+                       gyro=np.zeros((count, 2), dtype=np.int16),
+                       counter=np.arange(count, dtype=np.uint8),
+                       timestamp=np.asarray(timestamps, dtype=float),
+                       battery=np.zeros(count, dtype=np.int8),
+                       quality=np.zeros(count, dtype=np.uint16),
+                       hostTime=np.asarray(timestamps, dtype=float))
+
+def twoHeadsets(maxSkew=0.5):
+    transport = SimulatedTransport(["SN20130116000001", "SN20130116000002"])
+    group = EmotivDeviceGroup(transport=transport, maxSkew=maxSkew)
+    return group, [device._ring for device in group.devices.values()]
+
+def test_watermarkHoldsBackTheLeader():
+    group, (first, second) = twoHeadsets()
+    first.write(stampedBlock(10 + np.arange(20) * PERIOD))
+    second.write(stampedBlock(10.001 + np.arange(12) * PERIOD))
+    blocks = group.read()
+    assert group.watermark == 10.001 + 11 * PERIOD
+    assert len(blocks["SN20130116000001"].counter) == 12
+    assert len(blocks["SN20130116000002"].counter) == 12
+    # The rest is handed out once the second headset catches up
+    second.write(stampedBlock(10.001 + np.arange(12, 30) * PERIOD))
+    blocks = group.read()
+    assert group.watermark == 10 + 19 * PERIOD
+    assert len(blocks["SN20130116000001"].counter) == 8
+    assert len(blocks["SN20130116000002"].counter) == 7
+    for block in blocks.values():
+        assert block.timestamp[-1] <= group.watermark
+
+def test_laggingHeadsetStopsHoldingBack():
+    group, (first, second) = twoHeadsets(maxSkew=0.5)
+    second.write(stampedBlock([10.0]))
+    first.write(stampedBlock(10 + np.arange(128) * PERIOD))
+    # Nothing from the second headset for almost a second
+    blocks = group.read()
+    assert len(blocks["SN20130116000001"].counter) == 128
+    assert len(blocks["SN20130116000002"].counter) == 1
+
+def test_acquisitionAligned():
+    group, rings = twoHeadsets()
+    group.startAcquisition()
+    try:
+        received = dict((sn, 0) for sn in group.serialNumbers)
+        for i in range(20):
+            for sn, block in group.read(timeout=1.0).items():
+                received[sn] += len(block.counter)
+                if len(block.counter):
+                    assert block.timestamp[-1] <= group.watermark
+    finally:
+        group.stopAcquisition()
+        group.disconnect()
+    # Both headsets at 128Hz: never more than a couple of samples apart
+    assert min(received.values()) > 0
+    assert abs(received["SN20130116000001"] - received["SN20130116000002"]) <= 3
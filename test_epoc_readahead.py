@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_readahead against the simulated dongle, run with pytest."""
+
+import time
+
+import pytest
+
+pytest.importorskip("usb")
+
+from epoc_iohub import EmotivDevice
+from epoc_sim import SimulatedEndpoint, SimulatedTransport
+from epoc_readahead import ReadAheadEndpoint
+
+def stalledRun(readAhead, seconds=2.0, stall=0.15, every=0.5):
+    """Acquire from a dongle holding 4 packets while a subscriber sleeps
+    `stall` seconds (19 packets at 128Hz) every `every` seconds."""
+    device = EmotivDevice(transport=SimulatedTransport(realtime=True, dongleBuffer=4),
+                          readAhead=readAhead)
+    last = [time.time()]
+    def slowSubscriber(block):
+        if time.time() - last[0] > every:
+            last[0] = time.time()
+            time.sleep(stall)
+    device.subscribe(slowSubscriber)
+    device.startAcuisition()
+    time.sleep(seconds)
+    device.stopAcquisition()
+    return device
+
+def test_readAheadSurvivesStalls():
+    device = stalledRun(readAhead=True)
+    assert device.getPacketLoss() == 0
+    assert device.getStats()["overruns"] == 0
+    assert device._device.dropped == 0
+
+def test_stallsLoseWithoutReadAhead():
+    device = stalledRun(readAhead=False)
+    assert device.getPacketLoss() > 0
+    assert device._device.dropped == device.getPacketLoss()
+
+def test_readBatchKeepsOrderAcrossWrap():
+    reader = ReadAheadEndpoint(SimulatedEndpoint(realtime=False), capacity=5000)
+    reader.start()
+    raw = b""
+    while len(raw) < 3000 * 32:
+        raw += reader.readBatch(maxCount=7, timeout=1.0)[0]
+    reader.stop()
+    direct = SimulatedEndpoint(realtime=False)
+    expected = b"".join(bytes(bytearray(direct.read(32))) for _ in range(3000))
+    assert raw[:len(expected)] == expected
+
+def test_overrunsCounted():
+    reader = ReadAheadEndpoint(SimulatedEndpoint(realtime=False), capacity=8)
+    reader.start()
+    time.sleep(0.05)
+    raw, readTimes = reader.readBatch()
+    reader.stop()
+    assert len(readTimes) == 8
+    assert reader.overruns > 0
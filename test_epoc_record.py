@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_record, run with pytest."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from epoc_decoder import CHANNEL_NAMES, SampleBlock
+from epoc_record import SessionReader, SessionRecorder, indexPath, openRecords
+
+PERIOD = 1.0 / 128
+
+def makeBlock(first, count):
+    """SampleBlock of raw samples `first` to `first + count`."""
+    numbers = np.arange(first, first + count)
+    return SampleBlock(signal=(numbers[:, None] * 14 + np.arange(len(CHANNEL_NAMES))) % 16384,
+                       gyro=np.column_stack((numbers % 100, -(numbers % 50))).astype(np.int16),
+                       counter=(numbers % 128).astype(np.uint8),
+                       timestamp=numbers * PERIOD,
+                       battery=np.full(count, 80, dtype=np.int8),
+                       quality=(numbers % 4096).astype(np.uint16),
+                       hostTime=numbers * PERIOD)
+
+def record(path, sizes, close=True, **recorderArgs):
+    recorder = SessionRecorder(path, **recorderArgs)
+    first = 0
+    for size in sizes:
+        recorder.write(makeBlock(first, size))
+        first += size
+    if close:
+        recorder.close()
+    return recorder, makeBlock(0, first)
+
+class TempDir(object):
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self.path
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.path)
+
+def test_recordingRoundTrip():
+    with TempDir() as tmp:
+        path = os.path.join(tmp, "session.npy")
+        recorder, expected = record(path, [1, 7, 100, 3, 500, 29], indexInterval=64,
+                                    flushSize=50)
+        assert recorder.count == 640
+        records = np.load(path)
+        for name in ("counter", "battery", "quality", "gyro", "timestamp", "signal"):
+            assert records[name].tolist() == getattr(expected, name).tolist(), name
+        assert records["signal"].dtype == np.dtype("<u2")
+        index = np.load(indexPath(path))
+        assert index["sample"].tolist() == list(range(0, 640, 64))
+        assert index["timestamp"].tolist() == (index["sample"] * PERIOD).tolist()
+
+def test_unclosedRecordingReadable():
+    with TempDir() as tmp:
+        path = os.path.join(tmp, "session.npy")
+        recorder, expected = record(path, [300], close=False, flushSize=128)
+        # Only what was flushed is on disk, found from the file size
+        recorder._records._file.flush()
+        records = openRecords(path)
+        assert len(records) == 256
+        assert records["timestamp"].tolist() == expected.timestamp[:256].tolist()
+        recorder.close()
+        assert len(openRecords(path)) == 300
+
+def test_readerWindows():
+    with TempDir() as tmp:
+        path = os.path.join(tmp, "session.npy")
+        recorder, expected = record(path, [1000, 24], indexInterval=100)
+        reader = SessionReader(path)
+        assert len(reader) == 1024
+        # Between two samples, on a sample, past the end
+        assert reader.timeToSample(10.5 * PERIOD) == 11
+        assert reader.timeToSample(700 * PERIOD) == 700
+        assert reader.timeToSample(2000 * PERIOD) == 1024
+        for t in np.linspace(-1, 9, 37):
+            assert reader.timeToSample(t) == np.searchsorted(expected.timestamp, t)
+        eeg = reader.timeRange(128 * PERIOD, 256 * PERIOD, channels=["O1", "O2"])
+        o1 = CHANNEL_NAMES.index("O1")
+        assert eeg.tolist() == expected.signal[128:256, o1:o1 + 2].tolist()
+        # Neighbouring channels are a view of the mapping
+        assert np.shares_memory(eeg, reader.records)
+        picked = reader.sampleRange(0, 10, channels=["F3", "F4"])
+        assert picked.tolist() == expected.signal[:10, [0, 13]].tolist()
+        windows = list(reader.windows(256, 128))
+        assert [first for first, window in windows] == list(range(0, 1024 - 255, 128))
+        assert windows[-1][1].tolist() == expected.signal[768:1024].tolist()
+        # Unmapped before the directory is removed (Windows)
+        del reader, eeg, picked, windows
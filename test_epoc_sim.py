@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_sim, run with pytest."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("Crypto")
+
+from epoc_decoder import CYCLE, PACKET_SIZE, EmotivPacketDecoder, decodePackets
+from epoc_sim import SimulatedEndpoint
+from epoc_usb import newCipher
+
+def readPlain(endpoint, count):
+    raw = b"".join(bytes(bytearray(endpoint.read(PACKET_SIZE))) for i in range(count))
+    return newCipher(endpoint.serialNumber).decrypt(raw)
+
+def test_counterWrapsAfterBatteryPacket():
+    endpoint = SimulatedEndpoint(realtime=False, battery=80)
+    # More than a generated chunk, so that the cycle carries over
+    count = 10 * CYCLE
+    packets = decodePackets(readPlain(endpoint, count))
+    slots = np.arange(count) % CYCLE
+    assert packets.isBattery.tolist() == (slots == CYCLE - 1).tolist()
+    assert packets.counter[~packets.isBattery].tolist() == slots[slots < CYCLE - 1].tolist()
+    assert (packets.battery[packets.isBattery] >= 80).all()
+
+def test_replaysSource():
+    rng = np.random.RandomState(0)
+    source = rng.randint(0, 1 << 14, (300, 14))
+    endpoint = SimulatedEndpoint(source=source, realtime=False)
+    decoder = EmotivPacketDecoder()
+    block = decoder.decode(readPlain(endpoint, 2 * CYCLE + 100), np.arange(2 * CYCLE + 100) / 128.0)
+    # Battery packets carry no sample, the source is replayed in a loop
+    assert decoder.loss.lost == 0
+    assert len(block.counter) == 2 * CYCLE + 100 - 2
+    assert block.signal.tolist() == source[np.arange(len(block.counter)) % 300].tolist()
+    assert decoder.battery >= 100
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_stats, run with pytest."""
+
+import time
+
+import pytest
+
+from epoc_stats import countHistogram, durationHistogram
+
+def test_histogramBuckets():
+    histogram = durationHistogram()
+    for value in (3e-6, 3e-6, 0.75):
+        histogram.add(value)
+    snapshot = histogram.snapshot()
+    counts = dict(snapshot["buckets"])
+    assert counts[2.0 ** -18] == 2
+    assert counts[1.0] == 1
+    assert snapshot["count"] == 3
+    assert snapshot["max"] == 0.75
+
+def test_histogramZeros():
+    histogram = countHistogram()
+    for value in (0, 0, 0, 5):
+        histogram.add(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"][0] == (1.0, 3)
+    assert snapshot["p50"] == 1.0
+    assert snapshot["p99"] == 5
+
+    durations = durationHistogram()
+    durations.add(0.0)
+    assert durations.snapshot()["buckets"][0][1] == 1
+    assert durations.snapshot()["p50"] == 0.0
+
+def test_acquisitionSamplesTimings():
+    pytest.importorskip("usb")
+    from epoc_iohub import EmotivDevice
+    from epoc_sim import SimulatedTransport
+    device = EmotivDevice(transport=SimulatedTransport(realtime=False))
+    device.startAcuisition()
+    time.sleep(0.3)
+    device.stopAcquisition()
+    snapshot = device.getStats()
+    every = snapshot["sampleEvery"]
+    # Counters see every packet and batch, histograms one in sampleEvery
+    assert snapshot["packets"] == snapshot["batches"] > every
+    assert snapshot["decode"]["count"] == (snapshot["batches"] + every - 1) // every
+    assert snapshot["readWait"]["count"] == (snapshot["packets"] + every - 1) // every
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# vim:set et ts=4 sw=4:
+"""Tests of epoc_usb against fake pyusb devices, run with pytest."""
+
+import errno
+
+import pytest
+
+usb = pytest.importorskip("usb")
+import usb.core
+import usb.util
+
+import epoc_usb
+
+class FakeInterface(object):
+    def __init__(self, number, iInterface):
+        self.bInterfaceNumber = number
+        self.iInterface = iInterface
+
+class FakeDongle(object):
+    """A dongle whose string descriptors are looked up in `strings`."""
+    idVendor, idProduct = 0x21A1, 0x0001
+
+    def __init__(self, address, serialNumber, denied=False):
+        self.bus = 1
+        self.address = address
+        self.denied = denied
+        self.strings = {1: epoc_usb.MANUFACTURER_DESC, 2: "Emotiv DATA",
+                        3: epoc_usb.INTERFACE_DESC, 4: serialNumber}
+        self.iManufacturer = 1
+        self.iSerialNumber = 4
+        self.released = []
+
+    def get_active_configuration(self):
+        return [FakeInterface(0, 2), FakeInterface(1, 3)]
+
+def fakeGetString(device, length, index):
+    # The lock is not held during the control transfers
+    assert not epoc_usb._lock.locked()
+    if device.denied:
+        raise usb.core.USBError("Access denied", errno=errno.EACCES)
+    return device.strings[index]
+
+def fakeRelease(device, number):
+    device.released.append(number)
+
+class FakeBus(object):
+    """Patch pyusb so that the bus holds `devices` while in the block."""
+    def __init__(self, devices):
+        self.devices = devices
+
+    def find(self, find_all=False, custom_match=None):
+        return iter([dev for dev in self.devices if custom_match(dev)])
+
+    def __enter__(self):
+        self.saved = usb.core.find, usb.util.get_string, usb.util.release_interface
+        usb.core.find, usb.util.get_string, usb.util.release_interface = (
+            self.find, fakeGetString, fakeRelease)
+        epoc_usb._identified.clear()
+        epoc_usb._opened.clear()
+        return self
+
+    def __exit__(self, *exc):
+        usb.core.find, usb.util.get_string, usb.util.release_interface = self.saved
+        epoc_usb._identified.clear()
+        epoc_usb._opened.clear()
+
+def test_permissionFailureNotCached():
+    dongle = FakeDongle(5, "SN0001", denied=True)
+    with FakeBus([dongle]):
+        assert epoc_usb.findDongles() == []
+        # Permission granted meanwhile, e.g. a udev rule added
+        dongle.denied = False
+        assert epoc_usb.findDongles() == [("SN0001", dongle)]
+
+def test_releaseDongleForgetsEndpoint():
+    dongle = FakeDongle(6, "SN0002")
+    with FakeBus([dongle]):
+        epoc_usb._identified[1, 6] = "SN0002"
+        epoc_usb._opened["SN0002"] = (dongle, "endpoint")
+        assert epoc_usb.openDongle("SN0002") == ("SN0002", "endpoint")
+        epoc_usb.releaseDongle("SN0002")
+        assert dongle.released == [0, 1]
+        assert "SN0002" not in epoc_usb._opened
+        # Not opened by openDongle(), e.g. simulated
+        epoc_usb.releaseDongle("SN0003")